@@ -0,0 +1,452 @@
+"""
+This script runs performance benchmarks for the scripts that generate and convert the
+Mirador dataset, using synthetic inputs of configurable size so the results are not
+limited by the size of the actual data.
+
+-vcf: compares the streaming VCF reader against PyVCF on a synthetic cohort VCF, use
+      -samples and -sites to set its size.
+-csv: measures the throughput (rows/sec) and peak memory of makecsv.py on a synthetic
+      Mirador dataset, use -rows and -cols to set its size (e.g. -rows 2000000 -cols 200
+      for a dataset of a few GB).
+-pipeline: generates synthetic cohorts with the same layout as the files in sources/ and
+      times each stage of the pipeline (makemira.py with and without sequencing data, a 
+      no-op incremental rebuild, makecsv.py, and makespss.py with the card and .sav outputs), 
+      reporting wall time and peak memory per stage. Use -patients with a comma-separated 
+      list of cohort sizes to measure scaling, -series for the maximum length of the qPCR 
+      and Piccolo series, -snps for the number of SNP/iSNV sites, -samples for the number of
+      sequenced samples, and -report to save the results into a JSON file.
+-ranges: measures the throughput (panels/sec) of the Piccolo reference range flagging used by
+      makemira.py -ranges, use -panels to set the number of metabolic panels.
+-memory: measures the peak memory of makemira.py, which is mostly taken by the patient
+      records, on synthetic cohorts of the sizes given in -patients (e.g. -patients 1000000).
+-synth <folder>: only generates a synthetic cohort in the given folder, using the first 
+      cohort size in -patients.
+
+@copyright: Harvard University 2014-15
+"""
+
+import sys, os, csv, json, time, array, random, tempfile, shutil, subprocess
+import vcfstream, miradata
+
+"""Writes a synthetic VCF file with the same layout as iSNV-all.vcf (GT:AF format fields)
+
+:param filename: name of the vcf file
+:param nsamples: number of sample columns
+:param nsites: number of sites (records)
+"""
+def write_synthetic_vcf(filename, nsamples, nsites):
+    rnd = random.Random(0)
+    with open(filename, "w") as vcf_file:
+        vcf_file.write("##fileformat=VCFv4.1\n")
+        vcf_file.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        vcf_file.write('##FORMAT=<ID=AF,Number=A,Type=Float,Description="Allele Frequency">\n')
+        vcf_file.write("##contig=<ID=KM034562,length=18957>\n")
+        names = ["EBOV_2014_X" + str(7000 + i) for i in range(0, nsamples)]
+        vcf_file.write("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"] + names) + "\n")
+        for i in range(0, nsites):
+            calls = []
+            for j in range(0, nsamples):
+                if rnd.random() < 0.05:
+                    calls.append("1:" + str(rnd.random()))
+                else:
+                    calls.append("0:0.0")
+            vcf_file.write("KM034562\t" + str(i + 1) + "\t.\tA\tG\t.\t.\tEFF=intragenic_variant(MODIFIER|||||NP||CODING|||1)\tGT:AF\t" + "\t".join(calls) + "\n")
+
+"""Reads the GT and AF values of all samples with PyVCF, returns the number of values read
+
+:param filename: name of the vcf file
+"""
+def read_pyvcf(filename):
+    import vcf
+    count = 0
+    for record in vcf.Reader(open(filename, "r")):
+        for s in record.samples:
+            gt = s.data.GT
+            af = str(s.data.AF)
+            count = count + 1
+    return count
+
+"""Reads the GT and AF values of all samples with the streaming reader, returns the number
+of values read
+
+:param filename: name of the vcf file
+"""
+def read_vcfstream(filename):
+    count = 0
+    for site in vcfstream.Reader(filename, ["GT", "AF"]):
+        count = count + len(site.values[0])
+    return count
+
+"""Times a reader function and prints its throughput
+
+:param name: name of the reader
+:param func: reader function
+:param filename: name of the vcf file
+"""
+def time_reader(name, func, filename):
+    t0 = time.time()
+    count = func(filename)
+    t1 = time.time()
+    print("  " + name + ": " + "%.3f" % (t1 - t0) + " s, " + "%.0f" % (count / max(t1 - t0, 1e-9)) + " calls/s")
+    return t1 - t0
+
+def bench_vcf(nsamples, nsites):
+    print("VCF reader benchmark (" + str(nsamples) + " samples, " + str(nsites) + " sites)...")
+    folder = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(folder, "synthetic.vcf")
+        write_synthetic_vcf(filename, nsamples, nsites)
+        ts = time_reader("vcfstream", read_vcfstream, filename)
+        try:
+            tp = time_reader("PyVCF", read_pyvcf, filename)
+            print("  Speedup: " + "%.1f" % (tp / max(ts, 1e-9)) + "x")
+        except ImportError:
+            print("  PyVCF is not installed, skipping comparison")
+    finally:
+        shutil.rmtree(folder)
+    print("Done.")
+
+"""Writes a synthetic Mirador dataset (config.mira, dictionary.csv and data.csv) with a mix
+of int, float, date, category and string variables, and about 10% of missing values.
+
+:param folder: folder to save the dataset into
+:param nrows: number of rows
+:param ncols: number of columns
+"""
+def write_synthetic_mirador(folder, nrows, ncols):
+    rnd = random.Random(0)
+    with open(os.path.join(folder, "config.mira"), "w") as mira_file:
+        mira_file.write("data.source=data.csv\ndata.dictionary=dictionary.csv\nmissing.string=\\N\n")
+    types = ["int", "float", "date", "category", "String"]
+    col_types = [types[i % len(types)] for i in range(0, ncols)]
+    with open(os.path.join(folder, "dictionary.csv"), "w") as dict_file:
+        for i in range(0, ncols):
+            if col_types[i] == "category":
+                dict_file.write("Variable " + str(i) + ",category,1:Yes;0:No;2:Unknown\n")
+            else:
+                dict_file.write("Variable " + str(i) + "," + col_types[i] + "\n")
+    generators = {"int": lambda: str(rnd.randint(0, 100)),
+                  "float": lambda: repr(rnd.random() * 1e6),
+                  "date": lambda: "2014-%02d-%02d" % (rnd.randint(1, 12), rnd.randint(1, 28)),
+                  "category": lambda: str(rnd.randint(0, 2)),
+                  "String": lambda: "X-" + str(rnd.randint(1000, 9999))}
+    with open(os.path.join(folder, "data.csv"), "w") as data_file:
+        data_file.write(",".join("V" + str(i) for i in range(0, ncols)) + "\n")
+        for r in range(0, nrows):
+            row = ["\\N" if rnd.random() < 0.1 else generators[t]() for t in col_types]
+            data_file.write(",".join(row) + "\n")
+
+"""Runs a script in a separate process, returns its wall time and peak memory (in MB)
+
+:param args: command line of the script, starting with the name of the script
+:param cwd: working directory of the script
+"""
+def run_script(args, cwd=None):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), args[0])
+    t0 = time.time()
+    proc = subprocess.Popen([sys.executable, script] + args[1:], stdout=open(os.devnull, "w"), cwd=cwd)
+    [pid, status, usage] = os.wait4(proc.pid, 0)
+    t1 = time.time()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError(args[0] + " failed with exit code " + str(proc.returncode))
+    peak = usage.ru_maxrss / 1024.0
+    if sys.platform == "darwin": peak = peak / 1024.0
+    return [t1 - t0, peak]
+
+def bench_csv(nrows, ncols):
+    print("makecsv.py benchmark (" + str(nrows) + " rows, " + str(ncols) + " columns)...")
+    folder = tempfile.mkdtemp()
+    try:
+        write_synthetic_mirador(folder, nrows, ncols)
+        size = os.path.getsize(os.path.join(folder, "data.csv")) / (1024.0 * 1024.0)
+        print("  Dataset size: " + "%.1f" % size + " MB")
+        [elapsed, peak] = run_script(["makecsv.py", "-in", folder, "-out", os.path.join(folder, "out", "data.csv")])
+        print("  Time: " + "%.2f" % elapsed + " s, " + "%.0f" % (nrows / max(elapsed, 1e-9)) + " rows/s, " + "%.1f" % (size / max(elapsed, 1e-9)) + " MB/s")
+        print("  Peak memory: " + "%.1f" % peak + " MB")
+    finally:
+        shutil.rmtree(folder)
+    print("Done.")
+
+"""Measures the time needed to convert synthetic metabolic panels into a numeric matrix with
+the reference limits for the sex of each patient, and to flag the values in the matrix
+
+:param npanels: number of panels
+"""
+def bench_ranges(npanels):
+    print("Piccolo range flagging benchmark (" + str(npanels) + " panels)...")
+    rnd = random.Random(0)
+    limits = {"Female": [[], []], "Male": [[], []]}
+    root = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(root, "piccolo-expected.csv"), "r") as file:
+        reader = csv.reader(file)
+        next(reader)
+        for row in reader:
+            parts = row[3].split(" ", 1)[0].split(":")
+            for sex, part in [["Female", parts[0]], ["Male", parts[-1]]]:
+                [low, high] = [float(x) for x in part.split("-")]
+                limits[sex][0].append(low)
+                limits[sex][1].append(high)
+    nanalytes = len(limits["Female"][0])
+    panels = []
+    for i in range(0, npanels):
+        sex = rnd.choice(["Female", "Male"])
+        values = [repr(round(rnd.uniform(0.5 * low, 1.5 * high), 2)) if rnd.random() < 0.95 else "" 
+                  for low, high in zip(limits[sex][0], limits[sex][1])]
+        panels.append([sex, values])
+
+    t0 = time.time()
+    values = array.array("d")
+    lows = array.array("d")
+    highs = array.array("d")
+    for [sex, row] in panels:
+        values.extend([miradata.parse_number(value) for value in row])
+        lows.extend(limits[sex][0])
+        highs.extend(limits[sex][1])
+    t1 = time.time()
+    flags = miradata.flag_ranges(values, lows, highs)
+    t2 = time.time()
+    abnormal = sum(1 for flag in flags if flag == miradata.RANGE_BELOW or flag == miradata.RANGE_ABOVE)
+    print("  Matrix: " + "%.2f" % (t1 - t0) + " s, " + "%.0f" % (npanels / max(t1 - t0, 1e-9)) + " panels/s")
+    print("  Flags: " + "%.2f" % (t2 - t1) + " s, " + "%.0f" % (npanels / max(t2 - t1, 1e-9)) + " panels/s, " + 
+          "%.0f" % (npanels * nanalytes / max(t2 - t1, 1e-9)) + " values/s")
+    print("  Values out of range: " + str(abnormal) + " of " + str(len(flags)))
+    print("Done.")
+
+"""Returns the entries of a dictionary file used by makemira.py (demo-dict.csv or
+case-dict.csv) as a list of [column, type, labels], where labels is the list of raw values
+accepted by the category variables, or None for other variables.
+
+:param filename: csv file containing the dictionary
+"""
+def read_source_dict(filename):
+    entries = []
+    with open(filename, "r") as dict_file:
+        for row in csv.reader(dict_file):
+            labels = None
+            if len(row) == 7:
+                labels = [""] + [p.split(":")[1] for p in row[6].split(";") if p]
+            entries.append([int(row[0]), row[5], labels])
+    return entries
+
+"""Returns the header of a file in the sources folder
+
+:param filename: csv file
+"""
+def read_source_header(filename):
+    with open(filename, "r") as file:
+        return next(csv.reader(file))
+
+"""Returns a random value for a source column of the given type
+
+:param rnd: random generator
+:param type: variable type
+:param labels: values accepted by category variables
+"""
+def random_value(rnd, type, labels):
+    if rnd.random() < 0.1: return ""
+    if labels is not None: return rnd.choice(labels)
+    if type == "int": return str(rnd.randint(1, 80))
+    if type == "float": return repr(round(rnd.uniform(30, 200), 2))
+    if type == "date": return random_date(rnd)
+    return "S" + str(rnd.randint(0, 99))
+
+def random_date(rnd):
+    return "2014-%02d-%02d" % (rnd.randint(5, 12), rnd.randint(1, 28))
+
+"""Writes a synthetic cohort with the same layout as the files in the sources folder (and the
+dictionaries, idignore and config.mira needed to run makemira.py), with random data.
+
+:param folder: folder to save the cohort into
+:param npatients: number of patients
+:param max_series: maximum length of the qPCR and Piccolo series of a patient
+:param nsnps: number of SNP and iSNV sites
+:param nsamples: number of sequenced samples (at most the number of patients)
+"""
+def write_synthetic_cohort(folder, npatients, max_series, nsnps, nsamples):
+    rnd = random.Random(0)
+    root = os.path.dirname(os.path.abspath(__file__))
+    for fn in ["config.mira", "idignore", "demo-dict.csv", "case-dict.csv", "piccolo-expected.csv"]:
+        shutil.copyfile(os.path.join(root, fn), os.path.join(folder, fn))
+    csv_folder = os.path.join(folder, "sources", "csv")
+    vcf_folder = os.path.join(folder, "sources", "vcf")
+    for fn in [csv_folder, vcf_folder]:
+        if not os.path.exists(fn): os.makedirs(fn)
+    ids = [str(7000 + i) for i in range(0, npatients)]
+
+    # Master table: one row per qPCR measurement
+    master_name = "MasterDataListandEBOVResults.csv"
+    with open(os.path.join(csv_folder, master_name), "w") as file:
+        writer = csv.writer(file)
+        writer.writerow(read_source_header(os.path.join(root, "sources", "csv", master_name)))
+        for id in ids:
+            group = "Epos" if rnd.random() < 0.7 else "Eneg"
+            for s in range(1, rnd.randint(1, max_series) + 1):
+                vload = repr(rnd.uniform(10, 1e9)) if group == "Epos" and rnd.random() < 0.9 else ""
+                writer.writerow(["X-" + id, "X-" + id, "", str(s), "", random_date(rnd), "", "X-" + id, vload,
+                                 "Positive" if group == "Epos" else "Negative", group])
+
+    # Demographics and case notification tables: values for the columns in the dictionaries
+    for [fname, dname, id_col] in [["DemographicsFromSim_schieffelin.csv", "demo-dict.csv", 1],
+                                   ["CaseNotification_schieffelin.csv", "case-dict.csv", 0]]:
+        header = read_source_header(os.path.join(root, "sources", "csv", fname))
+        entries = read_source_dict(os.path.join(root, dname))
+        with open(os.path.join(csv_folder, fname), "w") as file:
+            writer = csv.writer(file)
+            writer.writerow(header)
+            for id in ids:
+                row = [""] * len(header)
+                row[id_col] = "X-" + id
+                for [col, type, labels] in entries:
+                    row[col] = random_value(rnd, type, labels)
+                if fname.startswith("Demographics"):
+                    row[3] = rnd.choice(["Female", "Male", ""])
+                writer.writerow(row)
+
+    # Piccolo table: one row per metabolic panel
+    pico_name = "FinalPiccoloData_schieffelin-FinalSummary1.csv"
+    header = read_source_header(os.path.join(root, "sources", "csv", pico_name))
+    with open(os.path.join(csv_folder, pico_name), "w") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        for id in ids:
+            if rnd.random() < 0.5: continue
+            for s in range(1, rnd.randint(1, max_series) + 1):
+                row = [repr(round(rnd.uniform(0.1, 200), 2)) for i in range(0, len(header))]
+                row[0:8] = [id + "-" + str(s), id + "-" + str(s), "X-" + id + "-" + str(s), "X-" + id, str(s), str(s), random_date(rnd), random_date(rnd)]
+                writer.writerow(row)
+
+    # SNP and iSNV data: the AF data is always loaded for site 10218
+    samples = ids[0:min(nsamples, npatients)]
+    positions = sorted(set(rnd.sample(range(1, 18957), min(nsnps, 18956)) + [10218]))
+    for [vname, format] in [["SNP-2014.vcf", "GT"], ["iSNV-all.vcf", "GT:AF"]]:
+        with open(os.path.join(vcf_folder, vname), "w") as file:
+            file.write("##fileformat=VCFv4.1\n")
+            file.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+            file.write('##FORMAT=<ID=AF,Number=A,Type=Float,Description="Allele Frequency">\n')
+            names = ["EBOV_2014_X" + id + (".1" if format == "GT:AF" else "") for id in samples]
+            file.write("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"] + names) + "\n")
+            for pos in positions:
+                calls = []
+                for id in samples:
+                    if rnd.random() < 0.1:
+                        calls.append("1" if format == "GT" else "1:" + repr(rnd.random()))
+                    else:
+                        calls.append("0" if format == "GT" else "0:0.0")
+                file.write("KM034562\t" + str(pos) + "\t.\tA\tG\t.\t.\tEFF=intragenic_variant(MODIFIER|||||NP||CODING|||1)\t" + format + "\t" + "\t".join(calls) + "\n")
+
+    # Cluster data for the sequenced samples
+    with open(os.path.join(vcf_folder, "clusters.tsv"), "w") as file:
+        file.write("Sample\tTimepoint\tCluster\tDate\n")
+        for id in samples:
+            cluster = str(rnd.randint(1, 3)) + "." + str(rnd.randint(1, 3)) + str(rnd.randint(1, 3))
+            file.write("X" + id + "\t1\t" + cluster + "\t25-May-14\n")
+
+"""Runs each stage of the pipeline on a synthetic cohort, returns a list of results per stage
+
+:param npatients: number of patients
+:param max_series: maximum length of the qPCR and Piccolo series of a patient
+:param nsnps: number of SNP and iSNV sites
+:param nsamples: number of sequenced samples
+"""
+def bench_cohort(npatients, max_series, nsnps, nsamples):
+    folder = tempfile.mkdtemp()
+    results = []
+    try:
+        t0 = time.time()
+        write_synthetic_cohort(folder, npatients, max_series, nsnps, nsamples)
+        print("  Cohort with " + str(npatients) + " patients generated in " + "%.2f" % (time.time() - t0) + " s")
+        stages = [["makemira", ["makemira.py", "-csv", "-force"]],
+                  ["makemira -seq", ["makemira.py", "-csv", "-seq", "-force"]],
+                  ["makemira -seq (no changes)", ["makemira.py", "-csv", "-seq"]],
+                  ["makemira -kinetics -ranges", ["makemira.py", "-csv", "-kinetics", "-ranges", "-force"]],
+                  ["makecsv", ["makecsv.py", "-in", "mirador", "-out", "out/ebola-data.csv"]],
+                  ["makespss", ["makespss.py", "-in", "mirador", "-out", "out/spss/ebola-data.csv"]],
+                  ["makespss .sav", ["makespss.py", "-in", "mirador", "-out", "out/spss/ebola-data.sav"]]]
+        for [name, args] in stages:
+            [elapsed, peak] = run_script(args, folder)
+            print("    " + name.ljust(28) + "%10.2f s" % elapsed + "%10.1f MB" % peak)
+            results.append({"patients": npatients, "stage": name, "time": elapsed, "peak_mb": peak})
+        size = os.path.getsize(os.path.join(folder, "mirador", "data.csv")) / (1024.0 * 1024.0)
+        print("    Dataset size: " + "%.1f" % size + " MB")
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+def bench_pipeline(patient_counts, max_series, nsnps, nsamples, report):
+    print("Pipeline benchmark (series up to " + str(max_series) + ", " + str(nsnps) + " sites, " + str(nsamples) + " samples)...")
+    results = []
+    for npatients in patient_counts:
+        results.extend(bench_cohort(npatients, max_series, nsnps, nsamples))
+    if report:
+        with open(report, "w") as file:
+            json.dump(results, file, indent=1)
+        print("  Results saved to " + report)
+    print("Done.")
+
+def bench_memory(patient_counts, max_series):
+    print("makemira.py memory benchmark (series up to " + str(max_series) + ")...")
+    for npatients in patient_counts:
+        folder = tempfile.mkdtemp()
+        try:
+            write_synthetic_cohort(folder, npatients, max_series, 10, 100)
+            [elapsed, peak] = run_script(["makemira.py", "-csv", "-force"], folder)
+            print("  " + str(npatients).rjust(9) + " patients" + "%10.2f s" % elapsed + "%10.1f MB" % peak + 
+                  "%10.2f KB/patient" % (1024.0 * peak / npatients))
+        finally:
+            shutil.rmtree(folder)
+    print("Done.")
+
+##########################################################################################
+#
+# Main
+#
+##########################################################################################
+
+run_vcf = False
+run_csv = False
+run_pipeline = False
+run_ranges = False
+run_memory = False
+num_panels = 500000
+synth_folder = None
+patient_counts = [1000, 10000]
+max_series = 10
+num_snps = 100
+report_name = None
+num_samples = 2000
+num_sites = 500
+num_rows = 100000
+num_cols = 200
+for i in range(1, len(sys.argv)):
+    arg = sys.argv[i]
+    if arg == "-vcf": run_vcf = True
+    elif arg == "-csv": run_csv = True
+    elif arg == "-pipeline": run_pipeline = True
+    elif arg == "-ranges": run_ranges = True
+    elif arg == "-memory": run_memory = True
+    elif arg == "-panels": num_panels = int(sys.argv[i + 1])
+    elif arg == "-synth": synth_folder = sys.argv[i + 1]
+    elif arg == "-patients": patient_counts = [int(n) for n in sys.argv[i + 1].split(",")]
+    elif arg == "-series": max_series = int(sys.argv[i + 1])
+    elif arg == "-snps": num_snps = int(sys.argv[i + 1])
+    elif arg == "-report": report_name = sys.argv[i + 1]
+    elif arg == "-rows": num_rows = int(sys.argv[i + 1])
+    elif arg == "-cols": num_cols = int(sys.argv[i + 1])
+    elif arg == "-samples": num_samples = int(sys.argv[i + 1])
+    elif arg == "-sites": num_sites = int(sys.argv[i + 1])
+
+if run_vcf:
+    bench_vcf(num_samples, num_sites)
+if run_csv:
+    bench_csv(num_rows, num_cols)
+if run_ranges:
+    bench_ranges(num_panels)
+if run_pipeline:
+    bench_pipeline(patient_counts, max_series, num_snps, num_samples, report_name)
+if run_memory:
+    bench_memory(patient_counts, max_series)
+if synth_folder:
+    print("Generating synthetic cohort in " + synth_folder + "...")
+    write_synthetic_cohort(synth_folder, patient_counts[0], max_series, num_snps, num_samples)
+    print("Done.")
@@ -0,0 +1,301 @@
+"""
+This module keeps track of the inputs and outputs of a build of the Mirador dataset, so
+makemira.py can skip the work that does not need to be redone:
+
+1) a build manifest stored with the dataset records the content hash of every input file,
+the build options, and the hash of every output file. When nothing changed since the last
+build, the dataset is up to date and makemira.py stops right away.
+
+2) a parsed-result cache stores the result of parsing each input file, keyed by the content
+hash of the file, so unchanged inputs do not need to be parsed again. The results are stored 
+as compressed pickle files, shared by all the scripts that use the same cache folder, and the 
+least recently used results are evicted when the cache grows over its size limit. The content
+hash of each file is remembered together with its path, size and modification time, so files 
+that were not modified are not read again to compute their hash. The cache can be inspected 
+and cleared with:
+
+python buildcache.py -info
+python buildcache.py -clear
+python buildcache.py -invalidate sources/vcf/SNP-2014.vcf
+
+3) output files are written to a temporary file first, and only replace the existing file
+when their content changes, so unchanged files (and the binary data file derived from them)
+are left alone.
+
+@copyright: Harvard University 2014-15
+"""
+
+import os, sys, time, zlib, hashlib, json, pickle, filecmp
+
+# Default size limit of the parsed-result cache, in MB
+CACHE_SIZE = 512
+
+"""Returns the SHA-1 hash of the contents of a file
+
+:param filename: name of the file
+"""
+def file_hash(filename):
+    sha = hashlib.sha1()
+    with open(filename, "rb") as file:
+        while True:
+            chunk = file.read(1 << 20)
+            if not chunk: break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+"""Build manifest, holding the input hashes, options, and output hashes of the last build.
+
+:param filename: name of the manifest file
+:param hasher: function returning the content hash of a file
+"""
+class Manifest(object):
+    def __init__(self, filename, hasher=file_hash):
+        self.filename = filename
+        self.hasher = hasher
+        self.data = {"inputs": {}, "options": [], "outputs": {}, "ingested": []}
+        if os.path.isfile(filename):
+            try:
+                with open(filename, "r") as file:
+                    self.data = json.load(file)
+            except ValueError:
+                print("  Warning: ignoring corrupted build manifest " + filename)
+
+    """Returns true if the inputs and options are the same as in the last build, and the
+    outputs of the last build have not been modified since. Outputs with rows ingested after
+    the last build (see save) are not up to date, unless ingested is true.
+
+    :param inputs: list of input files
+    :param options: list of build options
+    :param ingested: true to accept outputs with ingested rows
+    """
+    def up_to_date(self, inputs, options, ingested=False):
+        if self.data.get("ingested") and not ingested: return False
+        if sorted(options) != self.data["options"]: return False
+        if set(inputs) != set(self.data["inputs"]): return False
+        for fn in inputs:
+            if not os.path.isfile(fn) or self.hasher(fn) != self.data["inputs"][fn]: return False
+        if not self.data["outputs"]: return False
+        for fn in self.data["outputs"]:
+            if not os.path.isfile(fn) or self.hasher(fn) != self.data["outputs"][fn]: return False
+        return True
+
+    """Records the current build and saves the manifest.
+
+    :param inputs: list of input files
+    :param options: list of build options
+    :param outputs: list of output files
+    :param ingested: fingerprints of the new rows ingested into the outputs after they were
+                     built from the inputs
+    """
+    def save(self, inputs, options, outputs, ingested=None):
+        self.data = {"inputs": dict((fn, self.hasher(fn)) for fn in inputs),
+                     "options": sorted(options),
+                     "outputs": dict((fn, self.hasher(fn)) for fn in outputs if os.path.isfile(fn)),
+                     "ingested": ingested or []}
+        with open(self.filename, "w") as file:
+            json.dump(self.data, file, indent=1, sort_keys=True)
+
+"""Content hashes of files, stored with the size and modification time of each file so the
+hash is only computed again when the file is modified.
+
+:param filename: name of the file where the hashes are stored
+"""
+class HashIndex(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.hashes = {}
+        self.modified = False
+        if os.path.isfile(filename):
+            try:
+                with open(filename, "r") as file:
+                    self.hashes = json.load(file)
+            except ValueError:
+                print("  Warning: ignoring corrupted hash index " + filename)
+
+    """Returns the SHA-1 hash of the contents of a file
+
+    :param filename: name of the file
+    """
+    def hash(self, filename):
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        entry = self.hashes.get(path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        sha = file_hash(path)
+        self.hashes[path] = [stat.st_size, stat.st_mtime_ns, sha]
+        self.modified = True
+        return sha
+
+    """Forgets the hash of a file
+
+    :param filename: name of the file
+    """
+    def remove(self, filename):
+        path = os.path.abspath(filename)
+        if path in self.hashes:
+            del self.hashes[path]
+            self.modified = True
+
+    def save(self):
+        if not self.modified: return
+        folder = os.path.split(self.filename)[0]
+        if folder and not os.path.exists(folder): os.makedirs(folder)
+        tmp = self.filename + "." + str(os.getpid()) + ".tmp"
+        with open(tmp, "w") as file:
+            json.dump(self.hashes, file)
+        os.replace(tmp, self.filename)
+        self.modified = False
+
+"""Cache of parsed results for the input files, stored as compressed pickle files in the cache
+folder. The name of each file includes the hash of the input, and the modification time of 
+the file is updated each time it is used, so the least recently used results are evicted 
+first when the total size goes over the limit.
+
+:param folder: cache folder
+:param version: version string of the parsing code, results stored by a different version
+                are not used
+:param max_size: size limit of the cache in MB
+"""
+class ResultCache(object):
+    def __init__(self, folder, version="", max_size=CACHE_SIZE):
+        self.folder = folder
+        self.version = version
+        self.max_size = max_size
+        self.hashes = HashIndex(os.path.join(folder, "hashes.json"))
+
+    def hash(self, filename):
+        return self.hashes.hash(filename)
+
+    """Returns the result of calling func(filename, *args), from the cache if the file did
+    not change since the result was stored.
+
+    :param func: parsing function
+    :param filename: input file to parse
+    :param args: additional arguments for the parsing function
+    """
+    def call(self, func, filename, *args):
+        sha = self.hash(filename)
+        key = hashlib.sha1((self.version + "|" + func.__module__ + "." + func.__name__ + "|" + sha + "|" + repr(args)).encode("utf-8")).hexdigest()
+        fn = os.path.join(self.folder, func.__name__ + "-" + sha[:16] + "-" + key[:24] + ".pickle.z")
+        if os.path.isfile(fn):
+            try:
+                with open(fn, "rb") as file:
+                    result = pickle.loads(zlib.decompress(file.read()))
+                os.utime(fn)
+                return result
+            except Exception:
+                print("  Warning: ignoring corrupted cache file " + fn)
+        result = func(filename, *args)
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        tmp = fn + "." + str(os.getpid()) + ".tmp"
+        with open(tmp, "wb") as file:
+            file.write(zlib.compress(pickle.dumps(result, pickle.HIGHEST_PROTOCOL), 1))
+        os.replace(tmp, fn)
+        self.evict()
+        return result
+
+    """Returns the list of [name, size, time of last use] of the results in the cache
+    """
+    def entries(self):
+        if not os.path.isdir(self.folder): return []
+        entries = []
+        for name in os.listdir(self.folder):
+            if not name.endswith(".pickle.z"): continue
+            try:
+                stat = os.stat(os.path.join(self.folder, name))
+            except OSError:
+                # Removed by another process
+                continue
+            entries.append([name, stat.st_size, stat.st_mtime])
+        return entries
+
+    """Removes the least recently used results until the cache is under its size limit
+    """
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(entry[1] for entry in entries)
+        while entries and self.max_size * 1024 * 1024 < total:
+            [name, size, used] = entries.pop(0)
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
+            total -= size
+
+    """Removes the stored results for a file, or all the results if no file is given
+
+    :param filename: input file
+    """
+    def invalidate(self, filename=None):
+        if filename is None:
+            for [name, size, used] in self.entries(): os.remove(os.path.join(self.folder, name))
+            self.hashes.hashes = {}
+            self.hashes.modified = True
+        else:
+            sha = file_hash(filename)
+            for [name, size, used] in self.entries():
+                if "-" + sha[:16] + "-" in name: os.remove(os.path.join(self.folder, name))
+            self.hashes.remove(filename)
+        self.save()
+
+    """Saves the hashes of the input files, so they are not computed again in the next run
+    """
+    def save(self):
+        if os.path.isdir(self.folder): self.hashes.save()
+
+"""Output file that is written to a temporary file, and only replaces the target file when
+its contents are different. Works with any function that opens files, e.g. open or
+codecs.open.
+
+:param filename: name of the output file
+:param opener: function used to open the temporary file
+:param mode: mode used to open the temporary file
+:param args: additional arguments for the opener
+"""
+class OutputFile(object):
+    def __init__(self, filename, opener=open, mode="w", *args):
+        self.filename = filename
+        self.tmp = filename + ".tmp"
+        self.changed = False
+        self.file = opener(self.tmp, mode, *args)
+
+    def __enter__(self):
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is not None:
+            os.remove(self.tmp)
+            return False
+        if os.path.isfile(self.filename) and filecmp.cmp(self.tmp, self.filename, shallow=False):
+            os.remove(self.tmp)
+        else:
+            os.replace(self.tmp, self.filename)
+            self.changed = True
+        return False
+
+if __name__ == "__main__":
+    cache_folder = ".cache"
+    for i in range(1, len(sys.argv)):
+        arg = sys.argv[i]
+        if arg == "-folder":
+            cache_folder = sys.argv[i + 1]
+    cache = ResultCache(cache_folder)
+    for i in range(1, len(sys.argv)):
+        arg = sys.argv[i]
+        if arg == "-info":
+            entries = cache.entries()
+            print(str(len(entries)) + " results in " + cache_folder + ", " + "%.1f" % (sum(entry[1] for entry in entries) / (1024.0 * 1024.0)) + " MB")
+            for [name, size, used] in sorted(entries, key=lambda entry: entry[2], reverse=True):
+                print("  " + name + " " + str(size) + " bytes, last used " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(used)))
+        elif arg == "-clear":
+            cache.invalidate()
+            print("Cache cleared.")
+        elif arg == "-invalidate":
+            cache.invalidate(sys.argv[i + 1])
+            print("Results for " + sys.argv[i + 1] + " removed from the cache.")
+        elif arg == "-evict":
+            cache.max_size = float(sys.argv[i + 1])
+            cache.evict()
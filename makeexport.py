@@ -0,0 +1,54 @@
+"""
+This script exports a Mirador dataset into several formats in a single pass over the data,
+which is read only once regardless of the number of outputs:
+
+-csv <file>: single CSV file with long variable names and category labels (as makecsv.py)
+-miss <str>: missing string for the CSV file
+-spss <file>: copy of the data with a SPSS control card (as makespss.py)
+-sav <file>: SPSS system file
+-plugin <module.Class:file>: sink provided by another module, see miraexport.py
+
+Example:
+python makeexport.py -in mirador -csv csv/ebola-data.csv -sav spss/ebola-data.sav
+
+@copyright: Harvard University 2014-15
+"""
+
+import sys
+import miraexport, buildcache
+
+mirador_folder = "./mirador/"
+miss_dst = ""
+outputs = []
+plugins = []
+cache_size = buildcache.CACHE_SIZE
+
+for i in range(1, len(sys.argv)):
+    arg = sys.argv[i]
+    if arg == "-in": mirador_folder = sys.argv[i + 1]
+    elif arg == "-cachesize": cache_size = float(sys.argv[i + 1])
+    elif arg == "-miss": miss_dst = sys.argv[i + 1]
+    elif arg == "-plugin": plugins.append(sys.argv[i + 1])
+    elif arg[1:] in miraexport.SINKS: outputs.append([arg[1:], sys.argv[i + 1]])
+
+sinks = []
+for [name, filename] in outputs:
+    if name == "csv":
+        sinks.append(miraexport.CSVSink(filename, miss_dst))
+    else:
+        sinks.append(miraexport.SINKS[name](filename))
+for spec in plugins:
+    sinks.append(miraexport.load_plugin(spec))
+if not sinks:
+    print("No outputs were given, nothing to export.")
+    sys.exit(1)
+
+print("Reading Mirador data...")
+project = miraexport.Project(mirador_folder, miraexport.open_cache(max_size=cache_size))
+print("Exporting data...")
+for [name, filename] in outputs:
+    print("  " + name + ": " + filename + "...")
+for spec in plugins:
+    print("  plugin: " + spec + "...")
+count = miraexport.export(mirador_folder, sinks, project)
+print("Done, " + str(count) + " rows exported.")
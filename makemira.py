@@ -13,20 +13,116 @@ http://www.nejm.org/doi/full/10.1056/NEJMoa1411680
 The aggregation results in a single dataset specially formatted for loading into the 
 visualization tool Mirador (http://fathom.info/mirador)
 
+The script can also be imported as a module: the loaders, aggregators and writers are methods
+of a Builder, which takes the sources and options explicitly, so several variants of the 
+dataset can be built in the same process (see Builder). The modules that read the Excel 
+workbooks and VCF files are only imported when these files are read.
+
 @copyright: Harvard University 2014-15
 """
 
-import sys, csv, os, codecs, shutil, math, time, re, vcf
-import collections
-import xml.dom.minidom
-from time import mktime
+import sys, csv, os, codecs, shutil, math, array
+import miradata, buildcache, miraprof, patientindex
+import collections, filecmp, functools, itertools, operator, multiprocessing, concurrent.futures
+import xml.sax, xml.sax.handler, xml.sax.saxutils
+
+"""Streaming XML writer: elements are written one line at a time, indented by their depth, and 
+closed in the order they were opened, so the output is well-formed by construction. Attribute 
+values are escaped, and characters outside the ASCII range are written as character references.
+When validation is enabled, each line is also fed to an incremental SAX parser as it is 
+written, so the document is checked without keeping it in memory.
+
+:param file: output file
+:param validate: true to check the document with a SAX parser
+"""
+class XMLWriter(object):
+    def __init__(self, file, validate=True):
+        self.file = file
+        self.stack = []
+        self.parser = None
+        if validate:
+            self.parser = xml.sax.make_parser()
+            self.parser.setContentHandler(xml.sax.handler.ContentHandler())
+        self.write_line('<?xml version="1.0"?>')
+
+    def write_line(self, line):
+        line = line.encode("ascii", "xmlcharrefreplace").decode("ascii") + "\n"
+        self.file.write(line)
+        if self.parser: self.parser.feed(line)
+
+    def tag(self, name, attrs):
+        return "<" + name + "".join(" " + key + "=" + xml.sax.saxutils.quoteattr(str(attrs[key])) for key in attrs)
+
+    """Opens an element
 
-def write_xml_line(line, xml_file, xml_strings):
-    ascii_line = ''.join(char for char in line if ord(char) < 128)
-    if len(ascii_line) < len(line):
-        print("  Warning: non-ASCII character found in line: '" + line.encode('ascii', 'ignore') + "'")
-    xml_file.write(ascii_line + "\n")
-    xml_strings.append(ascii_line + "\n")
+    :param name: name of the element
+    :param attrs: dictionary of attributes
+    """
+    def start(self, name, attrs={}):
+        self.write_line(" " * len(self.stack) + self.tag(name, attrs) + ">")
+        self.stack.append(name)
+
+    """Writes an element without children
+
+    :param name: name of the element
+    :param attrs: dictionary of attributes
+    """
+    def empty(self, name, attrs={}):
+        self.write_line(" " * len(self.stack) + self.tag(name, attrs) + "/>")
+
+    """Closes the last element opened
+    """
+    def end(self):
+        name = self.stack.pop()
+        self.write_line(" " * len(self.stack) + "</" + name + ">")
+
+    """Closes all the open elements, and finishes the validation
+    """
+    def close(self):
+        while self.stack: self.end()
+        if self.parser: self.parser.close()
+
+"""Returns all the rows in a csv file
+
+:param filename: csv file to read
+:param dialect: csv dialect of the file
+"""
+def read_csv(filename, dialect="excel"):
+    with open(filename, "r") as file:
+        return list(csv.reader(file, dialect=dialect))
+
+"""Returns all the rows in a source table, either an Excel workbook, which is read directly
+with the same values that in2csv would write, or a csv file. It is called through the
+parsed-result cache, so unchanged sources are not parsed again.
+
+:param filename: .xlsx or csv file to read
+:param sheet: sheet of the workbook, the first sheet if not provided
+"""
+def read_table(filename, sheet=None):
+    if filename.lower().endswith(".xlsx"):
+        import xlsxstream
+        return list(xlsxstream.read_sheet(filename, sheet))
+    return read_csv(filename)
+
+"""Returns the rows of a table in the folder of new rows to ingest, None if the folder does
+not have the table
+
+:param folder: folder with the new rows
+:param name: name of the csv file of the table
+"""
+def read_delta(folder, name):
+    filename = os.path.join(folder, name)
+    if not os.path.isfile(filename): return None
+    return read_csv(filename)
+
+"""Returns the fingerprint of the new rows in a folder to ingest, with the content hash of each
+table in the folder
+
+:param folder: folder with the new rows
+"""
+def delta_hash(folder):
+    names = [name for name in DELTA_TABLES if os.path.isfile(os.path.join(folder, name))]
+    return ",".join(name + ":" + buildcache.file_hash(os.path.join(folder, name)) for name in names)
 
 """Returns a list of patient ids to ignore in the aggregation
 
@@ -40,153 +136,12 @@ def load_ignore(filename):
            list.append(line.strip())
     return list
     
-"""Reads the master table and adds its entries to src_data
-
-:param filename: csv file containing the master table
-"""
-def load_master(filename):
-    reader = csv.reader(open(filename, "r"), dialect="excel")
-    next(reader)
-    for row in reader:
-        id = row[1]
-        if id in ignore_id: continue
-        idx = row[3]
-        date = row[5]
-        vload = row[8]
-        result = row[9]
-        group = row[10]
-        if not group: continue
-        if id in src_data:
-            series = src_data[id]["qpcr"]
-        else:
-            data = {}
-            src_data[id] = data
-            data["group"] = group
-            data["outcome"] = None
-            data["sex"] = None            
-            data["demo"] = None
-            data["case"] = None
-            data["pico"] = None
-            series = []
-            data["qpcr"] = series 
-        series.append([idx,date,vload])
-
-"""Reads the demographics table and adds its entries to src_data
-
-:param filename: csv file containing the demographics table
-"""
-def load_demo(filename):
-    reader = csv.reader(open(filename, "r"), dialect="excel")
-    next(reader)
-    for row in reader:
-        id = row[1]
-        if not id in src_data: continue
-        sex = row[3]
-        outcome = row[7]
-        src_data[id]["outcome"] = outcome
-        src_data[id]["sex"] = sex
-        src_data[id]["demo"] = row    
-
-"""Reads the case notification (clinical symptoms) table and adds its entries to src_data
+"""Returns a new patient record from the first row of the patient in the master table
 
-:param filename: csv file containing the demographics table
+:param row: row of the master table
 """
-def load_case(filename):
-    reader = csv.reader(open(filename, "r"), dialect="excel")
-    next(reader)
-    for row in reader:
-        id = row[0]
-        if not id in src_data: continue  
-        src_data[id]["case"] = row
-
-"""Reads the Piccolo (metabolic panel) table and adds its entries to src_data
-
-:param filename: csv file containing the Piccolo table
-"""
-def load_pico_data(filename): 
-    reader = csv.reader(open(filename, "r"), dialect="excel")
-    next(reader)
-    for row in reader:
-        id = row[3]
-        if not id in src_data: continue 
-        if not src_data[id]["pico"] == None:
-            pico_series = src_data[id]["pico"]
-        else:
-            pico_series = []
-            src_data[id]["pico"] = pico_series
-        pico_series.append(row)                           
-
-"""Prints some summary counts for debugging
-"""
-def print_summary():
-    count_total = len(src_data)
-    count_pos = 0
-    count_neg = 0
-    count_case = 0
-    count_pos_pico = 0
-    count_neg_pico = 0
-    count_known_out = 0
-    count_vload = 0
-    count_pos_male = 0
-    count_pos_fem = 0
-    count_pos_unk = 0    
-    count_neg_male = 0
-    count_neg_fem = 0
-    count_neg_unk = 0
-    count_novload_fatal = 0  
-    count_novload_nonfatal = 0    
-    
-    for id in src_data:
-        data = src_data[id]
-        if data["group"] == "Epos":
-            count_pos = count_pos + 1
-            if data["sex"] == "Male":
-                count_pos_male = count_pos_male + 1
-            elif data["sex"] == "Female":
-                count_pos_fem = count_pos_fem + 1
-            else:
-                count_pos_unk = count_pos_unk + 1
-            if data["outcome"]:                
-                count_known_out = count_known_out + 1
-                if data["case"]: count_case = count_case + 1            
-                if data["pico"]: count_pos_pico = count_pos_pico + 1            
-                series = data["qpcr"]
-                vload = False
-                for qpcr in series:
-                    if qpcr[2]: vload = True
-                if vload:
-                    count_vload = count_vload + 1
-                else:
-                    if data["outcome"] == "Died":
-                        count_novload_fatal = count_novload_fatal + 1
-                    elif data["outcome"] == "Discharged":
-                         count_novload_nonfatal = count_novload_nonfatal + 1                
-        else:
-            count_neg = count_neg + 1
-            if data["sex"] == "Male":
-                count_neg_male = count_neg_male + 1
-            elif data["sex"] == "Female":
-                count_neg_fem = count_neg_fem + 1
-            else:
-                count_neg_unk = count_neg_unk + 1             
-            if data["pico"]: count_neg_pico = count_neg_pico + 1           
-    
-    print("Cases evaluated for Ebola virus infection:", count_total) 
-    print("  Ebola virus disease cases:",count_pos)
-    print("    Ebola virus disease cases, female:",count_pos_fem )
-    print("    Ebola virus disease cases, male:",count_pos_male)
-    print("    Ebola virus disease cases, unknown gender:",count_pos_unk) 
-    print("    Ebola virus disease cases with known outcome:",count_known_out) 
-    print("      Cases with Ebola virus load (qPCR):",count_vload)
-    print("      Cases with clinical chart (signs/symptoms):",count_case) 
-    print("      Cases with metabolic panel:",count_pos_pico) 
-    print("      Cases with no Ebola virus load, fatal:",count_novload_fatal) 
-    print("      Cases with no Ebola virus load, non fatal:",count_novload_nonfatal) 
-    print("  Non Ebola cases disease illness patients:",count_neg) 
-    print("    Non Ebola cases disease illness patients, female:",count_neg_fem)
-    print("    Non Ebola cases disease illness patients, male:",count_neg_male) 
-    print("    Non Ebola cases disease illness patients, unknown gender:",count_neg_unk) 
-    print("    Non Ebola cases disease illness patients with metabolic panel:",count_neg_pico) 
+def new_patient(row):
+    return patientindex.Patient(row[10])
 
 """Returns a dictionary file, where each entry holds the metadata for a variable (short name,
 long name or alias, group and table it belongs to, and type (int, float, etc).
@@ -239,20 +194,6 @@ def load_pico_info(filename):
 
     return [pico_names, pico_info]
 
-"""Normalizes a patient id string by adding a slash between the character and numeric portions.
-
-:param id: original id to normalize
-"""
-def normalize_id(id):
-    res = re.search("\d", id)
-    if res:
-        pos = res.start()
-        new_id = id[:pos] + '-' + id[pos:]
-        return new_id
-    else:
-        print("  Warning: patient ID is malformed: " + id)
-        return id
-
 """Returns SNP data stored in the provided VCF file, in the form of the list of SNPs, and
 a binary indicator per each patient for whom there was viral sequencing data available.
 
@@ -261,43 +202,130 @@ a binary indicator per each patient for whom there was viral sequencing data ava
 def load_snp_data(filename):
     snp_vars = collections.OrderedDict()
     snp_data = {}
-    vcf_reader = vcf.Reader(open(filename, "r"))
-    for record in vcf_reader:
-        # Info per SNP: record.CHROM, record.POS
-        pos = str(record.POS)
+    import vcfstream
+    reader = vcfstream.Reader(filename, ["GT"], lambda s: patientindex.normalize_id(s.split("_")[2]))
+    for site in reader:
+        # Info per SNP: site.chrom, site.pos
+        pos = str(site.pos)
         name = "SNP" + pos
         alias = "SNP @" + pos
         snp_vars[name] = alias
         dict = {}
-        for s in record.samples:
-            id = normalize_id(s.sample.split("_")[2])
-            dict[id] = "1" if s.data.GT == "1" else "0"
+        for id, gt in zip(reader.ids, site.values[0]):
+            dict[id] = "1" if gt == "1" else "0"
         snp_data[name] = dict
     return [snp_vars, snp_data]
 
-"""Returns Allele Frequency data stored in the provided VCF file, in the form of the list 
-of SNPs, and the AF per each patient for whom such data available was available.
+"""Formats the frequencies of the alternate alleles of a site in the same way as the string
+representation of the list of floats that PyVCF used to return for an AF entry, so the 
+values in the dataset are unchanged. Missing frequencies are NaN, and entries where all of
+them are missing are formatted as "None".
+
+:param freqs: frequency of each alternate allele
+"""
+def format_af(freqs):
+    if all(math.isnan(x) for x in freqs): return "None"
+    return "[" + ", ".join("None" if math.isnan(x) else str(x) for x in freqs) + "]"
+
+"""Returns the effect classes of a site listed in the EFF field of the INFO column, e.g.
+["missense_variant"] for EFF=missense_variant(MODERATE|MISSENSE|...)
+
+:param info: INFO column of the site
+"""
+def af_effects(info):
+    effects = []
+    for field in info.split(";"):
+        if field.startswith("EFF="):
+            for effect in field[4:].split(","):
+                name = effect.split("(")[0]
+                if name and name not in effects: effects.append(name)
+    return effects
+
+"""Returns the Allele Frequency data stored in the provided VCF file, as a sparse matrix with
+a row per sequenced patient and a column per alternate allele of each site, where only the
+non-zero frequencies are stored. Each column is described by the chromosome and position of
+its site, the index of the allele, the number of alternate alleles and the effect classes 
+of the site. When a patient has more than one sample, the last one in the file is used.
 
 :param filename: vcf file containing AF data
-:param inc_snp: list of SNPs to include in the returned lists, empty list to include alls
+:param inc_snp: list of SNPs to include in the matrix, empty list to include all.
+                The requested SNPs are read directly using the position index of the file.
 """
 def load_af_data(filename, inc_snp = None):
+    import vcfstream
+    reader = vcfstream.Reader(filename, ["AF"], lambda s: patientindex.normalize_id(s.split("_")[2].split(".")[0]))
+    if inc_snp:
+        sites = reader.fetch(set(inc_snp))
+    else:
+        sites = reader
+    ids = list(collections.OrderedDict.fromkeys(reader.ids))
+    last = dict((id, j) for j, id in enumerate(reader.ids))
+    samples = [last[id] for id in ids]
+    columns = []
+    rows = array.array("i")
+    cols = array.array("i")
+    values = array.array("d")
+    for site in sites:
+        afs = site.values[0]
+        nalleles = max([len(afs[j].split(",")) for j in samples] or [1])
+        col = len(columns)
+        effects = af_effects(site.info)
+        for k in range(0, nalleles):
+            columns.append({"chrom": site.chrom, "pos": site.pos, "allele": k, "alleles": nalleles, "effects": effects})
+        for i, j in enumerate(samples):
+            af = afs[j]
+            if af == "0.0": continue
+            # A missing entry has all the frequencies of the site missing
+            freqs = ["."] * nalleles if not af or af == "." else af.split(",")
+            for k, x in enumerate(freqs):
+                value = float(x) if x != "." else float("nan")
+                if value != 0:
+                    rows.append(i)
+                    cols.append(col + k)
+                    values.append(value)
+    return miradata.SparseMatrix(ids, columns, rows, cols, values)
+
+"""Returns the positions of the sites in the AF matrix that are added to the dataset: the
+requested positions, the sites where the frequency reaches min_freq in some patient, and
+the sites with any of the requested effect classes
+
+:param matrix: sparse AF matrix
+:param positions: list of positions
+:param min_freq: minimum frequency, None to not select sites by frequency
+:param effects: list of effect classes (e.g. missense_variant)
+"""
+def select_af_sites(matrix, positions, min_freq, effects):
+    maxs = matrix.column_max() if min_freq is not None else None
+    selected = collections.OrderedDict()
+    for c, site in enumerate(matrix.sites):
+        pos = site["pos"]
+        if pos in positions or (maxs is not None and min_freq <= maxs[c]) or any(effect in effects for effect in site["effects"]):
+            selected[pos] = True
+    return list(selected)
+
+"""Returns the AF variables of the given sites, and the formatted AF per each sequenced 
+patient, in the same form as the rest of the sequencing data
+
+:param matrix: sparse AF matrix
+:param positions: positions of the sites
+"""
+def af_columns(matrix, positions):
     af_vars = collections.OrderedDict()
     af_data = {}
-    vcf_reader = vcf.Reader(open(filename, "r"))
-    for record in vcf_reader:
-        if inc_snp and not record.POS in inc_snp: continue
-        pos = str(record.POS)
+    positions = set(positions)
+    cols = [c for c, site in enumerate(matrix.sites) if site["pos"] in positions]
+    values = matrix.columns(cols)
+    for c in cols:
+        site = matrix.sites[c]
+        if site["allele"] != 0: continue
+        pos = str(site["pos"])
         name = "AF" + pos
-        alias = "Allele Frequency @" + pos
-        af_vars[name] = alias
+        af_vars[name] = "Allele Frequency @" + pos
         dict = {}
-        for s in record.samples:
-            id0 = s.sample.split("_")[2]
-            id = normalize_id(id0.split(".")[0])
-            dict[id] = str(s.data.AF)
+        for i, id in enumerate(matrix.ids):
+            dict[id] = format_af([values[c + k].get(i, 0.0) for k in range(0, site["alleles"])])
         af_data[name] = dict
-    return [af_vars, af_data]     
+    return [af_vars, af_data]
 
 """Returns the viral sequence clustering data for patients with SNP data available. This 
 information comprises cluster and subcluster the patient belongs to, as well as the 
@@ -319,14 +347,14 @@ def load_cluster_data(filename):
     reader = csv.reader(open(filename, "r"), dialect="excel-tab")
     next(reader)
     for row in reader:
-        id = normalize_id(row[0])
+        id = patientindex.normalize_id(row[0])
         cvalue = ""
         cmutat = ""
         svalue = ""
         smutat = ""            
         parts = row[2].split(".")
         cvalue = parts[0]
-        extra = parts[1]
+        extra = parts[1] if 1 < len(parts) else ""
         if 0 < len(extra):
             cmutat = extra[0]
             if 1 < len(extra):
@@ -341,308 +369,1191 @@ def load_cluster_data(filename):
 
     return [cl_vars, cl_data]
 
-"""Adds a new variable to include in the Mirador dataset.
+"""Returns the sum of a series of floats, adding them one after the other so the result does
+not depend on the summation algorithm of the Python version
 
-:param name: variable name
-:param title: variable title (long name or alias)
-:param type: variable type (int, float, date, category, string)
-:param gname: name of group containing the variable
-:param tname: name of table containing the variable
+:param values: series of floats
 """
-def add_variable(name, title, type, gname, tname):
-    variables.append(name)
-    var_titles[name] = title
-    var_types[name] = type
-    
-    if gname in var_groups: 
-        group = var_groups[gname]
-    else:
-        group = collections.OrderedDict()
-        var_groups[gname] = group
-    
-    if tname in group:
-        table = group[tname]
-    else:
-        table = []
-        group[tname] = table
-            
-    table.append(name)
-    
-"""Sets the range of values for a variable already added to the dataset.
-
-:param name: variable name
-:param ranges: range string
-"""    
-def set_var_ranges(name, ranges):
-    var_ranges[name] = ranges
-        
-"""Adds the demographics data to the Mirador dataset
+def sequential_sum(values):
+    return functools.reduce(operator.add, values)
+
+"""Returns the days from the first measurement to the peak viral load, the clearance slope 
+(change of the log viral load per day, by least squares from the peak to the last measurement) 
+and the average days between measurements of a series of qPCR measurements.
+
+:param loads: viral loads in log units
+:param days: days of the measurements, NaN when the date is unknown
 """
-def add_demo_data():
-    add_variable("GID", "Patient ID", "String", "Demographics", "Basic Information") 
-    set_var_ranges("GID", "label")
-    add_variable("DIAG", "Diagnosis", "category", "Demographics", "Basic Information") 
-    set_var_ranges("DIAG", "1:Positive;0:Negative")
-            
-    for col in demo_dict:
-        var = demo_dict[col]
-        add_variable(var["name"], var["alias"], var["type"], var["group"], var["table"]) 
-        if "ranges" in var:
-            set_var_ranges(var["name"], var["ranges"])
-
-    for id in src_data:
-        data = src_data[id]
-        diag = "1" if data["group"] == "Epos" else "0"
-        row = [id, diag]
-        for col in demo_dict:
-            var = demo_dict[col]
-            if data["demo"]:
-                val = data["demo"][col]
-            else:
-                val = ""
-            if "idict" in var: 
-                if val in var["idict"]:
-                    val = var["idict"][val]
-                else:
-                    val = ""
+def qpcr_kinetics(loads, days):
+    points = [(d, v) for d, v in zip(days, loads) if not math.isnan(d)]
+    if not points: return [None, None, None]
+    peak = max(range(0, len(points)), key=lambda k: points[k][1])
+    days_to_peak = int(points[peak][0] - points[0][0])
+    slope = None
+    tail = points[peak:]
+    if 1 < len(tail):
+        dmean = sum(p[0] for p in tail) / len(tail)
+        vmean = sum(p[1] for p in tail) / len(tail)
+        sxx = sum((p[0] - dmean) ** 2 for p in tail)
+        if 0 < sxx: slope = sum((p[0] - dmean) * (p[1] - vmean) for p in tail) / sxx
+    interval = (points[-1][0] - points[0][0]) / (len(points) - 1) if 1 < len(points) else None
+    return [days_to_peak, slope, interval]
+
+"""Inits the folder to store the Mirador dataset
 
+:param dir: folder path
+:param config: config.mira file copied into the folder
+""" 
+def init_dataset(dir, config="config.mira"):
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    if not os.path.isfile(dir + '/config.mira') or not filecmp.cmp(config, dir + '/config.mira', shallow=False):
+        shutil.copyfile(config, dir + '/config.mira')
 
-            row.append(val)
-        mira_data[id] = row        
+"""Removes the binary data file that Mirador generates from the csv data, when the data or 
+the dictionary were modified and it needs to be regenerated.
 
-"""Adds the case notification (clinical symptoms) data to the Mirador dataset
+:param filename: name of the binary data file
 """
-def add_case_data():
-    for col in case_dict:
-        var = case_dict[col]
-        add_variable(var["name"], var["alias"], var["type"], var["group"], var["table"]) 
-        if "ranges" in var:
-            set_var_ranges(var["name"], var["ranges"])
-
-    for id in src_data:
-        data = src_data[id]
-        row = mira_data[id]
-        for col in case_dict:
-            var = case_dict[col]
-            if data["case"]:
-                val = data["case"][col]
-            else:
-                val = ""
-            if "idict" in var: 
-                val = var["idict"][val]
-            row.append(val)     
+def remove_binary(filename):
+    if os.path.isfile(filename):
+        os.remove(filename)
+
+# Sheets of the master and Piccolo workbooks
+MASTER_SHEET = "Ebola_js1"
+PICO_SHEET = "FinalSummary1"
+
+# Tables in the folder of new rows to ingest
+DELTA_TABLES = ["master.csv", "demographics.csv", "case.csv", "piccolo.csv"]
+
+code_hashes = []
 
-"""Adds the Piccolo (metabolic panel) data to the Mirador dataset
+"""Returns the version of the code of the build, with the content hashes of the scripts. The
+hashes are computed the first time it is called, and reused by every Builder of the process.
 """
-def add_pico_data():
-    # Calculating the maximum length of a series of metabolic panels
-    max_len = 0
-    for id in src_data:
-        data = src_data[id]  
-        series = data["pico"]        
-        if series:
-            max_len = max(max_len, len(series))
-
-    # Total number of variables added to store metabolic panel data
-    count = max_len * (1 + len(pico_names))
-    for i in range(1, max_len + 1):
-        add_variable("DOPANEL_" + str(i), "Date of metabolic panel " + str(i), "date", "Laboratory", "Metabolic Panel Day " + str(i))
-        for name in pico_names:
-            info = pico_info[name]
-            add_variable(name + "_" + str(i), info["title"] + " day " + str(i), "float", "Laboratory", "Metabolic Panel Day " + str(i))
-    
-    for id in src_data:
-        data = src_data[id]
-        series = data["pico"]
-        row = mira_data[id]
-        if series:
-            count1 = len(series)
-            for pico in series:
-                row.append(pico[6])
-                for name in pico_names:
-                    col = pico_info[name]["column"]
-                    row.append(pico[col])
-            row.extend(["\\N"] * (count - count1 * (1 + len(pico_names)))) # Adding missing days
+def code_version():
+    if not code_hashes:
+        folder = os.path.dirname(os.path.abspath(__file__))
+        names = ["makemira", "miradata", "vcfstream", "buildcache", "patientindex", "xlsxstream", "miraassoc"]
+        code_hashes.extend(buildcache.file_hash(os.path.join(folder, name + ".py")) for name in names)
+    return "".join(code_hashes)
+
+"""Returns the default files of the sources, relative to the folder of the sources (see 
+Builder): either the Excel workbooks or the csv files converted from their sheets with in2csv,
+and the files of the sequencing data.
+
+:param xlsx: true to read the Excel workbooks
+"""
+def source_files(xlsx=True):
+    if xlsx:
+        files = {"master": "sources/xls/MasterDataListandEBOVResults.xlsx",
+                 "demo": "sources/xls/DemographicsFromSim_schieffelin.xlsx",
+                 "case": "sources/xls/CaseNotification_schieffelin.xlsx",
+                 "pico": "sources/xls/FinalPiccoloData_schieffelin.xlsx"}
+    else:
+        # Sheets converted with in2csv
+        files = {"master": "sources/csv/MasterDataListandEBOVResults.csv",
+                 "demo": "sources/csv/DemographicsFromSim_schieffelin.csv",
+                 "case": "sources/csv/CaseNotification_schieffelin.csv",
+                 "pico": "sources/csv/FinalPiccoloData_schieffelin-FinalSummary1.csv"}
+    files["snp"] = "sources/vcf/SNP-2014.vcf"
+    files["af"] = "sources/vcf/iSNV-all.vcf"
+    files["cluster"] = "sources/vcf/clusters.tsv"
+    return files
+
+"""Returns the keyword arguments of Builder given by the command line arguments of the script
+
+:param args: command line arguments
+"""
+def parse_options(args):
+    options = {}
+    for i in range(0, len(args)):
+        arg = args[i]
+        if arg == "-seq":
+            options["seq"] = True
+        elif arg == "-log":
+            options["log"] = True
+        elif arg == "-force":
+            options["force"] = True
+        elif arg == "-bin":
+            options["binary"] = True
+        elif arg == "-long":
+            options["long"] = True
+        elif arg == "-kinetics":
+            options["kinetics"] = True
+        elif arg == "-ranges":
+            options["ranges"] = True
+        elif arg == "-jobs":
+            options["jobs"] = int(args[i + 1])
+        elif arg == "-cachesize":
+            options["cache_size"] = float(args[i + 1])
+        elif arg == "-csv":
+            options["xlsx"] = False
+        elif arg == "-profile":
+            options["profile"] = args[i + 1]
+        elif arg == "-cprofile":
+            options["cprofile"] = args[i + 1]
+        elif arg == "-prune":
+            options["prune"] = True
+        elif arg == "-assoc":
+            options["assoc"] = True
+        elif arg == "-ingest":
+            options["ingest"] = args[i + 1]
+        elif arg == "-af":
+            options["af_sites"] = [int(pos) for pos in args[i + 1].split(",")]
+        elif arg == "-afmin":
+            options["af_min_freq"] = float(args[i + 1])
+        elif arg == "-afeff":
+            options["af_effects"] = args[i + 1].split(",")
+    return options
+
+"""Builder of the Mirador dataset. The sources, options and output folder of the dataset are
+given explicitly, and all the data of a build is held by the builder, so several variants of
+the dataset can be built one after the other in the same process, e.g.:
+
+makemira.Builder("variants/seq", seq=True, log=True).build()
+
+Each option has the same effect as the argument of the script with the same name (see 
+parse_options and README.md).
+
+:param output: folder of the Mirador dataset, the mirador folder inside root if not provided
+:param root: folder with the sources, dictionaries, idignore, config.mira and the .cache folder
+:param sources: files of some of the sources (see source_files), relative to root
+:param seq: true to aggregate the sequencing data
+:param log: true to convert the viral loads into log units
+:param binary: true to save the binary data file
+:param long: true to save the series in long format
+:param kinetics: true to add the viral load kinetics
+:param ranges: true to flag the metabolic panel values with the reference ranges
+:param prune: true to remove the columns over the missing threshold
+:param assoc: true to compute the associations between all the pairs of variables
+:param af_sites: positions of the AF sites to add, [10218] if no sites are selected
+:param af_min_freq: minimum frequency of the AF sites to add
+:param af_effects: effect classes of the AF sites to add
+:param jobs: number of processes used to parse the sources and compute the associations
+:param xlsx: true to read the Excel workbooks, false to read the csv files
+:param force: true to build the dataset even if it is up to date
+:param ingest: folder with new rows to add to the dataset
+:param cache_size: size limit of the parsed-result cache in MB
+:param profile: name of the JSON profile report
+:param cprofile: folder of the cProfile dumps
+"""
+class Builder(object):
+    def __init__(self, output=None, root=".", sources=None, seq=False, log=False, binary=False, long=False, 
+                 kinetics=False, ranges=False, prune=False, assoc=False, af_sites=None, af_min_freq=None, 
+                 af_effects=None, jobs=1, xlsx=True, force=False, ingest=None, cache_size=buildcache.CACHE_SIZE, 
+                 profile=None, cprofile=None):
+        if ingest and (long or binary or prune or assoc):
+            # These outputs depend on all the rows of the dataset
+            raise ValueError("The -long, -bin, -prune and -assoc options cannot be used with -ingest")
+        self.aggregate_seq_data = seq
+        self.convert_qpcr_log = log
+        self.save_binary_data = binary
+        self.long_format = long
+        self.qpcr_kinetics_data = kinetics
+        self.pico_range_flags = ranges
+        self.prune_missing = prune
+        self.compute_assoc = assoc
+        self.af_effect_classes = af_effects or []
+        self.af_min_freq = af_min_freq
+        if af_sites is None:
+            # Only the SNP 10218 is added when no other sites are selected
+            af_sites = [10218] if af_min_freq is None and not self.af_effect_classes else []
+        self.af_sites = af_sites
+        self.num_jobs = jobs
+        self.force_build = force
+        self.ingest_folder = ingest
+        self.profile_report = profile
+        self.profile_dumps = cprofile
+
+        files = source_files(xlsx)
+        files.update(sources or {})
+        path = lambda name: os.path.normpath(os.path.join(root, name))
+        self.files = dict((key, path(files[key])) for key in files)
+        self.config_file = path("config.mira")
+        self.ignore_file = path("idignore")
+        self.demo_dict_file = path("demo-dict.csv")
+        self.case_dict_file = path("case-dict.csv")
+        self.pico_info_file = path("piccolo-expected.csv")
+        self.mirador_folder = os.path.normpath(output) if output else path("mirador")
+
+        # The build is skipped when the inputs (including the code of the scripts), options and 
+        # outputs are the same as in the last build recorded in the manifest
+        version = code_version()
+        self.input_files = [self.config_file, self.ignore_file, self.files["master"], self.files["demo"], self.files["case"], self.files["pico"],
+                            self.demo_dict_file, self.case_dict_file, self.pico_info_file]
+        if seq:
+            self.input_files.extend([self.files["snp"], self.files["af"], self.files["cluster"]])
+        flags = [["-seq", seq], ["-log", log], ["-bin", binary], ["-long", long], ["-kinetics", kinetics], ["-ranges", ranges], ["-prune", prune], ["-assoc", assoc]]
+        self.build_options = [arg for [arg, value] in flags if value] + [version]
+        if seq:
+            self.build_options.extend(["-af", ",".join(map(str, self.af_sites)), "-afmin", str(af_min_freq), "-afeff", ",".join(self.af_effect_classes)])
+        dir = self.mirador_folder
+        self.binary_file = dir + "/" + miradata.read_config(self.config_file)["data.binary"]
+        self.columns_file = dir + "/" + miradata.BINARY_NAME
+        self.af_matrix_file = dir + "/af-matrix.bin"
+        self.assoc_file = dir + "/assoc.bin"
+        self.state_file = dir + "/patients.store"
+        self.long_files = [dir + "/qpcr.csv", dir + "/panels.csv"]
+        self.output_files = [dir + "/" + fn for fn in ["config.mira", "data.csv", miradata.INDEX_NAME, "dictionary.csv", "groups.xml", "missing.csv"]]
+        self.output_files.append(self.state_file)
+        if binary:
+            self.output_files.append(self.columns_file)
+        if seq:
+            self.output_files.append(self.af_matrix_file)
+        if assoc:
+            self.output_files.append(self.assoc_file)
+        if long:
+            self.output_files.extend(self.long_files)
+        self.cache = buildcache.ResultCache(path(".cache"), version, cache_size)
+        self.profiler = None
+        self.clear()
+
+    """Releases the data of the last build
+    """
+    def clear(self):
+        self.index = None
+        self.src_data = None
+        self.mira_data = None
+        self.variables = []
+        self.var_titles = {}
+        self.var_types = {}
+        self.var_ranges = {}
+        self.var_groups = collections.OrderedDict()
+        self.demo_dict = None
+        self.case_dict = None
+        self.pico_names = None
+        self.pico_info = None
+        self.snp_vars = self.snp_data = None
+        self.af_matrix = None
+        self.af_vars = self.af_data = None
+        self.cl_vars = self.cl_data = None
+        self.ingest_ids = None
+        patientindex.normalize_id.cache_clear()
+        # Longest series of qPCR results and metabolic panels of all the patients in the dataset
+        self.series_lengths = {"qpcr": 0, "panels": 0}
+
+    """Builds the dataset, unless it is up to date. Returns true if the dataset was built, or
+    the new rows were ingested.
+    """
+    def build(self):
+        self.clear()
+        self.profiler = miraprof.Profiler(self.profile_report, self.profile_dumps)
+        manifest = buildcache.Manifest(self.mirador_folder + "/manifest.json", self.cache.hash)
+        ingested = manifest.data.get("ingested", [])
+        with self.profiler.stage("check_manifest", len(self.input_files)):
+            up_to_date = not self.force_build and manifest.up_to_date(self.input_files, self.build_options, self.ingest_folder is not None)
+        if self.ingest_folder:
+            if not up_to_date:
+                # The new rows are merged into the patient store saved by the last build, which 
+                # needs to have the same sources and options
+                raise ValueError("The dataset needs to be built with the same sources and options before ingesting new rows")
+            delta = delta_hash(self.ingest_folder)
+            if delta in ingested:
+                raise ValueError("The new rows in " + self.ingest_folder + " were already ingested")
+            ingested = ingested + [delta]
+        elif up_to_date:
+            print("Dataset is up to date.")
+            self.cache.save()
+            self.profiler.save()
+            return False
+        elif ingested:
+            print("  Warning: the dataset is built again from the sources, without the rows ingested since the last build")
+            ingested = []
+        self.load()
+        self.aggregate()
+        self.save()
+        manifest.save(self.input_files, self.build_options, self.output_files, ingested)
+        self.cache.save()
+        self.profiler.save()
+        # The data is released, only the outputs are kept
+        self.clear()
+        return True
+
+    """Loads the sources into the patient index. When ingesting, the index only has the new rows
+    and the records of their patients saved by the last build.
+    """
+    def load(self):
+        print("Loading data...")
+        tasks = [[load_ignore, self.ignore_file, []],
+                 [load_dict, self.demo_dict_file, []],
+                 [load_dict, self.case_dict_file, []],
+                 [load_pico_info, self.pico_info_file, []]]
+        if self.aggregate_seq_data:
+            # SNP data, Allele Frequency data (all the sites), and cluster data
+            tasks.extend([[load_snp_data, self.files["snp"], []],
+                          [load_af_data, self.files["af"], []],
+                          [load_cluster_data, self.files["cluster"], []]])
+        # The master table goes first, since it creates the patient records
+        tables = [[self.load_master, "master table", [read_table, self.files["master"], [MASTER_SHEET]]],
+                  [self.load_demo, "demographics table", [read_table, self.files["demo"], []]],
+                  [self.load_case, "case notification table", [read_table, self.files["case"], []]],
+                  [self.load_pico_data, "metabolic panel table", [read_table, self.files["pico"], [PICO_SHEET]]]]
+        if self.ingest_folder:
+            # Only the new rows are read
+            results = self.parse_sources(tasks, self.num_jobs)
+        elif 1 < self.num_jobs:
+            # All the tables are parsed concurrently, so they are in memory at the same time
+            results = self.parse_sources(tasks + [table[2] for table in tables], self.num_jobs)
+            table_rows = results[len(tasks):]
         else:
-            row.extend(["\\N"] * count)
-
-"""Adds the viral load (qPCR) data to the Mirador dataset
-"""            
-def add_qpcr_data():
-    # Calculating the maximum length of a series of qPCR samples
-    max_len = 0
-    for id in src_data:
-        data = src_data[id]  
-        series = data["qpcr"]        
-        if series:
-            max_len = max(max_len, len(series))
-
-    count = 4 + max_len * 2
-    log_str = " (log units)" if convert_qpcr_log else ""
-    add_variable("PCR", "First measured viral load" + log_str, "float", "Laboratory", "Viral Load (qPCR) summary")
-    add_variable("PCR_MAX", "Maximum measured viral load" + log_str, "float", "Laboratory", "Viral Load (qPCR) summary")
-    add_variable("PCR_MIN", "Minimum measured viral load" + log_str, "float", "Laboratory", "Viral Load (qPCR) summary")
-    add_variable("PCR_AVE", "Averaged viral load" + log_str, "float", "Laboratory", "Viral Load (qPCR) summary")
-    for i in range(1, max_len + 1):
-        add_variable("DOPCR_" + str(i), "Date of qPCR " + str(i), "date", "Laboratory", "Viral Load (qPCR) day " + str(i))
-        add_variable("PCR_" + str(i), "EBOV copies/mL plasma" + log_str + " day " + str(i), "float", "Laboratory", "Viral Load (qPCR) day " + str(i)) 
-        
-    for id in src_data:
-        data = src_data[id]
-        series = data["qpcr"]
-        row = mira_data[id]
-        if series:
-            count1 = len(series)
-            first_qpcr = None
-            max_qpcr = None
-            min_qpcr = None
-            ave_qpcr = None
-            slen = 0
-            for qpcr in series:
-                value = qpcr[2]
-                if value:
-                    if convert_qpcr_log: fval = math.log10(1 + float(value))
-                    else: fval = float(value)
-                    if first_qpcr: 
-                        max_qpcr = max(max_qpcr, fval)
-                        min_qpcr = min(min_qpcr, fval)                        
-                        ave_qpcr = ave_qpcr + fval
-                    else: 
-                        first_qpcr = fval
-                        max_qpcr = fval
-                        min_qpcr = fval 
-                        ave_qpcr = fval
-                    slen = slen + 1
-                    qpcr[2] = str(fval)
-
-            if first_qpcr: 
-                row.extend([str(first_qpcr), str(max_qpcr), str(min_qpcr), str(ave_qpcr / slen)])
-            else: 
-                row.extend(["\\N"] * 4)
-                
-            for qpcr in series:
-                date = qpcr[1]
-                value = qpcr[2]
-                row.extend([date, value])
-                
-            row.extend(["\\N"] * (count - 4 - count1 * 2))                
+            # Each table is parsed right before it is merged, so only one is in memory at a time
+            results = self.parse_sources(tasks, self.num_jobs)
+            table_rows = [None] * len(tables)
+
+        self.demo_dict = results[1]
+        self.case_dict = results[2]
+        [self.pico_names, self.pico_info] = results[3]
+        self.index = patientindex.PatientIndex(results[0])
+        self.src_data = self.index.records
+        store = ()
+        if self.ingest_folder:
+            # The new qPCR results and panels are added at the end of the series, and the new rows
+            # of the demographics and case notification tables replace the ones of the patient
+            deltas = [[self.load_master, "master table", read_delta(self.ingest_folder, "master.csv"), 1],
+                      [self.load_demo, "demographics table", read_delta(self.ingest_folder, "demographics.csv"), 1],
+                      [self.load_case, "case notification table", read_delta(self.ingest_folder, "case.csv"), 0],
+                      [self.load_pico_data, "metabolic panel table", read_delta(self.ingest_folder, "piccolo.csv"), 3]]
+            deltas = [delta for delta in deltas if delta[2] is not None]
+            ingest_ids = set(row[key] for [load, title, rows, key] in deltas for row in rows[1:])
+            # Only the records of the patients in the new rows are read from the store
+            store = patientindex.PatientStore(self.state_file)
+            with self.profiler.stage("load_state", len(ingest_ids)) as stage:
+                self.index.preload(store, sorted(ingest_ids))
+                stage.rows_out = len(self.src_data)
+            self.series_lengths = dict(store.info)
+            old_count = len(self.src_data)
+            for [load, title, rows, key] in deltas:
+                print("  new rows of the " + title + "...")
+                with self.profiler.stage(load.__name__, len(rows)) as stage:
+                    load(rows)
+                    stage.rows_out = len(self.src_data)
+            # Patients already in the dataset go first, then the new ones in the order of the index 
+            new_ids = list(itertools.islice(reversed(self.src_data), len(self.src_data) - old_count))[::-1]
+            self.ingest_ids = [id for id in ingest_ids if id in self.src_data and not id in set(new_ids)] + new_ids
+            tables = []
+        # The tables are released once merged, the index only keeps the values it needs
+        for k in range(0, len(tables)):
+            [load, title, task] = tables[k]
+            rows = table_rows[k] or self.parse_sources([task], 1)[0]
+            table_rows[k] = None
+            print("  " + title + "...")
+            with self.profiler.stage(load.__name__, len(rows)) as stage:
+                load(rows)
+                stage.rows_out = len(self.src_data)
+            rows = None
+        if self.aggregate_seq_data:
+            print("  sequencing data...")
+            [self.snp_vars, self.snp_data] = results[4]
+            self.af_matrix = results[5]
+            [self.af_vars, self.af_data] = af_columns(self.af_matrix, select_af_sites(self.af_matrix, self.af_sites, self.af_min_freq, self.af_effect_classes))
+            [self.cl_vars, self.cl_data] = results[6]
+            # The sequencing data is already keyed by GID, with the same samples at every site
+            self.index.check("SNP data", next(iter(self.snp_data.values()), {}), store)
+            self.index.check("AF data", self.af_matrix.ids, store)
+            self.index.check("cluster data", self.cl_data["CLUST"], store)
+        if store: store.close()
+        print("Done.")
+        if self.ingest_folder:
+            # Only the patients in the new rows are counted
+            self.index.print_report("Patients with new rows")
         else:
-            row.extend(["\\N"] * count)
+            self.index.print_report()
+        self.print_summary()
 
-"""Adds the sequencing data (SNPs, AF, clustering) to the Mirador dataset
-""" 
-def add_seq_data():
-    for var in snp_vars:
-        add_variable(var, snp_vars[var], "category", "Sequencing", "Viral SNPs")
-        set_var_ranges(var, "1:Yes;0:No")
-    for var in af_vars:
-        add_variable(var, af_vars[var], "float", "Sequencing", "Allele Frequencies")
-    add_variable("CLUST", cl_vars["CLUST"], "category", "Sequencing", "Clustering")
-    set_var_ranges("CLUST", "1:Cluster 1;2:Cluster 2;3:Cluster 3")
-    add_variable("MCLUST", cl_vars["MCLUST"], "int", "Sequencing", "Clustering")    
-    add_variable("SCLUST", cl_vars["SCLUST"], "category", "Sequencing", "Clustering")
-    set_var_ranges("SCLUST", "1:Sub-cluster a;2:Sub-cluster b;3:Sub-cluster c")
-    add_variable("MSCLUST", cl_vars["MSCLUST"], "int", "Sequencing", "Clustering")
-
-    for var in snp_vars:
-        for id in mira_data:
-            row = mira_data[id]
-            if id in snp_data[var]:
-                row.append(snp_data[var][id])
-            else:
-                row.append("")
+    """Aggregates the patients into the columns of the Mirador dataset
+    """
+    def aggregate(self):
+        print("Aggregating data...")
+        # When ingesting, only the patients with new rows are aggregated
+        self.mira_data = miradata.Dataset(self.ingest_ids if self.ingest_folder else self.src_data)
+        aggregators = [self.add_demo_data, self.add_case_data, self.add_pico_data, self.add_qpcr_data]
+        if self.aggregate_seq_data:
+            aggregators.append(self.add_seq_data)
+        for func in aggregators:
+            with self.profiler.stage(func.__name__, len(self.src_data)) as stage:
+                func()
+                stage.rows_out = len(self.mira_data)
+        print("Done.")
 
-    for var in af_vars:
-        for id in mira_data:
-            row = mira_data[id]
-            if id in af_data[var]:
-                row.append(af_data[var][id])
+    """Saves the Mirador dataset, and the patient store for ingesting new rows later
+    """
+    def save(self):
+        dir = self.mirador_folder
+        init_dataset(dir, self.config_file)
+        if self.ingest_folder:
+            with self.profiler.stage("save_ingest", len(self.mira_data), [dir + "/data.csv", dir + "/" + miradata.INDEX_NAME, dir + "/missing.csv"]) as stage:
+                stage.rows_out = self.save_ingest(dir)
+            data_changed = 0 < len(self.mira_data)
+        else:
+            with self.profiler.stage("save_missing", len(self.variables), [dir + "/missing.csv"]) as stage:
+                over_threshold = self.save_missing(dir + "/missing.csv")
+                # The columns that Mirador would leave out are removed before saving the dataset
+                if self.prune_missing: self.remove_variables(over_threshold)
+                stage.rows_out = len(self.variables)
+            with self.profiler.stage("save_data", len(self.mira_data), [dir + "/data.csv", dir + "/" + miradata.INDEX_NAME]) as stage:
+                data_changed = self.save_data(dir + "/data.csv")
+                stage.rows_out = len(self.mira_data)
+        with self.profiler.stage("save_dict", len(self.variables), [dir + "/dictionary.csv"]) as stage:
+            dict_changed = self.save_dict(dir + "/dictionary.csv")
+            stage.rows_out = len(self.variables)
+        with self.profiler.stage("save_groups", len(self.var_groups), [dir + "/groups.xml"]) as stage:
+            self.save_groups(dir + "/groups.xml")
+            stage.rows_out = len(self.var_groups)
+        if self.long_format:
+            with self.profiler.stage("save_long_data", len(self.mira_data), self.long_files):
+                self.save_long_data(dir)
+        else:
+            # The long-format tables of an earlier build with -long do not match the new data
+            for filename in self.long_files:
+                if os.path.isfile(filename): os.remove(filename)
+        if self.save_binary_data:
+            with self.profiler.stage("save_binary", len(self.mira_data), [self.columns_file]) as stage:
+                self.save_binary(self.columns_file)
+                stage.rows_out = len(self.mira_data)
+        # The binary file of Mirador is generated again from the new data
+        if data_changed or dict_changed:
+            remove_binary(self.binary_file)
+        if self.aggregate_seq_data:
+            with self.profiler.stage("save_af_matrix", len(self.af_matrix), [self.af_matrix_file]) as stage:
+                self.save_af_matrix(self.af_matrix_file)
+                stage.rows_out = len(self.af_matrix)
+        if self.compute_assoc:
+            with self.profiler.stage("save_assoc", len(self.variables), [self.assoc_file]) as stage:
+                stage.rows_out = self.save_assoc(self.assoc_file)
+        with self.profiler.stage("save_state", len(self.src_data), [self.state_file]):
+            if self.ingest_folder:
+                self.index.update(self.state_file, self.ingest_ids, self.series_lengths)
             else:
-                row.append("")
+                self.index.save(self.state_file, self.series_lengths)
 
-    for var in cl_vars:
-        for id in mira_data:
-            row = mira_data[id]
-            if id in cl_data[var]:
-                row.append(cl_data[var][id])
-            else:
-                row.append("")            
+    """Adds the entries of the master table to the patient index. Patients in the ignore list, 
+    and rows without a group, are left out.
 
-"""Inits the folder to store the Mirador dataset
+    :param rows: rows of the csv file containing the master table
+    """
+    def load_master(self, rows):
+        nan = float("nan")
+        pool = self.index.pool
+        def merge(data, row):
+            data.qpcr_dates.append(pool.code(row[5]))
+            data.qpcr_loads.append(float(row[8]) if row[8] else nan)
+        self.index.join("master", rows[1:], 1, merge, create=new_patient, accept=lambda row: row[10], unique=False)
 
-:param dir: folder path
-""" 
-def init_dataset(dir):
-    if not os.path.exists(dir):
-        os.makedirs(dir)
-    if os.path.isfile(dir + "/data.bin"):
-        os.remove(dir + "/data.bin")
-    shutil.copyfile('config.mira', dir + '/config.mira')
+    """Adds the entries of the demographics table to the patient index, keeping only the columns
+    in the demographics dictionary
 
-"""Saves the Mirador dataset into a csv file
+    :param rows: rows of the csv file containing the demographics table
+    """
+    def load_demo(self, rows):
+        columns = list(self.demo_dict.keys())
+        def merge(data, row):
+            data.outcome = sys.intern(row[7])
+            data.sex = sys.intern(row[3])
+            data.demo = patientindex.select_columns(row, columns)
+        self.index.join("demographics", rows[1:], 1, merge)
 
-:param filename: name of csv file
-""" 
-def save_data(filename):
-    print("Saving data...")
-    writer = csv.writer(open(filename, "w"), dialect="excel")
-    writer.writerow(variables)
-    for id in mira_data:
-        row = mira_data[id]
-        for i in range(0, len(row)):
-            row[i] = str(row[i])
-            if not row[i]: row[i] = "\\N"        
-        writer.writerow(row)
-    print("Done.")
-    
-"""Saves the dictionary for the Mirador dataset into a csv file
+    """Adds the entries of the case notification (clinical symptoms) table to the patient index,
+    keeping only the columns in the case notification dictionary
 
-:param filename: name of csv dictionary
-""" 
-def save_dict(filename):    
-    print("Saving dictionary...") 
-    writer = csv.writer(open(filename, "w"), dialect="excel")
-    for var in variables:
-        if var in var_ranges and var_ranges[var]:
-            writer.writerow([var_titles[var], var_types[var], var_ranges[var]])
+    :param rows: rows of the csv file containing the case notification table
+    """
+    def load_case(self, rows):
+        columns = list(self.case_dict.keys())
+        def merge(data, row):
+            data.case = patientindex.select_columns(row, columns)
+        self.index.join("case notification", rows[1:], 0, merge)
+
+    """Adds the entries of the Piccolo (metabolic panel) table to the patient index, keeping only
+    the date and the columns of the analytes in pico_names (see pico_columns)
+
+    :param rows: rows of the csv file containing the Piccolo table
+    """
+    def load_pico_data(self, rows): 
+        columns = self.pico_columns()
+        pool = self.index.pool
+        def merge(data, row):
+            if data.pico is None: data.pico = array.array("i")
+            data.pico.extend([pool.code(row[col]) for col in columns])
+        self.index.join("metabolic panel", rows[1:], 3, merge, unique=False)
+
+    """Returns the columns of the Piccolo table kept for each panel: the date of the panel 
+    followed by the analytes in the same order as pico_names
+    """
+    def pico_columns(self):
+        return [6] + [self.pico_info[name]["column"] for name in self.pico_names]
+
+    """Returns the number of metabolic panels of a patient
+
+    :param data: patient record
+    """
+    def pico_count(self, data):
+        if data.pico is None: return 0
+        return len(data.pico) // (len(self.pico_names) + 1)
+
+    """Returns a value of the i-th metabolic panel of a patient, the date of the panel when k is
+    None, otherwise the value of the k-th analyte
+
+    :param data: patient record
+    :param i: index of the panel
+    :param k: index of the analyte
+    """
+    def pico_value(self, data, i, k=None):
+        j = i * (len(self.pico_names) + 1)
+        if k is not None: j += k + 1
+        return self.index.pool.string(data.pico[j])
+
+    """Parses the source files, returns the list of results in the same order as the tasks. The
+    sources are independent of each other, so when more than one job is requested they are 
+    parsed concurrently in a pool of processes, each one returning its own result. The results
+    are then merged into src_data by the load_* functions.
+
+    :param tasks: list of [function, filename, extra arguments] to parse each source
+    :param jobs: number of processes
+    """
+    def parse_sources(self, tasks, jobs):
+        if 1 < jobs and "fork" in multiprocessing.get_all_start_methods():
+            # Forked workers already have this script loaded, so they do not need to import it
+            context = multiprocessing.get_context("fork")
+            # The sources are hashed before forking, since the hashes computed by the workers
+            # would be lost when they exit, and the workers inherit them from this process
+            for [func, filename, args] in tasks:
+                self.cache.hash(filename)
+            with concurrent.futures.ProcessPoolExecutor(min(jobs, len(tasks)), mp_context=context) as pool:
+                futures = [pool.submit(self.cache.call, func, filename, *args) for [func, filename, args] in tasks]
+                return [future.result() for future in futures]
+        if 1 < jobs:
+            print("  Warning: parallel loading is not supported in this platform")
+        results = []
+        for [func, filename, args] in tasks:
+            with self.profiler.stage(func.__name__ + ":" + os.path.basename(filename)) as stage:
+                result = self.cache.call(func, filename, *args)
+                stage.rows_out = len(result)
+            results.append(result)
+        return results
+
+    """Prints some summary counts for debugging, only of the patients with new rows when 
+    ingesting
+    """
+    def print_summary(self):
+        count_total = len(self.src_data)
+        count_pos = 0
+        count_neg = 0
+        count_case = 0
+        count_pos_pico = 0
+        count_neg_pico = 0
+        count_known_out = 0
+        count_vload = 0
+        count_pos_male = 0
+        count_pos_fem = 0
+        count_pos_unk = 0    
+        count_neg_male = 0
+        count_neg_fem = 0
+        count_neg_unk = 0
+        count_novload_fatal = 0  
+        count_novload_nonfatal = 0    
+
+        for id in self.src_data:
+            data = self.src_data[id]
+            if data.group == "Epos":
+                count_pos = count_pos + 1
+                if data.sex == "Male":
+                    count_pos_male = count_pos_male + 1
+                elif data.sex == "Female":
+                    count_pos_fem = count_pos_fem + 1
+                else:
+                    count_pos_unk = count_pos_unk + 1
+                if data.outcome:                
+                    count_known_out = count_known_out + 1
+                    if data.case: count_case = count_case + 1            
+                    if data.pico: count_pos_pico = count_pos_pico + 1            
+                    vload = False
+                    for load in data.qpcr_loads:
+                        if not math.isnan(load): vload = True
+                    if vload:
+                        count_vload = count_vload + 1
+                    else:
+                        if data.outcome == "Died":
+                            count_novload_fatal = count_novload_fatal + 1
+                        elif data.outcome == "Discharged":
+                             count_novload_nonfatal = count_novload_nonfatal + 1                
+            else:
+                count_neg = count_neg + 1
+                if data.sex == "Male":
+                    count_neg_male = count_neg_male + 1
+                elif data.sex == "Female":
+                    count_neg_fem = count_neg_fem + 1
+                else:
+                    count_neg_unk = count_neg_unk + 1             
+                if data.pico: count_neg_pico = count_neg_pico + 1           
+
+        print("Cases evaluated for Ebola virus infection:", count_total) 
+        print("  Ebola virus disease cases:",count_pos)
+        print("    Ebola virus disease cases, female:",count_pos_fem )
+        print("    Ebola virus disease cases, male:",count_pos_male)
+        print("    Ebola virus disease cases, unknown gender:",count_pos_unk) 
+        print("    Ebola virus disease cases with known outcome:",count_known_out) 
+        print("      Cases with Ebola virus load (qPCR):",count_vload)
+        print("      Cases with clinical chart (signs/symptoms):",count_case) 
+        print("      Cases with metabolic panel:",count_pos_pico) 
+        print("      Cases with no Ebola virus load, fatal:",count_novload_fatal) 
+        print("      Cases with no Ebola virus load, non fatal:",count_novload_nonfatal) 
+        print("  Non Ebola cases disease illness patients:",count_neg) 
+        print("    Non Ebola cases disease illness patients, female:",count_neg_fem)
+        print("    Non Ebola cases disease illness patients, male:",count_neg_male) 
+        print("    Non Ebola cases disease illness patients, unknown gender:",count_neg_unk) 
+        print("    Non Ebola cases disease illness patients with metabolic panel:",count_neg_pico) 
+
+    """Adds a new variable to include in the Mirador dataset.
+
+    :param name: variable name
+    :param title: variable title (long name or alias)
+    :param type: variable type (int, float, date, category, string)
+    :param gname: name of group containing the variable
+    :param tname: name of table containing the variable
+    """
+    def add_variable(self, name, title, type, gname, tname):
+        self.variables.append(name)
+        self.var_titles[name] = title
+        self.var_types[name] = type
+
+        if gname in self.var_groups: 
+            group = self.var_groups[gname]
         else:
-            writer.writerow([var_titles[var], var_types[var]])
-    print("Done.") 
-        
-"""Saves the group/tables hierarchy for the Mirador dataset into an xml file
+            group = collections.OrderedDict()
+            self.var_groups[gname] = group
 
-:param filename: name of xml file
-"""
-def save_groups(filename):
-    print("Saving groups...")
-    # Writing file in utf-8 because the input html files from
-    # NHANES website sometimes have characters output the ASCII range.
-    xml_file = codecs.open(filename, 'w', 'utf-8')
-    xml_strings = []
-    write_xml_line('<?xml version="1.0"?>', xml_file, xml_strings)
-    write_xml_line('<data>', xml_file, xml_strings)
-    for gname in var_groups:
-        if gname in ["State", "Weighting", "Land and Cell Raking"]: continue            
-        write_xml_line(' <group name="' + gname + '">', xml_file, xml_strings)
-        group = var_groups[gname]
-        for tname in group:
-            write_xml_line('  <table name="' + tname + '">', xml_file, xml_strings)
+        if tname in group:
             table = group[tname]
-            for var in table:
-                write_xml_line('   <variable name="' + var + '"/>', xml_file, xml_strings)
-            write_xml_line('  </table>', xml_file, xml_strings)
-        write_xml_line(' </group>', xml_file, xml_strings)
-    write_xml_line('</data>', xml_file, xml_strings)
-    xml_file.close()
-
-    # XML validation.
-    try:
-        doc = xml.dom.minidom.parseString(''.join(xml_strings))
-        doc.toxml()
+        else:
+            table = []
+            group[tname] = table
+
+        table.append(name)
+
+    """Sets the range of values for a variable already added to the dataset.
+
+    :param name: variable name
+    :param ranges: range string
+    """    
+    def set_var_ranges(self, name, ranges):
+        self.var_ranges[name] = ranges
+
+    """Adds the values of a variable already added to the dataset, as a new column in the 
+    columnar store.
+
+    :param name: variable name
+    :param values: list of values, one per patient in the same order as mira_data.ids
+    """
+    def add_column(self, name, values):
+        self.mira_data.add_column(name, self.var_types[name], values)
+
+    """Adds the demographics data to the Mirador dataset
+    """
+    def add_demo_data(self):
+        self.add_variable("GID", "Patient ID", "String", "Demographics", "Basic Information") 
+        self.set_var_ranges("GID", "label")
+        self.add_variable("DIAG", "Diagnosis", "category", "Demographics", "Basic Information") 
+        self.set_var_ranges("DIAG", "1:Positive;0:Negative")
+
+        for col in self.demo_dict:
+            var = self.demo_dict[col]
+            self.add_variable(var["name"], var["alias"], var["type"], var["group"], var["table"]) 
+            if "ranges" in var:
+                self.set_var_ranges(var["name"], var["ranges"])
+
+        ids = self.mira_data.ids
+        self.add_column("GID", ids)
+        self.add_column("DIAG", ["1" if self.src_data[id].group == "Epos" else "0" for id in ids])
+        for k, col in enumerate(self.demo_dict):
+            var = self.demo_dict[col]
+            values = []
+            for id in ids:
+                demo = self.src_data[id].demo
+                if demo:
+                    val = demo[k]
+                else:
+                    val = ""
+                if "idict" in var: 
+                    if val in var["idict"]:
+                        val = var["idict"][val]
+                    else:
+                        val = ""
+                values.append(val)
+            self.add_column(var["name"], values)
+
+    """Adds the case notification (clinical symptoms) data to the Mirador dataset
+    """
+    def add_case_data(self):
+        for col in self.case_dict:
+            var = self.case_dict[col]
+            self.add_variable(var["name"], var["alias"], var["type"], var["group"], var["table"]) 
+            if "ranges" in var:
+                self.set_var_ranges(var["name"], var["ranges"])
+
+        ids = self.mira_data.ids
+        for k, col in enumerate(self.case_dict):
+            var = self.case_dict[col]
+            values = []
+            for id in ids:
+                case = self.src_data[id].case
+                if case:
+                    val = case[k]
+                else:
+                    val = ""
+                if "idict" in var: 
+                    val = var["idict"][val]
+                values.append(val)
+            self.add_column(var["name"], values)
+
+    """Flags the values of the metabolic panels of all the patients with respect to the reference 
+    range of each analyte for the sex of the patient. The panels are stored as the rows of a
+    single numeric matrix (one column per analyte) together with the limits that apply to each
+    value, so all the values are flagged in a single pass. The flags of each patient are stored 
+    in src_data, one row of len(pico_names) flags per panel.
+    """
+    def flag_pico_data(self):
+        n = len(self.pico_names)
+        limits = {}
+        for sex, key in [["Female", "range-female"], ["Male", "range-male"]]:
+            limits[sex] = [[self.pico_info[name][key][0] for name in self.pico_names], [self.pico_info[name][key][1] for name in self.pico_names]]
+        # When the sex is unknown, only the ranges that are the same for both sexes are used
+        nan = float("nan")
+        same = [self.pico_info[name]["range-female"] == self.pico_info[name]["range-male"] for name in self.pico_names]
+        limits[None] = [[low if s else nan for low, s in zip(limits["Female"][0], same)], 
+                        [high if s else nan for high, s in zip(limits["Female"][1], same)]]
+
+        values = array.array("d")
+        lows = array.array("d")
+        highs = array.array("d")
+        offsets = [0]
+        # Each string of the pool is parsed only once
+        numbers = [miradata.parse_number(value) for value in self.index.pool.strings]
+        for id in self.mira_data.ids:
+            data = self.src_data[id]
+            [low, high] = limits.get(data.sex, limits[None])
+            codes = data.pico or []
+            for j in range(0, len(codes), n + 1):
+                values.extend([numbers[code] for code in codes[j + 1:j + n + 1]])
+                lows.extend(low)
+                highs.extend(high)
+            offsets.append(len(values))
+        flags = memoryview(miradata.flag_ranges(values, lows, highs))
+        for i in range(0, len(self.mira_data.ids)):
+            self.src_data[self.mira_data.ids[i]].pico_flags = flags[offsets[i]:offsets[i + 1]]
+
+    """Returns the range flag of the k-th analyte in the i-th panel of a patient, as a category 
+    code
+
+    :param data: patient record
+    :param i: index of the panel
+    :param k: index of the analyte
+    """
+    def pico_flag(self, data, i, k):
+        flag = data.pico_flags[i * len(self.pico_names) + k]
+        return str(flag) if flag != miradata.RANGE_MISSING else "\\N"
+
+    """Returns the number of analytes out of the reference range in any of the panels of a 
+    patient
+
+    :param data: patient record
+    """
+    def count_abnormal(self, data):
+        if not data.pico: return "\\N"
+        n = len(self.pico_names)
+        flags = data.pico_flags
+        abnormal = set(j % n for j in range(0, len(flags)) if flags[j] == miradata.RANGE_BELOW or flags[j] == miradata.RANGE_ABOVE)
+        return str(len(abnormal))
+
+    """Adds the Piccolo (metabolic panel) data to the Mirador dataset
+    """
+    def add_pico_data(self):
+        # Calculating the maximum length of a series of metabolic panels, when ingesting the 
+        # longest series of the other patients is taken from the last build
+        max_len = self.series_lengths["panels"]
+        for id in self.src_data:
+            max_len = max(max_len, self.pico_count(self.src_data[id]))
+        self.series_lengths["panels"] = max_len
+        # In long format the panels are saved into a separate table (see save_long_data), 
+        # instead of adding columns for every day up to the longest series
+        if self.long_format: max_len = 0
+
+        if self.pico_range_flags:
+            self.flag_pico_data()
+            self.add_variable("PANEL_ABN", "Number of analytes out of the reference range", "int", "Laboratory", "Metabolic Panel summary")
+        for i in range(1, max_len + 1):
+            self.add_variable("DOPANEL_" + str(i), "Date of metabolic panel " + str(i), "date", "Laboratory", "Metabolic Panel Day " + str(i))
+            for name in self.pico_names:
+                info = self.pico_info[name]
+                self.add_variable(name + "_" + str(i), info["title"] + " day " + str(i), "float", "Laboratory", "Metabolic Panel Day " + str(i))
+                if self.pico_range_flags:
+                    self.add_variable(name + "_R_" + str(i), info["title"] + " reference range day " + str(i), "category", "Laboratory", "Metabolic Panel Day " + str(i))
+                    self.set_var_ranges(name + "_R_" + str(i), "1:Below;2:Within;3:Above")
+
+        if self.pico_range_flags:
+            self.add_column("PANEL_ABN", [self.count_abnormal(self.src_data[id]) for id in self.mira_data.ids])
+        # Patients without a panel on a given day get missing values
+        data_list = [self.src_data[id] for id in self.mira_data.ids]
+        counts = [self.pico_count(data) for data in data_list]
+        for i in range(1, max_len + 1):
+            self.add_column("DOPANEL_" + str(i), [self.pico_value(data, i - 1) if i <= n else "\\N" for data, n in zip(data_list, counts)])
+            for k in range(0, len(self.pico_names)):
+                name = self.pico_names[k]
+                self.add_column(name + "_" + str(i), [self.pico_value(data, i - 1, k) if i <= n else "\\N" for data, n in zip(data_list, counts)])
+                if self.pico_range_flags:
+                    self.add_column(name + "_R_" + str(i), [self.pico_flag(data, i - 1, k) if i <= n else "\\N" for data, n in zip(data_list, counts)])
+
+    """Adds the viral load (qPCR) data to the Mirador dataset. The measured viral loads of all
+    the patients are stored in a single ragged array, so the log transform is applied to the 
+    whole array at once and the summaries are computed over slices of it.
+    """            
+    def add_qpcr_data(self):
+        # Calculating the maximum length of a series of qPCR samples
+        max_len = self.series_lengths["qpcr"]
+        for id in self.src_data:
+            max_len = max(max_len, len(self.src_data[id].qpcr_loads))
+        self.series_lengths["qpcr"] = max_len
+        # In long format only the summary is added, the series are saved into a separate table
+        if self.long_format: max_len = 0
+
+        log_str = " (log units)" if self.convert_qpcr_log else ""
+        self.add_variable("PCR", "First measured viral load" + log_str, "float", "Laboratory", "Viral Load (qPCR) summary")
+        self.add_variable("PCR_MAX", "Maximum measured viral load" + log_str, "float", "Laboratory", "Viral Load (qPCR) summary")
+        self.add_variable("PCR_MIN", "Minimum measured viral load" + log_str, "float", "Laboratory", "Viral Load (qPCR) summary")
+        self.add_variable("PCR_AVE", "Averaged viral load" + log_str, "float", "Laboratory", "Viral Load (qPCR) summary")
+        if self.qpcr_kinetics_data:
+            self.add_variable("PCR_DPEAK", "Days from first qPCR to maximum viral load", "int", "Laboratory", "Viral Load (qPCR) kinetics")
+            self.add_variable("PCR_SLOPE", "Viral load clearance slope (log units per day)", "float", "Laboratory", "Viral Load (qPCR) kinetics")
+            self.add_variable("PCR_INTV", "Average days between qPCR samples", "float", "Laboratory", "Viral Load (qPCR) kinetics")
+        for i in range(1, max_len + 1):
+            self.add_variable("DOPCR_" + str(i), "Date of qPCR " + str(i), "date", "Laboratory", "Viral Load (qPCR) day " + str(i))
+            self.add_variable("PCR_" + str(i), "EBOV copies/mL plasma" + log_str + " day " + str(i), "float", "Laboratory", "Viral Load (qPCR) day " + str(i)) 
+
+        # Measurements without a viral load are left out of the array
+        loads = miradata.RaggedArray()
+        days = miradata.RaggedArray()
+        ordinals = {}
+        for id in self.mira_data.ids:
+            data = self.src_data[id]
+            loads.append([load for load in data.qpcr_loads if not math.isnan(load)])
+            if self.qpcr_kinetics_data:
+                for code in data.qpcr_dates:
+                    if code not in ordinals: ordinals[code] = float(miradata.parse_date(self.index.pool.string(code)) or "nan")
+                days.append([ordinals[code] for code, load in zip(data.qpcr_dates, data.qpcr_loads) if not math.isnan(load)])
+        # log(1 + qpcr) computed over the whole array with builtin functions
+        if self.convert_qpcr_log or self.qpcr_kinetics_data:
+            log_loads = loads.map((1.0).__add__).map(math.log10)
+        if self.convert_qpcr_log: loads = log_loads
+
+        # The measured values are saved with the same formatting in the daily columns
+        text = list(map(str, loads.values))
+        for i in range(0, len(self.mira_data.ids)):
+            data = self.src_data[self.mira_data.ids[i]]
+            k = loads.offsets[i]
+            values = []
+            for load in data.qpcr_loads:
+                if not math.isnan(load):
+                    values.append(text[k])
+                    k += 1
+                else:
+                    values.append("")
+            data.pcr = values
+
+        lengths = loads.lengths()
+        summary = [loads.reduce(lambda s: s[0]), loads.reduce(max), loads.reduce(min), loads.reduce(sequential_sum)]
+        self.add_column("PCR", [str(v) if v is not None else "\\N" for v in summary[0]])
+        self.add_column("PCR_MAX", [str(v) if v is not None else "\\N" for v in summary[1]])
+        self.add_column("PCR_MIN", [str(v) if v is not None else "\\N" for v in summary[2]])
+        self.add_column("PCR_AVE", [str(v / n) if v is not None else "\\N" for v, n in zip(summary[3], lengths)])
+
+        if self.qpcr_kinetics_data:
+            kinetics = [qpcr_kinetics(log_loads.series(i), days.series(i)) for i in range(0, len(loads))]
+            for k, name in enumerate(["PCR_DPEAK", "PCR_SLOPE", "PCR_INTV"]):
+                self.add_column(name, [str(values[k]) if values[k] is not None else "\\N" for values in kinetics])
+
+        # Patients with shorter series get missing values in the remaining days
+        dates_list = [self.src_data[id].qpcr_dates for id in self.mira_data.ids]
+        values_list = [self.src_data[id].pcr for id in self.mira_data.ids]
+        pool = self.index.pool
+        for i in range(1, max_len + 1):
+            self.add_column("DOPCR_" + str(i), [pool.string(dates[i - 1]) if i <= len(dates) else "\\N" for dates in dates_list])
+            self.add_column("PCR_" + str(i), [values[i - 1] if i <= len(values) else "\\N" for values in values_list])
+
+    """Adds the sequencing data (SNPs, AF, clustering) to the Mirador dataset
+    """ 
+    def add_seq_data(self):
+        for var in self.snp_vars:
+            self.add_variable(var, self.snp_vars[var], "category", "Sequencing", "Viral SNPs")
+            self.set_var_ranges(var, "1:Yes;0:No")
+        for var in self.af_vars:
+            self.add_variable(var, self.af_vars[var], "float", "Sequencing", "Allele Frequencies")
+        self.add_variable("CLUST", self.cl_vars["CLUST"], "category", "Sequencing", "Clustering")
+        self.set_var_ranges("CLUST", "1:Cluster 1;2:Cluster 2;3:Cluster 3")
+        self.add_variable("MCLUST", self.cl_vars["MCLUST"], "int", "Sequencing", "Clustering")    
+        self.add_variable("SCLUST", self.cl_vars["SCLUST"], "category", "Sequencing", "Clustering")
+        self.set_var_ranges("SCLUST", "1:Sub-cluster a;2:Sub-cluster b;3:Sub-cluster c")
+        self.add_variable("MSCLUST", self.cl_vars["MSCLUST"], "int", "Sequencing", "Clustering")
+
+        ids = self.mira_data.ids
+        for var in self.snp_vars:
+            self.add_column(var, [self.snp_data[var].get(id, "") for id in ids])
+        for var in self.af_vars:
+            self.add_column(var, [self.af_data[var].get(id, "") for id in ids])
+        for var in self.cl_vars:
+            self.add_column(var, [self.cl_data[var].get(id, "") for id in ids])
+
+    """Saves the number and fraction of missing values of each column of the dataset into a csv
+    file, counted while the columns were added. Returns the list of columns with more missing
+    values than the missing.threshold setting in config.mira, which Mirador would leave out.
+
+    :param filename: name of the csv report
+    :param counts: missing values of each variable in the rows saved in data.csv that are not 
+                   in the dataset, when only some of the rows were aggregated (see save_ingest)
+    :param nrows: number of these rows
+    """
+    def save_missing(self, filename, counts=None, nrows=0):
+        print("Saving missingness report...")
+        threshold = miradata.missing_threshold(miradata.read_config(self.config_file).get("missing.threshold"))
+        over = []
+        with buildcache.OutputFile(filename) as file:
+            writer = csv.writer(file, dialect="excel")
+            writer.writerow(["VARIABLE", "TYPE", "MISSING", "FRACTION", "OVER_THRESHOLD"])
+            for var in self.variables:
+                column = self.mira_data.columns[var]
+                missing = column.nmissing + (counts[var] if counts else 0)
+                total = len(column) + nrows
+                fraction = float(missing) / total if total else 0.0
+                above = threshold is not None and threshold < fraction
+                if above: over.append(var)
+                writer.writerow([var, self.var_types[var], str(missing), "%.4f" % fraction, "1" if above else "0"])
+        print("  " + str(len(over)) + " of " + str(len(self.variables)) + " columns over the missing threshold")
         print("Done.")
-    except:
-        sys.stderr.write("XML validation error:\n")
-        raise
+        return over
+
+    """Removes variables from the dataset, the dictionary and the groups, leaving out the tables
+    and groups that become empty
+
+    :param names: variable names
+    """
+    def remove_variables(self, names):
+        names = set(names)
+        for gname in list(self.var_groups):
+            group = self.var_groups[gname]
+            for tname in list(group):
+                group[tname] = [var for var in group[tname] if var not in names]
+                if not group[tname]: del group[tname]
+            if not group: del self.var_groups[gname]
+        for var in names:
+            del self.var_titles[var]
+            del self.var_types[var]
+            self.var_ranges.pop(var, None)
+        self.variables[:] = [var for var in self.variables if var not in names]
+        self.mira_data.remove_columns(names)
+
+    """Saves the Mirador dataset into a csv file, together with its row index (data.idx) for 
+    random access to the rows of each patient. Returns true if the csv file was modified.
+
+    :param filename: name of csv file
+    """ 
+    def save_data(self, filename):
+        print("Saving data...")
+        if list(self.mira_data.columns) != self.variables:
+            raise ValueError("The columns in the dataset do not match the list of variables")
+        output = buildcache.OutputFile(filename)
+        with output as file:
+            offsets = miradata.write_csv(file, self.variables, self.mira_data.rows())
+        # Row index with the byte offset of the row of each patient
+        index_name = os.path.join(os.path.dirname(filename), miradata.INDEX_NAME)
+        with buildcache.OutputFile(index_name, open, "wb") as file:
+            miradata.write_index(file, filename, self.variables, self.mira_data.ids, offsets)
+        print("Done.")
+        return output.changed
+
+    """Saves the rows of the patients aggregated from new source rows into the existing dataset.
+    The rows of the other patients are not aggregated again. When the patients are all new and 
+    the variables did not change, their rows are appended to data.csv, otherwise data.csv is 
+    rewritten in a single pass, copying the rows of the other patients, with missing values in
+    the variables added for the longer series. The missing value counts of the other patients
+    are taken from the previous missingness report. Returns the number of rows written.
+
+    :param dir: folder path
+    """
+    def save_ingest(self, dir):
+        print("Saving ingested data...")
+        filename = dir + "/data.csv"
+        if list(self.mira_data.columns) != self.variables:
+            raise ValueError("The columns in the dataset do not match the list of variables")
+        old = miradata.DataIndex(dir)
+        rows = dict(zip(self.mira_data.ids, self.mira_data.rows()))
+        changed = [id for id in self.mira_data.ids if id in old]
+        new_ids = [id for id in self.mira_data.ids if not id in old]
+
+        # Missing values in the rows that are not replaced
+        with open(dir + "/missing.csv", "r") as file:
+            counts = dict((row[0], int(row[2])) for row in list(csv.reader(file))[1:])
+        nrows = len(old) - len(changed)
+        for id in changed:
+            for name, value in zip(old.names, old.row(id)):
+                if value == "" or value == miradata.MISSING: counts[name] -= 1
+        counts = dict((var, counts[var] if var in old.columns else nrows) for var in self.variables)
+
+        if old.names == self.variables and not changed:
+            print("  appending " + str(len(new_ids)) + " patients...")
+            with open(filename, "a") as file:
+                offsets = miradata.write_csv(file, None, [rows[id] for id in new_ids], old.offsets[-1])
+            with buildcache.OutputFile(dir + "/" + miradata.INDEX_NAME, open, "wb") as file:
+                miradata.append_index(file, old, new_ids, offsets)
+            old.close()
+        else:
+            print("  updating " + str(len(changed)) + " patients, adding " + str(len(new_ids)) + " patients, " + 
+                  str(len([var for var in self.variables if not var in old.columns])) + " new variables...")
+            positions = [old.columns.get(var) for var in self.variables]
+            old_ids = old.ids()
+            def all_rows():
+                with open(filename, "r") as file:
+                    reader = csv.reader(file, dialect="excel")
+                    next(reader)
+                    for id, values in zip(old_ids, reader):
+                        if id in rows: yield rows[id]
+                        elif old.names == self.variables: yield values
+                        else: yield [values[k] if k is not None else miradata.MISSING for k in positions]
+                for id in new_ids:
+                    yield rows[id]
+            old.close()
+            with buildcache.OutputFile(filename) as file:
+                offsets = miradata.write_csv(file, self.variables, all_rows())
+            with buildcache.OutputFile(dir + "/" + miradata.INDEX_NAME, open, "wb") as file:
+                miradata.write_index(file, filename, self.variables, old_ids + new_ids, offsets)
+        print("Done.")
+        self.save_missing(dir + "/missing.csv", counts, nrows)
+        return len(changed) + len(new_ids)
+
+    """Saves the dictionary for the Mirador dataset into a csv file, returns true if the file 
+    was modified
+
+    :param filename: name of csv dictionary
+    """ 
+    def save_dict(self, filename):    
+        print("Saving dictionary...") 
+        output = buildcache.OutputFile(filename)
+        with output as file:
+            writer = csv.writer(file, dialect="excel")
+            for var in self.variables:
+                if var in self.var_ranges and self.var_ranges[var]:
+                    writer.writerow([self.var_titles[var], self.var_types[var], self.var_ranges[var]])
+                else:
+                    writer.writerow([self.var_titles[var], self.var_types[var]])
+        print("Done.") 
+        return output.changed
+
+    """Saves the group/tables hierarchy for the Mirador dataset into an xml file, returns true 
+    if the file was modified
+
+    :param filename: name of xml file
+    """
+    def save_groups(self, filename):
+        print("Saving groups...")
+        # Writing file in utf-8 because the input html files from
+        # NHANES website sometimes have characters output the ASCII range.
+        output = buildcache.OutputFile(filename, codecs.open, 'w', 'utf-8')
+        try:
+            with output as xml_file:
+                writer = XMLWriter(xml_file)
+                writer.start("data")
+                for gname in self.var_groups:
+                    if gname in ["State", "Weighting", "Land and Cell Raking"]: continue            
+                    writer.start("group", {"name": gname})
+                    group = self.var_groups[gname]
+                    for tname in group:
+                        writer.start("table", {"name": tname})
+                        for var in group[tname]:
+                            writer.empty("variable", {"name": var})
+                        writer.end()
+                    writer.end()
+                writer.close()
+        except xml.sax.SAXParseException:
+            sys.stderr.write("XML validation error:\n")
+            raise
+        print("Done.")
+        return output.changed
+
+    """Saves the qPCR and Piccolo series in long format: one row per measurement, with the GID
+    of the patient and the index of the measurement in the series, so the size of the tables 
+    depends only on the number of measurements. Returns the list of saved files.
+
+    :param dir: folder path
+    """ 
+    def save_long_data(self, dir):
+        print("Saving long format tables...")
+        qpcr_name = dir + "/qpcr.csv"
+        with buildcache.OutputFile(qpcr_name) as file:
+            writer = csv.writer(file, dialect="excel")
+            writer.writerow(["GID", "SAMPLE", "DOPCR", "PCR"])
+            for id in self.mira_data.ids:
+                dates = self.src_data[id].qpcr_dates
+                values = self.src_data[id].pcr
+                for i in range(0, len(dates)):
+                    writer.writerow([id, str(i + 1), self.index.pool.string(dates[i]) or "\\N", values[i] or "\\N"])
+        pico_name = dir + "/panels.csv"
+        with buildcache.OutputFile(pico_name) as file:
+            writer = csv.writer(file, dialect="excel")
+            header = ["GID", "PANEL", "DOPANEL"] + self.pico_names
+            if self.pico_range_flags: header.extend([name + "_R" for name in self.pico_names])
+            writer.writerow(header)
+            for id in self.mira_data.ids:
+                data = self.src_data[id]
+                for i in range(0, self.pico_count(data)):
+                    row = [id, str(i + 1), self.pico_value(data, i) or "\\N"] + [self.pico_value(data, i, k) or "\\N" for k in range(0, len(self.pico_names))]
+                    if self.pico_range_flags: row.extend([self.pico_flag(data, i, k) for k in range(0, len(self.pico_names))])
+                    writer.writerow(row)
+        print("Done.")
+        return [qpcr_name, pico_name]
+
+    """Saves the sparse matrix with the allele frequencies of all the iSNV sites next to the 
+    Mirador dataset, so genome-wide analyses do not need a column per site in data.csv
+
+    :param filename: name of the sparse matrix file
+    """
+    def save_af_matrix(self, filename):
+        print("Saving allele frequency matrix...")
+        output = buildcache.OutputFile(filename, open, "wb")
+        with output as file:
+            miradata.write_sparse(self.af_matrix, file)
+        print("Done.")
+        return output.changed
+
+    """Saves the associations between all the pairs of variables, computed with the correlation 
+    settings of config.mira (see miraassoc.py). Only the pairs involving variables that changed
+    since the last build are computed.
+
+    :param filename: name of the association file
+    """
+    def save_assoc(self, filename):
+        import miraassoc
+        print("Computing associations...")
+        config = miradata.read_config(self.config_file)
+        [computed, reused] = miraassoc.update(filename, self.mira_data, self.var_types, miraassoc.assoc_settings(config), self.num_jobs)
+        print("  " + str(computed) + " pairs computed, " + str(reused) + " pairs unchanged")
+        threshold = miraassoc.pvalue_threshold(config.get("correlation.pvalue", "P0_05"))
+        significant = miraassoc.count_significant(filename, threshold, float(config.get("correlation.threshold", "0")))
+        print("  " + str(significant) + " significant associations")
+        print("Done.")
+        return computed
+
+    """Saves the Mirador dataset into a typed, column-major binary file next to data.csv, so 
+    the data can be loaded without parsing the csv file. Mirador does not read this file, it
+    keeps generating its own binary file (data.binary in config.mira) from data.csv.
+
+    :param filename: name of binary file
+    """ 
+    def save_binary(self, filename):
+        print("Saving binary data...")
+        config = miradata.read_config(self.config_file)
+        output = buildcache.OutputFile(filename, open, "wb")
+        with output as file:
+            miradata.write_binary(self.mira_data, self.var_ranges, config.get("dates.parse", "yyyy-MM-dd"), file)
+        print("Done.")
+        return output.changed
 
 ##########################################################################################
 #
@@ -650,57 +1561,9 @@ def save_groups(filename):
 #
 ##########################################################################################
 
-aggregate_seq_data = False
-convert_qpcr_log = False
-for arg in sys.argv[1:]:
-    if arg == "-seq":
-        aggregate_seq_data = True
-    elif arg == "-log":
-        convert_qpcr_log = True
-    
-src_data = collections.OrderedDict()
-mira_data = collections.OrderedDict()
-
-variables = []
-var_titles = {}
-var_types = {}
-var_ranges = {}
-var_groups = collections.OrderedDict()
-
-print("Loading data...")
-ignore_id = load_ignore("idignore")
-print("  master table...")
-load_master("sources/csv/MasterDataListandEBOVResults.csv")
-print("  demographics table...")
-load_demo("sources/csv/DemographicsFromSim_schieffelin.csv")
-demo_dict = load_dict("demo-dict.csv")
-print("  case notification table...")
-load_case("sources/csv/CaseNotification_schieffelin.csv")
-case_dict = load_dict("case-dict.csv")
-print("  metabolic panel table...")
-load_pico_data("sources/csv/FinalPiccoloData_schieffelin-FinalSummary1.csv")
-[pico_names, pico_info] = load_pico_info("piccolo-expected.csv")
-if aggregate_seq_data:
-    print("  sequencing data...")
-    # Load the SNP data
-    [snp_vars, snp_data] = load_snp_data("sources/vcf/SNP-2014.vcf")
-    # Load the Allele Frequency data (only for SNP 10218)
-    [af_vars, af_data] = load_af_data("sources/vcf/iSNV-all.vcf", [10218])
-    # Load the cluster data
-    [cl_vars, cl_data] = load_cluster_data("sources/vcf/clusters.tsv")
-print("Done.")
-print_summary()
-
-print("Aggregating data...")
-add_demo_data()
-add_case_data()
-add_pico_data()
-add_qpcr_data()
-if aggregate_seq_data:
-    add_seq_data()
-print("Done.")
-    
-init_dataset("mirador")
-save_data("mirador/data.csv")
-save_dict("mirador/dictionary.csv")
-save_groups("mirador/groups.xml")
+if __name__ == "__main__":
+    try:
+        Builder(**parse_options(sys.argv[1:])).build()
+    except ValueError as e:
+        sys.stderr.write(str(e) + "\n")
+        sys.exit(1)
@@ -0,0 +1,323 @@
+"""
+This module precomputes the pairwise associations between the variables of the Mirador
+dataset with the correlation settings of config.mira (correlation.algorithm and
+correlation.surrogates), so the viewer does not need to compute them when the dataset is
+opened.
+
+The association between two variables is their mutual information over the patients with
+values in both, after binning the numeric and date values into quantiles (categories are
+used as they are, and string variables are not tested). The score is the mutual information
+normalized by the entropies of the two variables, between 0 and 1. Its p-value is estimated
+from surrogates where the values of the second variable are shuffled among the patients:
+from a Gaussian fit of the surrogate scores (SURROGATE_GAUSS), or from the fraction of
+surrogates scoring at least as high (SURROGATE_GENERAL). The shuffles are drawn from a fixed
+seed, so the results do not depend on the number of processes.
+
+Each surrogate only needs the joint counts of the two variables, which are computed with
+builtin functions (sorting the patients by random keys, counting with Counter) over typed
+arrays of bin codes. The pairs are split in blocks of variables that are computed in
+parallel by a pool of processes.
+
+The scores and p-values are saved into a binary file next to data.csv (assoc.bin), together
+with a hash of the values of each variable, so the next build only computes the pairs
+involving variables that changed.
+
+@copyright: Harvard University 2014-15
+"""
+
+import os, sys, math, json, mmap, struct, array, random, bisect, hashlib, datetime, itertools
+import collections, operator, multiprocessing, concurrent.futures
+import miradata, buildcache
+
+ASSOC_MAGIC = b"MIRAASC1"
+VERSION = 1
+SEED = 2014
+# Variables per block of pairs computed by a process
+BLOCK_SIZE = 32
+# Pairs with fewer patients with values in both variables are not tested
+MIN_ROWS = 10
+ALGORITHMS = ["SURROGATE_GAUSS", "SURROGATE_GENERAL", "NO_TEST"]
+
+"""Returns the settings used to compute the associations, from the correlation settings in
+config.mira
+
+:param config: dictionary with the settings of config.mira
+"""
+def assoc_settings(config):
+    algorithm = config.get("correlation.algorithm", "SURROGATE_GAUSS")
+    if not algorithm in ALGORITHMS:
+        raise ValueError("Unsupported correlation algorithm " + algorithm)
+    surrogates = int(config.get("correlation.surrogates", "100")) if algorithm != "NO_TEST" else 0
+    return {"version": VERSION, "algorithm": algorithm, "surrogates": surrogates, "seed": SEED,
+            "dates": config.get("dates.parse", "yyyy-MM-dd")}
+
+"""Returns the p-value threshold of a correlation.pvalue setting, e.g. 0.001 for P0_001
+
+:param value: value of correlation.pvalue
+"""
+def pvalue_threshold(value):
+    return float(value[1:].replace("_", "."))
+
+"""Returns the hash of the type and values of a column of the dataset
+
+:param column: column in the dataset
+:param type: variable type
+"""
+def column_hash(column, type):
+    sha = hashlib.sha1(type.lower().encode("utf-8"))
+    for i in range(0, len(column)):
+        sha.update(column.value(i).encode("utf-8"))
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+"""Returns the bin code of each value of a column (-1 for missing values), and the number of
+bins, or None for the variables that are not tested (strings). Numbers and dates are binned
+into quantiles, with as many bins as given by Sturges' rule, or into their distinct values
+when there are fewer of them.
+
+:param column: column in the dataset
+:param type: variable type
+:param dformat: strptime format used to parse dates
+"""
+def bin_column(column, type, dformat):
+    type = type.lower()
+    values = [None if column.missing[i] else column.value(i) for i in range(0, len(column))]
+    codes = array.array("i")
+    if type == "category":
+        levels = {}
+        for value in values:
+            if value is None:
+                codes.append(-1)
+                continue
+            if not value in levels: levels[value] = len(levels)
+            codes.append(levels[value])
+        return codes, len(levels)
+    if type != "int" and type != "float" and type != "date":
+        return None
+    numbers = []
+    for value in values:
+        try:
+            if value is None: number = None
+            elif type == "date": number = float(datetime.datetime.strptime(value, dformat).toordinal())
+            else: number = miradata.to_float(value)
+        except ValueError:
+            number = None
+        numbers.append(number if number is None or not math.isnan(number) else None)
+    present = sorted(x for x in numbers if x is not None)
+    distinct = sorted(set(present))
+    nbins = int(math.ceil(math.log(max(len(present), 1), 2))) + 1
+    if len(distinct) <= nbins:
+        for x in numbers: codes.append(-1 if x is None else bisect.bisect_left(distinct, x))
+        return codes, len(distinct)
+    edges = sorted(set(present[(k * len(present)) // nbins] for k in range(1, nbins)))
+    for x in numbers: codes.append(-1 if x is None else bisect.bisect_right(edges, x))
+    return codes, len(edges) + 1
+
+# Random keys and c*log(c) tables, built once per process
+shuffle_keys = {}
+clogc_tables = {}
+
+"""Returns the random keys used to shuffle the patients in each surrogate, the same in all
+the processes
+
+:param nsurrogates: number of surrogates
+:param nrows: number of patients
+:param seed: random seed
+"""
+def get_shuffle_keys(nsurrogates, nrows, seed):
+    key = (nsurrogates, nrows, seed)
+    if not key in shuffle_keys:
+        rand = random.Random(seed)
+        shuffle_keys[key] = [array.array("d", [rand.random() for i in range(0, nrows)]) for s in range(0, nsurrogates)]
+    return shuffle_keys[key]
+
+def get_clogc(nrows):
+    if not nrows in clogc_tables:
+        clogc_tables[nrows] = array.array("d", [0.0] + [c * math.log(c) for c in range(1, nrows + 1)])
+    return clogc_tables[nrows]
+
+"""Returns the entropy of a set of values from their counts
+
+:param counts: counts of each distinct value
+:param m: number of values
+:param clogc: table of c*log(c)
+"""
+def entropy(counts, m, clogc):
+    return math.log(m) - math.fsum(map(clogc.__getitem__, counts)) / m
+
+"""Returns [score, p-value] of the association between two variables
+
+:param x: bin codes of the first variable
+:param y: bin codes of the second variable
+:param ny: number of bins of the second variable
+:param settings: association settings
+"""
+def associate(x, y, ny, settings):
+    both = bytes(map(operator.and_, map((-1).__lt__, x), map((-1).__lt__, y)))
+    rows = list(itertools.compress(range(0, len(x)), both))
+    m = len(rows)
+    if m < MIN_ROWS: return [float("nan"), float("nan")]
+    clogc = get_clogc(len(x))
+    # The joint bins are x * ny + y
+    xs = [x[k] * ny for k in rows]
+    ys = list(map(y.__getitem__, rows))
+    hx = entropy(collections.Counter(xs).values(), m, clogc)
+    hy = entropy(collections.Counter(ys).values(), m, clogc)
+    if hx <= 0 or hy <= 0: return [0.0, 1.0]
+    norm = math.sqrt(hx * hy)
+    score = (hx + hy - entropy(collections.Counter(map(operator.add, xs, ys)).values(), m, clogc)) / norm
+    if settings["algorithm"] == "NO_TEST": return [score, float("nan")]
+    # Sorting the patients by random keys shuffles the values of y, which only changes the
+    # joint entropy
+    scores = []
+    for keys in get_shuffle_keys(settings["surrogates"], len(x), settings["seed"]):
+        shuffled = map(y.__getitem__, sorted(rows, key=keys.__getitem__))
+        scores.append((hx + hy - entropy(collections.Counter(map(operator.add, xs, shuffled)).values(), m, clogc)) / norm)
+    if settings["algorithm"] == "SURROGATE_GENERAL":
+        return [score, (1.0 + sum(1 for s in scores if score <= s)) / (len(scores) + 1.0)]
+    mean = math.fsum(scores) / len(scores)
+    std = math.sqrt(math.fsum((s - mean) ** 2 for s in scores) / len(scores))
+    if std == 0: return [score, 0.0 if mean < score else 1.0]
+    return [score, 0.5 * math.erfc((score - mean) / (std * math.sqrt(2.0)))]
+
+"""Computes a block of pairs, returns the list of [i, j, score, p-value]
+
+:param pairs: list of [i, j] pairs of variables
+:param bins: dictionary with the [codes, number of bins] of the variables in the pairs
+:param settings: association settings
+"""
+def compute_block(pairs, bins, settings):
+    results = []
+    for [i, j] in pairs:
+        [score, pvalue] = associate(bins[i][0], bins[j][0], bins[j][1], settings)
+        results.append([i, j, score, pvalue])
+    return results
+
+"""Position of the pair i < j in the upper triangle of an n x n matrix, stored row by row
+"""
+def pair_index(i, j, n):
+    return i * n - (i * (i + 1)) // 2 + (j - i - 1)
+
+"""Memory-mapped access to the scores and p-values of a file written by update.
+
+:param filename: name of the association file
+"""
+class Associations(object):
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[0:8] != ASSOC_MAGIC:
+            raise ValueError(filename + " is not a Mirador association file")
+        size = struct.unpack("<Q", self.map[8:16])[0]
+        header = json.loads(self.map[16:16 + size].decode("utf-8"))
+        start = 16 + size
+        self.settings = header["settings"]
+        self.names = header["variables"]
+        self.hashes = header["hashes"]
+        self.positions = dict((name, i) for i, name in enumerate(self.names))
+        npairs = len(self.names) * (len(self.names) - 1) // 2
+        self.scores = memoryview(self.map)[start:start + 8 * npairs].cast("d")
+        self.pvalues = memoryview(self.map)[start + 8 * npairs:start + 16 * npairs].cast("d")
+
+    """Returns [score, p-value] of two variables, NaN when they were not tested
+
+    :param a: name of the first variable
+    :param b: name of the second variable
+    """
+    def pair(self, a, b):
+        [i, j] = sorted([self.positions[a], self.positions[b]])
+        k = pair_index(i, j, len(self.names))
+        return [self.scores[k], self.pvalues[k]]
+
+    def close(self):
+        self.scores.release()
+        self.pvalues.release()
+        self.map.close()
+        self.file.close()
+
+"""Computes the associations between all the variables of the dataset, reusing the ones in
+the existing file for the pairs of variables that did not change, and saves them into the
+file. Returns the number of computed pairs and the number of reused pairs.
+
+:param filename: name of the association file
+:param dataset: Mirador dataset
+:param types: dictionary with the type of each variable
+:param settings: association settings (see assoc_settings)
+:param jobs: number of processes
+"""
+def update(filename, dataset, types, settings, jobs=1):
+    names = list(dataset.columns)
+    n = len(names)
+    hashes = [column_hash(dataset.columns[name], types[name]) for name in names]
+    scores = array.array("d", [float("nan")]) * (n * (n - 1) // 2)
+    pvalues = array.array("d", [float("nan")]) * (n * (n - 1) // 2)
+    # Pairs of unchanged variables are copied from the existing file
+    reused = set()
+    if os.path.isfile(filename):
+        try:
+            old = Associations(filename)
+        except ValueError:
+            old = None
+        if old is not None:
+            if old.settings == settings:
+                same = [i for i in range(0, n) if names[i] in old.positions and old.hashes[old.positions[names[i]]] == hashes[i]]
+                for a in range(0, len(same)):
+                    for b in range(a + 1, len(same)):
+                        [i, j] = [same[a], same[b]]
+                        k = pair_index(i, j, n)
+                        [scores[k], pvalues[k]] = old.pair(names[i], names[j])
+                        reused.add((i, j))
+            old.close()
+
+    dformat = miradata.date_format(settings["dates"])
+    bins = [bin_column(dataset.columns[name], types[name], dformat) for name in names]
+    tested = [i for i in range(0, n) if bins[i] is not None]
+    blocks = collections.OrderedDict()
+    for a in range(0, len(tested)):
+        for b in range(a + 1, len(tested)):
+            [i, j] = [tested[a], tested[b]]
+            if (i, j) in reused: continue
+            blocks.setdefault((a // BLOCK_SIZE, b // BLOCK_SIZE), []).append([i, j])
+    tasks = []
+    for pairs in blocks.values():
+        involved = set(i for pair in pairs for i in pair)
+        tasks.append([pairs, dict((i, bins[i]) for i in involved), settings])
+    if 1 < jobs and 1 < len(tasks) and "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(min(jobs, len(tasks)), mp_context=context) as pool:
+            results = list(pool.map(compute_block, *zip(*tasks)))
+    else:
+        results = [compute_block(*task) for task in tasks]
+    computed = 0
+    for block in results:
+        for [i, j, score, pvalue] in block:
+            k = pair_index(i, j, n)
+            scores[k] = score
+            pvalues[k] = pvalue
+            computed += 1
+
+    header = json.dumps({"settings": settings, "variables": names, "hashes": hashes}).encode("utf-8")
+    header += b" " * ((8 - len(header) % 8) % 8)
+    if sys.byteorder != "little":
+        scores.byteswap()
+        pvalues.byteswap()
+    with buildcache.OutputFile(filename, open, "wb") as file:
+        file.write(ASSOC_MAGIC)
+        file.write(struct.pack("<Q", len(header)))
+        file.write(header)
+        scores.tofile(file)
+        pvalues.tofile(file)
+    return [computed, len(reused)]
+
+"""Returns the number of pairs whose association is significant, with a p-value under the
+threshold and a score of at least min_score
+
+:param filename: name of the association file
+:param threshold: p-value threshold
+:param min_score: minimum score
+"""
+def count_significant(filename, threshold, min_score):
+    assoc = Associations(filename)
+    count = sum(1 for score, pvalue in zip(assoc.scores, assoc.pvalues) if pvalue < threshold and min_score <= score)
+    assoc.close()
+    return count
@@ -0,0 +1,994 @@
+"""
+This module provides the columnar in-memory store used to aggregate the Mirador dataset.
+Each variable is kept as a typed array (int, float, date or category/string codes into a
+string pool shared by all the columns), filled column by column, and only converted into
+rows of strings when the dataset is written.
+
+Numeric and date values are stored in typed arrays only when their text representation can
+be restored exactly, otherwise the column falls back to the string pool, so the saved
+dataset is identical to the input values. Missing values ("" or \\N) are tracked with a
+per-column mask.
+
+The dataset can also be saved into a typed, column-major binary file (data.cols.bin) that can
+be memory mapped to read individual columns without parsing the csv file (see write_binary 
+and BinaryData). This file is separate from the binary cache that Mirador itself generates 
+from data.csv (data.binary in config.mira), which has a different format. The binary file can
+be checked against data.csv with:
+
+python miradata.py -check mirador
+
+@copyright: Harvard University 2014-15
+"""
+
+import sys, os, io, csv, math, mmap, json, struct, array, datetime, collections
+
+MISSING = "\\N"
+INDEX_NAME = "data.idx"
+BINARY_NAME = "data.cols.bin"
+
+"""Pool of unique strings, each identified by an integer code.
+"""
+class StringPool(object):
+    def __init__(self):
+        self.codes = {}
+        self.strings = []
+
+    def code(self, value):
+        if value in self.codes:
+            return self.codes[value]
+        code = len(self.strings)
+        self.codes[value] = code
+        self.strings.append(value)
+        return code
+
+    def string(self, code):
+        return self.strings[code]
+
+"""Functions to convert strings into typed values and back for each storage kind. Parsing
+returns None when the value cannot be stored in the typed array without changing its text.
+"""
+def parse_int(value):
+    try:
+        ival = int(value)
+    except ValueError:
+        return None
+    if str(ival) != value or not (-2**63 <= ival < 2**63): return None
+    return ival
+
+def parse_float(value):
+    try:
+        fval = float(value)
+    except ValueError:
+        return None
+    if repr(fval) != value: return None
+    return fval
+
+def parse_date(value):
+    if len(value) != 10 or value[4] != "-" or value[7] != "-": return None
+    try:
+        date = datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+    except ValueError:
+        return None
+    if date.isoformat() != value: return None
+    return date.toordinal()
+
+def format_date(value):
+    return datetime.date.fromordinal(value).isoformat()
+
+# Storage kind per Mirador type: array typecode, parser and formatter
+KINDS = {"int": ("q", parse_int, str),
+         "float": ("d", parse_float, repr),
+         "date": ("i", parse_date, format_date)}
+
+"""Returns the storage kind for a Mirador variable type (int, float, date, category, string)
+
+:param type: variable type
+"""
+def storage_kind(type):
+    type = type.lower()
+    if type in KINDS: return type
+    return "pool"
+
+"""Typed column of values for a single variable in the dataset.
+
+:param name: variable name
+:param type: variable type (int, float, date, category, string)
+:param pool: string pool used for category and string values
+"""
+class Column(object):
+    def __init__(self, name, type, pool):
+        self.name = name
+        self.type = type
+        self.pool = pool
+        self.kind = storage_kind(type)
+        if self.kind == "pool":
+            self.data = array.array("i")
+        else:
+            self.data = array.array(KINDS[self.kind][0])
+        self.missing = bytearray()
+        self.nmissing = 0
+
+    def __len__(self):
+        return len(self.missing)
+
+    def demote(self):
+        # Moves the values stored so far into the string pool
+        format = KINDS[self.kind][2]
+        codes = array.array("i")
+        for i in range(0, len(self.data)):
+            codes.append(0 if self.missing[i] else self.pool.code(format(self.data[i])))
+        self.data = codes
+        self.kind = "pool"
+
+    def append(self, value):
+        if value is None or value == "" or value == MISSING:
+            self.data.append(0)
+            self.missing.append(1)
+            self.nmissing += 1
+            return
+        value = str(value)
+        if self.kind != "pool":
+            tval = KINDS[self.kind][1](value)
+            if tval is None:
+                self.demote()
+            else:
+                self.data.append(tval)
+                self.missing.append(0)
+                return
+        self.data.append(self.pool.code(value))
+        self.missing.append(0)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def value(self, i):
+        if self.missing[i]: return MISSING
+        if self.kind == "pool": return self.pool.string(self.data[i])
+        return KINDS[self.kind][2](self.data[i])
+
+"""Columnar dataset holding one row per patient.
+
+:param ids: patient ids, in the order the rows will be written
+"""
+class Dataset(object):
+    def __init__(self, ids):
+        self.ids = list(ids)
+        self.pool = StringPool()
+        self.columns = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.ids)
+
+    """Adds a new column to the dataset.
+
+    :param name: variable name
+    :param type: variable type (int, float, date, category, string)
+    :param values: iterable with one value per patient, in the same order as the ids
+    """
+    def add_column(self, name, type, values):
+        column = Column(name, type, self.pool)
+        column.extend(values)
+        if len(column) != len(self.ids):
+            raise ValueError("Column " + name + " has " + str(len(column)) + " values, expected " + str(len(self.ids)))
+        self.columns[name] = column
+        return column
+
+    """Removes columns from the dataset
+
+    :param names: variable names
+    """
+    def remove_columns(self, names):
+        for name in names:
+            del self.columns[name]
+
+    def row(self, i):
+        return [column.value(i) for column in self.columns.values()]
+
+    def rows(self):
+        columns = list(self.columns.values())
+        for i in range(0, len(self.ids)):
+            yield [column.value(i) for column in columns]
+
+"""Variable-length series of numbers, one per patient, stored in a single contiguous typed
+array together with the offset where each series starts. Transformations run over the whole
+array at once, and reductions over slices of it, instead of over Python lists per patient.
+
+:param typecode: typecode of the array holding the values
+"""
+class RaggedArray(object):
+    def __init__(self, typecode="d"):
+        self.values = array.array(typecode)
+        self.offsets = array.array("q", [0])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    """Adds a series at the end of the array
+
+    :param values: values of the series
+    """
+    def append(self, values):
+        self.values.extend(values)
+        self.offsets.append(len(self.values))
+
+    """Returns the values of the i-th series, as a view into the array
+    """
+    def series(self, i):
+        return memoryview(self.values)[self.offsets[i]:self.offsets[i + 1]]
+
+    def lengths(self):
+        return [self.offsets[i + 1] - self.offsets[i] for i in range(0, len(self))]
+
+    """Returns a new array with the same series, with func applied to all the values
+
+    :param func: function applied to each value, preferably a builtin so the whole array
+                 is transformed without calling Python code
+    """
+    def map(self, func):
+        result = RaggedArray(self.values.typecode)
+        result.values = array.array(self.values.typecode, map(func, self.values))
+        result.offsets = self.offsets
+        return result
+
+    """Returns the list with the result of func for each series, or the empty value for the
+    series without values
+
+    :param func: function applied to the view of each series
+    :param empty: value for the empty series
+    """
+    def reduce(self, func, empty=None):
+        view = memoryview(self.values)
+        offsets = self.offsets
+        return [func(view[offsets[i]:offsets[i + 1]]) if offsets[i] < offsets[i + 1] else empty for i in range(0, len(self))]
+
+# Position of a value with respect to a reference range
+RANGE_MISSING = 0
+RANGE_BELOW = 1
+RANGE_WITHIN = 2
+RANGE_ABOVE = 3
+
+def range_flag(value, low, high):
+    if not (value == value and low <= high): return RANGE_MISSING
+    if value < low: return RANGE_BELOW
+    if high < value: return RANGE_ABOVE
+    return RANGE_WITHIN
+
+"""Returns an array with the position of each value with respect to its reference range
+(RANGE_BELOW, RANGE_WITHIN or RANGE_ABOVE), or RANGE_MISSING when the value or the range are
+NaN. The three arrays are traversed in a single pass.
+
+:param values: array of values
+:param lows: array with the lower limit for each value
+:param highs: array with the upper limit for each value
+"""
+def flag_ranges(values, lows, highs):
+    return array.array("b", map(range_flag, values, lows, highs))
+
+"""Converts a value into a float, returns NaN if the value is missing or not a number
+
+:param value: string to convert
+"""
+def parse_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return float("nan")
+
+##########################################################################################
+#
+# Binary data file
+#
+##########################################################################################
+
+"""Returns the settings in a Mirador project file (config.mira) as a dictionary
+
+:param filename: name of the project file
+"""
+def read_config(filename):
+    config = {}
+    with open(filename, "r") as file:
+        for line in file:
+            line = line.strip()
+            if not line or not "=" in line: continue
+            [key, val] = line.split("=", 1)
+            config[key] = val
+    return config
+
+"""Returns the fraction of missing values above which Mirador leaves out a column, from the
+missing.threshold setting in config.mira (e.g. 0.8 for MISS_80), or None if the setting is
+not a percentage
+
+:param value: value of missing.threshold
+"""
+def missing_threshold(value):
+    if value and value.startswith("MISS_") and value[5:].isdigit():
+        return int(value[5:]) / 100.0
+    return None
+
+# Translation of the Java date patterns used in config.mira into strptime directives
+DATE_PATTERNS = [("yyyy", "%Y"), ("yy", "%y"), ("MMMM", "%B"), ("MMM", "%b"), ("MM", "%m"),
+                 ("dd", "%d"), ("d", "%d"), ("M", "%m"), ("HH", "%H"), ("mm", "%M"), ("ss", "%S")]
+
+"""Converts a Java date pattern (e.g. yyyy-MM-dd) into a strptime format (e.g. %Y-%m-%d)
+
+:param pattern: Java date pattern
+"""
+def date_format(pattern):
+    format = ""
+    i = 0
+    while i < len(pattern):
+        for java, py in DATE_PATTERNS:
+            if pattern.startswith(java, i):
+                format += py
+                i += len(java)
+                break
+        else:
+            format += pattern[i]
+            i += 1
+    return format
+
+BINARY_MAGIC = b"MIRABIN1"
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+INT_MISSING = -2**63
+DATE_MISSING = -2**31
+CODE_MISSING = -1
+
+"""Converts a numeric value into a float, also accepting single-element lists such as 
+"[0.75]", which is how the allele frequencies from the VCF files are written
+
+:param value: string to convert
+"""
+def to_float(value):
+    if value.startswith("[") and value.endswith("]"):
+        value = value[1:-1]
+    return float(value)
+
+"""Returns the list of category codes in a Mirador range string, e.g. ["1", "0"] for 
+"1:Positive;0:Negative"
+
+:param ranges: range string
+"""
+def range_codes(ranges):
+    codes = []
+    if ranges:
+        for piece in ranges.split(";"):
+            if ":" in piece: codes.append(piece.split(":")[0])
+    return codes
+
+"""Encodes the values of a column into the typed blocks stored in the binary file. Returns 
+the column entry for the header of the file and the list of blocks (one for numeric, date 
+and category columns, mask, offsets and data for string columns). Values that cannot be
+parsed as numbers or dates are stored as missing, and counted in the "invalid" entry.
+
+:param column: column in the dataset
+:param ranges: range string of the variable
+:param dformat: strptime format used to parse dates
+"""
+def encode_column(column, ranges, dformat):
+    type = column.type.lower()
+    entry = {"name": column.name, "type": type, "invalid": 0}
+    n = len(column)
+    values = [None if column.missing[i] else column.value(i) for i in range(0, n)]
+    if type == "int" or type == "float":
+        if type == "int" and column.kind == "int":
+            data = array.array("q", [INT_MISSING if column.missing[i] else column.data[i] for i in range(0, n)])
+        else:
+            data = array.array("q" if type == "int" else "d")
+            missing = INT_MISSING if type == "int" else float("nan")
+            parse = int if type == "int" else to_float
+            for value in values:
+                try:
+                    data.append(missing if value is None else parse(value))
+                except ValueError:
+                    data.append(missing)
+                    entry["invalid"] += 1
+        return entry, [data]
+    elif type == "date":
+        data = array.array("i")
+        for value in values:
+            if value is None:
+                data.append(DATE_MISSING)
+                continue
+            try:
+                date = datetime.datetime.strptime(value, dformat).date()
+                data.append(date.toordinal() - EPOCH)
+            except ValueError:
+                data.append(DATE_MISSING)
+                entry["invalid"] += 1
+        return entry, [data]
+    elif type == "category":
+        levels = range_codes(ranges)
+        index = dict((code, i) for i, code in enumerate(levels))
+        data = array.array("i")
+        for value in values:
+            if value is None:
+                data.append(CODE_MISSING)
+                continue
+            if not value in index:
+                index[value] = len(levels)
+                levels.append(value)
+            data.append(index[value])
+        entry["levels"] = levels
+        return entry, [data]
+    else:
+        mask = array.array("b", column.missing)
+        offsets = array.array("q", [0])
+        chunks = []
+        size = 0
+        for value in values:
+            if value is not None:
+                chunk = value.encode("utf-8")
+                chunks.append(chunk)
+                size += len(chunk)
+            offsets.append(size)
+        entry["type"] = "string"
+        return entry, [mask, offsets, b"".join(chunks)]
+
+"""Writes the dataset into a memory-mappable, typed, column-major binary file. The file 
+starts with an 8-byte magic string and the 8-byte length of a JSON header describing the
+columns, followed by the column blocks, each one aligned to 8 bytes:
+- int: int64 values, missing stored as -2^63
+- float: float64 values, missing stored as NaN
+- date: int32 days since 1970-01-01, missing stored as -2^31
+- category: int32 index into the list of levels of the column, missing stored as -1
+- string: int8 missing mask, int64 offsets (one more than the number of rows) and UTF-8 data
+All the values are little-endian.
+
+:param dataset: dataset to write
+:param ranges: dictionary with the range strings of the variables
+:param pattern: date pattern used in the dataset (dates.parse in config.mira)
+:param file: binary file to write into
+"""
+def write_binary(dataset, ranges, pattern, file):
+    dformat = date_format(pattern)
+    entries = []
+    blocks = []
+    offset = 0
+    for name in dataset.columns:
+        entry, cblocks = encode_column(dataset.columns[name], ranges.get(name, ""), dformat)
+        entry["blocks"] = []
+        for block in cblocks:
+            if isinstance(block, array.array):
+                if sys.byteorder != "little": block.byteswap()
+                entry["blocks"].append([offset, len(block) * block.itemsize, block.typecode])
+                offset += len(block) * block.itemsize
+            else:
+                entry["blocks"].append([offset, len(block), "B"])
+                offset += len(block)
+            blocks.append(block)
+            pad = (8 - offset % 8) % 8
+            if pad:
+                blocks.append(b"\0" * pad)
+                offset += pad
+        entries.append(entry)
+    header = json.dumps({"rows": len(dataset), "columns": entries}).encode("utf-8")
+    header += b" " * ((8 - len(header) % 8) % 8)
+    file.write(BINARY_MAGIC)
+    file.write(struct.pack("<Q", len(header)))
+    file.write(header)
+    for block in blocks:
+        if isinstance(block, array.array):
+            block.tofile(file)
+        else:
+            file.write(block)
+
+"""Memory-mapped access to the columns of a binary data file written by write_binary.
+
+:param filename: name of the binary file
+"""
+class BinaryData(object):
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[0:8] != BINARY_MAGIC:
+            raise ValueError(filename + " is not a Mirador binary data file")
+        size = struct.unpack("<Q", self.map[8:16])[0]
+        header = json.loads(self.map[16:16 + size].decode("utf-8"))
+        self.start = 16 + size
+        self.rows = header["rows"]
+        self.columns = collections.OrderedDict((entry["name"], entry) for entry in header["columns"])
+
+    def block(self, entry, i):
+        [offset, length, typecode] = entry["blocks"][i]
+        view = memoryview(self.map)[self.start + offset:self.start + offset + length]
+        if typecode == "B": return view
+        return view.cast(typecode)
+
+    """Returns the values of a numeric, date or category column as a memory view over the
+    mapped file (no copy is made), or the list of values of a string column.
+
+    :param name: variable name
+    """
+    def column(self, name):
+        entry = self.columns[name]
+        if entry["type"] != "string":
+            return self.block(entry, 0)
+        mask = self.block(entry, 0)
+        offsets = self.block(entry, 1)
+        data = self.block(entry, 2)
+        return [None if mask[i] else bytes(data[offsets[i]:offsets[i + 1]]).decode("utf-8") for i in range(0, self.rows)]
+
+    """Returns the values of a column converted back into strings as in the csv file, with
+    None for missing values.
+
+    :param name: variable name
+    """
+    def strings(self, name):
+        entry = self.columns[name]
+        values = self.column(name)
+        type = entry["type"]
+        if type == "string": return values
+        if type == "int": return [None if v == INT_MISSING else str(v) for v in values]
+        if type == "float": return [None if math.isnan(v) else repr(v) for v in values]
+        if type == "date": return [None if v == DATE_MISSING else format_date(v + EPOCH) for v in values]
+        levels = entry["levels"]
+        return [None if v == CODE_MISSING else levels[v] for v in values]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+##########################################################################################
+#
+# Sparse matrix
+#
+##########################################################################################
+
+SPARSE_MAGIC = b"MIRASPM1"
+
+"""Sparse matrix with a row per patient and a column per site, in compressed sparse row 
+(CSR) form: the column indices and values of the non-zero entries of all the rows are 
+stored one row after the other in two typed arrays, together with the offset where each
+row starts. Missing entries are stored as NaN, so they are kept apart from the zeros.
+
+The matrix is built from its non-zero entries given in any order (coordinate form), e.g.
+as they are read column by column from a file.
+
+:param ids: id of each row
+:param sites: dictionary describing each column
+:param rows: row of each entry
+:param cols: column of each entry
+:param values: value of each entry
+"""
+class SparseMatrix(object):
+    def __init__(self, ids, sites, rows, cols, values):
+        self.ids = list(ids)
+        self.sites = list(sites)
+        # Counting sort of the entries by row, keeping the order of the columns in each row
+        counts = [0] * (len(self.ids) + 1)
+        for r in rows: counts[r + 1] += 1
+        for i in range(0, len(self.ids)): counts[i + 1] += counts[i]
+        self.offsets = array.array("q", counts)
+        self.indices = array.array("i", [0]) * len(values)
+        self.values = array.array("d", [0.0]) * len(values)
+        starts = counts[:-1]
+        for r, c, v in zip(rows, cols, values):
+            k = starts[r]
+            self.indices[k] = c
+            self.values[k] = v
+            starts[r] = k + 1
+
+    def __len__(self):
+        return len(self.ids)
+
+    """Returns the column indices and the values of the non-zero entries of the i-th row, as
+    views into the arrays
+    """
+    def row(self, i):
+        start = self.offsets[i]
+        end = self.offsets[i + 1]
+        return memoryview(self.indices)[start:end], memoryview(self.values)[start:end]
+
+    """Returns a dictionary per requested column with the non-zero values by row
+
+    :param cols: indices of the columns
+    """
+    def columns(self, cols):
+        result = dict((c, {}) for c in cols)
+        for i in range(0, len(self.ids)):
+            [indices, values] = self.row(i)
+            for c, v in zip(indices, values):
+                if c in result: result[c][i] = v
+        return result
+
+    """Returns the largest non-missing value of each column, 0 for columns without entries
+    """
+    def column_max(self):
+        maxs = [0.0] * len(self.sites)
+        for c, v in zip(self.indices, self.values):
+            if maxs[c] < v: maxs[c] = v
+        return maxs
+
+"""Writes a sparse matrix into a memory-mappable binary file, with the same layout as the 
+binary data file (see write_binary): an 8-byte magic string, the 8-byte length of a JSON 
+header with the row ids, the columns and the number of non-zero entries, and three blocks
+aligned to 8 bytes: int64 row offsets (one more than the number of rows), int32 column 
+indices and float64 values. All the values are little-endian.
+
+:param matrix: sparse matrix to write
+:param file: binary file to write into
+"""
+def write_sparse(matrix, file):
+    blocks = [matrix.offsets, matrix.indices, matrix.values]
+    entries = []
+    offset = 0
+    for block in blocks:
+        entries.append([offset, len(block) * block.itemsize, block.typecode])
+        offset += len(block) * block.itemsize
+        offset += (8 - offset % 8) % 8
+    header = json.dumps({"ids": matrix.ids, "sites": matrix.sites, "nnz": len(matrix.values), "blocks": entries}).encode("utf-8")
+    header += b" " * ((8 - len(header) % 8) % 8)
+    file.write(SPARSE_MAGIC)
+    file.write(struct.pack("<Q", len(header)))
+    file.write(header)
+    for block in blocks:
+        if sys.byteorder != "little":
+            block = array.array(block.typecode, block)
+            block.byteswap()
+        block.tofile(file)
+        size = len(block) * block.itemsize
+        if size % 8: file.write(b"\0" * (8 - size % 8))
+
+"""Memory-mapped access to the rows of a sparse matrix file written by write_sparse.
+
+:param filename: name of the sparse matrix file
+"""
+class SparseData(object):
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[0:8] != SPARSE_MAGIC:
+            raise ValueError(filename + " is not a Mirador sparse matrix file")
+        size = struct.unpack("<Q", self.map[8:16])[0]
+        header = json.loads(self.map[16:16 + size].decode("utf-8"))
+        start = 16 + size
+        self.ids = header["ids"]
+        self.rows = dict((id, i) for i, id in enumerate(self.ids))
+        self.sites = header["sites"]
+        [self.offsets, self.indices, self.values] = [memoryview(self.map)[start + offset:start + offset + length].cast(typecode) for [offset, length, typecode] in header["blocks"]]
+
+    """Returns the list of [site, value] of the non-zero entries of a patient, an empty list 
+    if the patient is not in the matrix
+
+    :param id: patient id (GID)
+    """
+    def row(self, id):
+        if id not in self.rows: return []
+        i = self.rows[id]
+        return [[self.sites[self.indices[k]], self.values[k]] for k in range(self.offsets[i], self.offsets[i + 1])]
+
+    def close(self):
+        self.offsets.release()
+        self.indices.release()
+        self.values.release()
+        self.map.close()
+        self.file.close()
+
+##########################################################################################
+#
+# Row index
+#
+##########################################################################################
+
+"""Writes the header and the rows of the dataset into a csv file, returns the array with the 
+byte offset of each row in the file, followed by the size of the file. Rows can also be
+appended at the end of an existing file, without the header.
+
+:param file: csv file, opened for writing
+:param names: variable names, None to not write the header
+:param rows: iterable with the rows of the dataset
+:param offset: size of the file before writing, when appending to it
+"""
+def write_csv(file, names, rows, offset=0):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, dialect="excel")
+    def flush():
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        file.write(line)
+        return len(line.encode("utf-8"))
+    if names is not None:
+        writer.writerow(names)
+        offset += flush()
+    offsets = array.array("q")
+    for row in rows:
+        offsets.append(offset)
+        writer.writerow(row)
+        offset += flush()
+    offsets.append(offset)
+    return offsets
+
+"""Returns the width of the keys in a table of entries sorted by key (see KeyTable): the 
+length of the longest key in UTF-8, rounded up to a multiple of 8
+
+:param keys: keys of the table as bytes
+"""
+def key_width(keys):
+    width = max([len(key) for key in keys] + [1])
+    return width + (8 - width % 8) % 8
+
+"""Returns the bytes of a table of entries sorted by key (see KeyTable)
+
+:param entries: dictionary with the int64 values of the entry of each key, keys as bytes
+:param width: width of the keys
+"""
+def pack_keys(entries, width):
+    return b"".join(key.ljust(width, b"\0") + struct.pack("<" + str(len(entries[key])) + "q", *entries[key]) for key in sorted(entries))
+
+"""Table of fixed-width entries sorted by the UTF-8 bytes of their keys, stored in a 
+memory-mapped file, so an entry is found with a binary search without reading the table. 
+Each entry has the key padded with zeros to the width of the table, followed by a number of 
+int64 values. The row index (data.idx) and the patient store (see patientindex.py) use it to 
+find the rows or records of the patients by GID.
+
+:param buffer: memory-mapped file
+:param start: position of the table in the file
+:param count: number of entries
+:param width: width of the keys, a multiple of 8 (see key_width)
+:param nvalues: number of values in each entry
+"""
+class KeyTable(object):
+    def __init__(self, buffer, start, count, width, nvalues):
+        self.buffer = buffer
+        self.start = start
+        self.count = count
+        self.width = width
+        self.nvalues = nvalues
+        self.size = width + 8 * nvalues
+        self.format = "<" + str(nvalues) + "q"
+
+    def __len__(self):
+        return self.count
+
+    """Returns the position of the entry of a key, or where it would be inserted, and true if 
+    the key is in the table
+
+    :param key: key as bytes
+    """
+    def search(self, key):
+        if self.width < len(key): key = key[:self.width] + b"\1"
+        key = key.ljust(self.width, b"\0")
+        low = 0
+        high = self.count
+        while low < high:
+            mid = (low + high) // 2
+            pos = self.start + mid * self.size
+            entry = self.buffer[pos:pos + self.width]
+            if entry < key:
+                low = mid + 1
+            elif key < entry:
+                high = mid
+            else:
+                return [mid, True]
+        return [low, False]
+
+    """Returns the values of the entry of a key, None if the key is not in the table
+
+    :param key: key as a string
+    """
+    def find(self, key):
+        [i, found] = self.search(key.encode("utf-8"))
+        return self.values(i) if found else None
+
+    def key(self, i):
+        pos = self.start + i * self.size
+        return self.buffer[pos:pos + self.width].rstrip(b"\0").decode("utf-8")
+
+    def values(self, i):
+        return struct.unpack_from(self.format, self.buffer, self.start + i * self.size + self.width)
+
+    """Returns the width, number of entries and bytes of a new table with the entries of this 
+    table and the given entries, which replace the entries with the same key. The entries 
+    that are not replaced are copied as bytes, so only the given entries are encoded.
+
+    :param entries: dictionary with the values of the entry of each key, keys as strings
+    """
+    def merge(self, entries):
+        entries = dict((key.encode("utf-8"), entries[key]) for key in entries)
+        width = max(self.width, key_width(entries))
+        if width != self.width:
+            # Longer keys, all the entries need to be padded again
+            table = dict((self.key(i).encode("utf-8"), self.values(i)) for i in range(0, self.count))
+            table.update(entries)
+            return [width, len(table), pack_keys(table, width)]
+        parts = []
+        last = 0
+        count = self.count
+        for key in sorted(entries):
+            [i, found] = self.search(key)
+            parts.append(self.buffer[self.start + last * self.size:self.start + i * self.size])
+            parts.append(pack_keys({key: entries[key]}, width))
+            last = i + 1 if found else i
+            if not found: count += 1
+        parts.append(self.buffer[self.start + last * self.size:self.start + self.count * self.size])
+        return [width, count, b"".join(parts)]
+
+INDEX_MAGIC = b"MIRAIDX1"
+
+"""Writes the row index of a csv data file: the position of each column in the header and the 
+byte offsets of the row of each patient, as returned by write_csv. The file starts with an 
+8-byte magic string and the 8-byte length of a JSON header (data file, its size, number of 
+rows, width of the ids and variable names), followed by the int64 offsets of the rows and the 
+table of ids with the number of the row of each id (see KeyTable). All the values are 
+little-endian.
+
+:param file: index file, opened for writing in binary mode
+:param data_filename: name of the csv data file
+:param names: variable names
+:param ids: patient ids, in the order of the rows
+:param offsets: byte offsets of the rows followed by the size of the file
+:param table: width, number of entries and bytes of the table of ids, when it was already 
+              built from the table of an earlier index (see append_index)
+"""
+def write_index(file, data_filename, names, ids, offsets, table=None):
+    if table is None:
+        keys = [id.encode("utf-8") for id in ids]
+        width = key_width(keys)
+        table = [width, len(keys), pack_keys(dict((key, [i]) for i, key in enumerate(keys)), width)]
+    header = json.dumps({"data": os.path.basename(data_filename),
+                         "size": offsets[-1],
+                         "rows": table[1],
+                         "width": table[0],
+                         "columns": list(names)}).encode("utf-8")
+    header += b" " * ((8 - len(header) % 8) % 8)
+    file.write(INDEX_MAGIC)
+    file.write(struct.pack("<Q", len(header)))
+    file.write(header)
+    offsets = array.array("q", offsets)
+    if sys.byteorder != "little": offsets.byteswap()
+    offsets.tofile(file)
+    file.write(table[2])
+
+"""Writes the row index of a csv data file after rows were appended to it, from the index of
+the file before appending them. Only the entries of the appended rows are added to the table
+of ids, the rest of the index is copied.
+
+:param file: index file, opened for writing in binary mode
+:param index: index of the data file before appending the rows (see DataIndex)
+:param ids: patient ids of the appended rows, which must not be in the index
+:param offsets: byte offsets of the appended rows followed by the size of the file
+"""
+def append_index(file, index, ids, offsets):
+    table = index.table.merge(dict((id, [len(index) + i]) for i, id in enumerate(ids)))
+    all_offsets = array.array("q", index.offsets[:-1])
+    all_offsets.extend(offsets)
+    write_index(file, index.data_filename, index.names, None, all_offsets, table)
+
+"""Random access to the rows of a Mirador data file using its row index (data.idx), so the 
+row of a patient is read with a single seek, and only the columns up to the last requested 
+one are parsed. The index is memory-mapped and the ids are found with a binary search in its
+table of ids, so opening the index does not depend on the number of rows.
+
+:param folder: folder of the Mirador dataset
+"""
+class DataIndex(object):
+    def __init__(self, folder):
+        config = read_config(os.path.join(folder, "config.mira"))
+        self.data_filename = os.path.join(folder, config.get("data.source", "data.csv"))
+        self.index_file = open(os.path.join(folder, INDEX_NAME), "rb")
+        self.map = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[0:8] != INDEX_MAGIC:
+            raise ValueError("The row index of " + self.data_filename + " is out of date")
+        size = struct.unpack("<Q", self.map[8:16])[0]
+        header = json.loads(self.map[16:16 + size].decode("utf-8"))
+        if os.path.getsize(self.data_filename) != header["size"]:
+            raise ValueError("The row index of " + self.data_filename + " is out of date")
+        self.names = header["columns"]
+        self.columns = dict((name, i) for i, name in enumerate(self.names))
+        count = header["rows"]
+        start = 16 + size
+        self.offsets = memoryview(self.map)[start:start + 8 * (count + 1)].cast("q")
+        self.table = KeyTable(self.map, start + 8 * (count + 1), count, header["width"], 1)
+        self.file = open(self.data_filename, "rb")
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, id):
+        return self.find(id) is not None
+
+    """Returns the number of the row of a patient in the data file, None if the patient is not 
+    in the file
+
+    :param id: patient id (GID)
+    """
+    def find(self, id):
+        values = self.table.find(id)
+        return values[0] if values else None
+
+    """Returns the list of patient ids in the order of the rows
+    """
+    def ids(self):
+        ids = [None] * len(self.table)
+        for i in range(0, len(self.table)):
+            ids[self.table.values(i)[0]] = self.table.key(i)
+        return ids
+
+    """Returns the values of a patient in the first count columns of the data file
+    
+    :param id: patient id (GID)
+    :param count: number of columns to return, all the columns if not provided
+    """
+    def row(self, id, count=None):
+        i = self.find(id)
+        if i is None: raise KeyError(id)
+        self.file.seek(self.offsets[i])
+        line = self.file.read(self.offsets[i + 1] - self.offsets[i]).decode("utf-8")
+        if count is None: count = len(self.names)
+        if '"' in line:
+            values = next(csv.reader([line]))
+        else:
+            values = line.rstrip("\r\n").split(",", count)
+        if values[0] != id:
+            raise ValueError("The row index of " + self.data_filename + " is out of date")
+        return values[:count]
+
+    """Returns the values of a patient in the given columns
+
+    :param id: patient id (GID)
+    :param names: variable names
+    """
+    def values(self, id, names):
+        positions = [self.columns[name] for name in names]
+        row = self.row(id, max(positions) + 1 if positions else 1)
+        return [row[k] for k in positions]
+
+    def close(self):
+        self.offsets.release()
+        self.map.close()
+        self.index_file.close()
+        self.file.close()
+
+"""Returns the number of values in a binary data file that do not match the values in the 
+csv data file of the Mirador dataset. Numbers are compared by value, and dates after parsing
+them with the date pattern of the dataset.
+
+:param folder: folder of the Mirador dataset
+"""
+def check_binary(folder):
+    config = read_config(os.path.join(folder, "config.mira"))
+    dformat = date_format(config.get("dates.parse", "yyyy-MM-dd"))
+    miss = config.get("missing.string", MISSING)
+    bdata = BinaryData(os.path.join(folder, BINARY_NAME))
+    mismatches = 0
+    with open(os.path.join(folder, config["data.source"]), "r") as file:
+        reader = csv.reader(file)
+        names = next(reader)
+        columns = [bdata.strings(name) for name in names]
+        types = [bdata.columns[name]["type"] for name in names]
+        nrows = 0
+        for r, row in enumerate(reader):
+            nrows += 1
+            for c in range(0, len(names)):
+                value = None if row[c] == miss or row[c] == "" else row[c]
+                stored = columns[c][r]
+                if value is None or stored is None:
+                    same = value is None and stored is None
+                elif types[c] == "int" or types[c] == "float":
+                    same = to_float(value) == float(stored)
+                elif types[c] == "date":
+                    same = datetime.datetime.strptime(value, dformat).date().isoformat() == stored
+                else:
+                    same = value == stored
+                if not same:
+                    mismatches += 1
+                    print("  Mismatch in row " + str(r + 1) + ", column " + names[c] + ": '" + row[c] + "' vs '" + str(stored) + "'")
+    if nrows != bdata.rows:
+        print("  Number of rows is different: " + str(nrows) + " vs " + str(bdata.rows))
+        mismatches += 1
+    bdata.close()
+    return mismatches
+
+if __name__ == "__main__":
+    # Round-trip check of the binary data file against data.csv: python miradata.py -check mirador
+    folder = "mirador"
+    for i in range(1, len(sys.argv)):
+        if sys.argv[i] == "-check" and i + 1 < len(sys.argv): folder = sys.argv[i + 1]
+    print("Checking binary data file in " + folder + "...")
+    count = check_binary(folder)
+    if count:
+        print("Found " + str(count) + " mismatches.")
+        sys.exit(1)
+    print("Done.")
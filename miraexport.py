@@ -0,0 +1,257 @@
+"""
+This module exports a Mirador dataset into other formats in a single pass: the project file
+and dictionary are parsed once, and each row of the data file is read once and streamed to
+any number of sinks, each one writing a different output (decoded CSV, CSV with a SPSS
+control card, SPSS system file, or sinks provided by other modules).
+
+A sink is an object with the following methods:
+- open(project): called before reading the data, with the parsed Project
+- write_row(row): called for each row of the data file, with the list of values
+- close(): called after the last row
+
+@copyright: Harvard University 2014-15
+"""
+
+import os, csv, importlib
+import miradata, savwriter, buildcache
+
+"""Returns the variable names, types and dictionary of category codes and labels of each
+variable in the dictionary file of a Mirador dataset
+
+:param filename: name of the dictionary file
+"""
+def read_dictionary(filename):
+    long_names = []
+    var_types = []
+    code_dict = []
+    with open(filename, "r") as dict_file:
+        reader = csv.reader(dict_file)
+        for row in reader:
+            name = row[0]
+            long_names.append(name)
+            type = row[1]
+            var_types.append(type)
+            codes = {}
+            if type.lower() == "category" and 2 < len(row):
+                pieces = row[2].split(";")
+                for piece in pieces:
+                    parts = piece.split(":")
+                    codes[parts[0]] = parts[1]
+            code_dict.append(codes)
+    return [long_names, var_types, code_dict]
+
+"""Returns the parsed-result cache used to read the project and dictionary files, the cached 
+results are invalidated when the code of this module changes.
+
+:param folder: cache folder
+:param max_size: size limit of the cache in MB
+"""
+def open_cache(folder=".cache", max_size=buildcache.CACHE_SIZE):
+    version = "".join(buildcache.file_hash(fn) for fn in [__file__, miradata.__file__])
+    return buildcache.ResultCache(folder, version, max_size)
+
+"""Metadata of a Mirador dataset: project settings, variable names, labels, types and
+category codes. When a cache is given, the parsed project and dictionary files are read 
+from the cache if they did not change.
+
+:param folder: folder of the Mirador dataset
+:param cache: buildcache.ResultCache for the parsed files
+"""
+class Project(object):
+    def __init__(self, folder, cache=None):
+        self.folder = folder
+        config_filename = os.path.join(folder, "config.mira")
+        if cache: self.config = cache.call(miradata.read_config, config_filename)
+        else: self.config = miradata.read_config(config_filename)
+        self.miss_str = self.config.get("missing.string", "\\N")
+        self.date_pattern = self.config.get("dates.parse", "yyyy-MM-dd")
+        self.data_filename = os.path.join(folder, self.config.get("data.source", ""))
+        self.dict_filename = os.path.join(folder, self.config.get("data.dictionary", ""))
+
+        with open(self.data_filename, "r") as data_file:
+            self.short_names = next(csv.reader(data_file))
+
+        if cache: [self.long_names, self.var_types, self.code_dict] = cache.call(read_dictionary, self.dict_filename)
+        else: [self.long_names, self.var_types, self.code_dict] = read_dictionary(self.dict_filename)
+        if cache: cache.save()
+
+"""Creates the folder of an output file if it does not exist
+
+:param filename: name of the output file
+"""
+def make_folder(filename):
+    out_folder = os.path.split(filename)[0]
+    if out_folder and not os.path.exists(out_folder): os.makedirs(out_folder)
+
+"""Returns a function that decodes the values of a column: category codes are replaced by
+their labels, and missing values by the missing string of the output file.
+
+:param type: variable type
+:param codes: dictionary of category codes and labels
+:param miss_src: missing string in the Mirador dataset
+:param miss_dst: missing string in the output file
+"""
+def make_decoder(type, codes, miss_src, miss_dst):
+    if type == "category" and codes:
+        def decode(value):
+            value = codes.get(value, value)
+            return miss_dst if value == miss_src else value
+    else:
+        def decode(value):
+            return miss_dst if value == miss_src else value
+    return decode
+
+"""Sink writing a single CSV file with the long variable names in the header, category
+labels instead of codes, and a custom missing string.
+
+:param filename: name of the csv file
+:param miss_dst: missing string in the output file
+"""
+class CSVSink(object):
+    def __init__(self, filename, miss_dst=""):
+        self.filename = filename
+        self.miss_dst = miss_dst
+
+    def open(self, project):
+        make_folder(self.filename)
+        self.decoders = [make_decoder(project.var_types[i], project.code_dict[i], project.miss_str, self.miss_dst) for i in range(0, len(project.var_types))]
+        self.file = open(self.filename, "w")
+        self.writer = csv.writer(self.file, dialect="excel")
+        self.writer.writerow(project.long_names)
+
+    def write_row(self, row):
+        self.writer.writerow([decode(value) for decode, value in zip(self.decoders, row)])
+
+    def close(self):
+        self.file.close()
+
+def spss_type(mtype):
+    if mtype == "int": return "F"
+    elif mtype == "float": return "f"
+    elif mtype == "date": return "DATE"
+    else: return "A"
+
+"""Sink writing a copy of the data file together with a SPSS control card (same name with
+the .spss extension) holding the metadata.
+
+:param filename: name of the csv file
+"""
+class SPSSCardSink(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+    def open(self, project):
+        make_folder(self.filename)
+        self.project = project
+        self.file = open(self.filename, "w")
+        self.writer = csv.writer(self.file, dialect="excel")
+        self.writer.writerow(project.short_names)
+
+    def write_row(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+        out_folder, out_name = os.path.split(self.filename)
+        spss_name = os.path.join(out_folder, out_name.replace(".csv", ".spss"))
+        self.write_card(spss_name)
+
+    def write_card(self, spss_name):
+        short_names = self.project.short_names
+        long_names = self.project.long_names
+        var_types = self.project.var_types
+        code_dict = self.project.code_dict
+        miss_str = self.project.miss_str
+        count = len(short_names)
+        with open(spss_name, "w") as spss_file:
+            spss_file.write("DATA LIST LIST(',') /\n")
+
+            # Variable types
+            for i in range(0, count):
+                spss_file.write("  " + short_names[i] + " " + "(" + spss_type(var_types[i]) + ")" + "\n")
+            spss_file.write("  .\n")
+
+            # Variable labels
+            spss_file.write("VARIABLE LABELS\n")
+            for i in range(0, count):
+                spss_file.write('  ' + short_names[i] + ' "' + long_names[i] + '"\n')
+            spss_file.write("  .\n")
+
+            # Value labels
+            spss_file.write("VALUE labels\n")
+            for i in range(0, count):
+                if var_types[i] == "category" and code_dict[i]:
+                    spss_file.write("  " + short_names[i] + " ")
+                    for key in code_dict[i]:
+                        spss_file.write('  ' + key + ' "' + code_dict[i][key] + '"\n')
+                    spss_file.write("  /\n")
+            spss_file.write("  .\n")
+            # Missing values
+            spss_file.write("MISSING VALUES\n")
+            for i in range(0, count):
+                spss_file.write("  " + short_names[i] + "(" + miss_str + ")" + "\n")
+            spss_file.write("  .\n")
+
+"""Sink writing a SPSS system file (.sav)
+
+:param filename: name of the sav file
+"""
+class SavSink(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+    def open(self, project):
+        self.writer = savwriter.SavWriter(self.filename, project.short_names, project.long_names, project.var_types,
+                                          project.code_dict, project.miss_str, project.date_pattern)
+
+    def write_row(self, row):
+        self.writer.add_row(row)
+
+    def close(self):
+        self.writer.close()
+
+"""Registered sinks, by the name of the command line argument that selects them
+"""
+SINKS = {"csv": CSVSink, "spss": SPSSCardSink, "sav": SavSink}
+
+"""Registers a sink class so it can be selected by name
+
+:param name: name of the sink
+:param sink_class: class of the sink, it is created with the output filename as argument
+"""
+def register_sink(name, sink_class):
+    SINKS[name] = sink_class
+
+"""Returns a sink provided by another module, given as module.Class:filename
+
+:param spec: module, class and output filename of the sink
+"""
+def load_plugin(spec):
+    [path, filename] = spec.split(":", 1)
+    [module_name, class_name] = path.rsplit(".", 1)
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)(filename)
+
+"""Reads the Mirador dataset once, streaming each row to all the sinks. Returns the number of
+rows exported.
+
+:param folder: folder of the Mirador dataset
+:param sinks: list of sinks
+:param project: parsed Project, read from the folder if not provided
+"""
+def export(folder, sinks, project=None):
+    if project is None:
+        project = Project(folder)
+    for sink in sinks:
+        sink.open(project)
+    count = 0
+    with open(project.data_filename, "r") as data_file:
+        reader = csv.reader(data_file)
+        next(reader)
+        for row in reader:
+            for sink in sinks:
+                sink.write_row(row)
+            count += 1
+    for sink in sinks:
+        sink.close()
+    return count
@@ -0,0 +1,121 @@
+"""
+This module records the wall time, CPU time, peak memory, rows in/out and bytes written of
+each stage of the scripts that build and export the Mirador dataset (makemira.py, makecsv.py
+and makespss.py), when they are run with the -profile argument. The results are printed at
+the end and saved into a JSON report, and a cProfile dump can also be saved for each stage
+so slow stages can be inspected with pstats or snakeviz.
+
+Stages are run one after the other, so they should not be nested. When profiling is not
+enabled the stages only run their code.
+
+@copyright: Harvard University 2014-15
+"""
+
+import os, sys, re, time, json, resource, tracemalloc, cProfile
+
+"""A stage of the script, the code inside the stage can set the number of rows it read and
+produced.
+
+:param name: name of the stage
+:param rows_in: number of input rows
+:param outputs: list of files written in the stage
+"""
+class Stage(object):
+    def __init__(self, name, rows_in=None, outputs=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.outputs = outputs if outputs else []
+
+"""Profiler of the stages of a script.
+
+:param report: name of the JSON report, profiling is disabled if not provided
+:param dump_folder: folder where the cProfile dump of each stage is saved
+"""
+class Profiler(object):
+    def __init__(self, report=None, dump_folder=None):
+        self.report = report
+        self.dump_folder = dump_folder
+        self.enabled = report is not None or dump_folder is not None
+        self.stages = []
+        self.current = None
+        if self.enabled:
+            tracemalloc.start()
+            self.start_wall = time.time()
+            self.start_cpu = time.process_time()
+
+    """Returns a context manager that runs and profiles a stage, e.g.:
+
+    with profiler.stage("load_master", len(rows)) as stage:
+        load_master(rows)
+        stage.rows_out = len(src_data)
+
+    :param name: name of the stage
+    :param rows_in: number of input rows
+    :param outputs: list of files written in the stage, their size is reported
+    """
+    def stage(self, name, rows_in=None, outputs=None):
+        self.current = Stage(name, rows_in, outputs)
+        return self
+
+    def __enter__(self):
+        stage = self.current
+        if self.enabled:
+            tracemalloc.reset_peak()
+            stage.base_mem = tracemalloc.get_traced_memory()[0]
+            if self.dump_folder:
+                stage.cprofile = cProfile.Profile()
+                stage.cprofile.enable()
+            stage.wall = time.time()
+            stage.cpu = time.process_time()
+        return stage
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stage = self.current
+        self.current = None
+        if not self.enabled or exc_type is not None: return False
+        wall = time.time() - stage.wall
+        cpu = time.process_time() - stage.cpu
+        if self.dump_folder:
+            stage.cprofile.disable()
+            if not os.path.exists(self.dump_folder): os.makedirs(self.dump_folder)
+            stage.cprofile.dump_stats(os.path.join(self.dump_folder, str(len(self.stages) + 1).zfill(2) + "-" + re.sub("[^A-Za-z0-9_.-]", "_", stage.name) + ".prof"))
+        [current, peak] = tracemalloc.get_traced_memory()
+        self.stages.append({"name": stage.name,
+                            "wall_time": wall,
+                            "cpu_time": cpu,
+                            "peak_mb": (peak - stage.base_mem) / (1024.0 * 1024.0),
+                            "retained_mb": (current - stage.base_mem) / (1024.0 * 1024.0),
+                            "rows_in": stage.rows_in,
+                            "rows_out": stage.rows_out,
+                            "bytes_written": sum(os.path.getsize(fn) for fn in stage.outputs if os.path.isfile(fn))})
+        return False
+
+    """Prints the results and saves the report, if profiling is enabled.
+    """
+    def save(self):
+        if not self.enabled: return
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        if sys.platform == "darwin": peak = peak / 1024.0
+        results = {"script": os.path.basename(sys.argv[0]),
+                   "args": sys.argv[1:],
+                   "wall_time": time.time() - self.start_wall,
+                   "cpu_time": time.process_time() - self.start_cpu,
+                   "max_rss_mb": peak,
+                   "stages": self.stages}
+        tracemalloc.stop()
+        width = max([len(stage["name"]) for stage in self.stages] + [20]) + 2
+        print("Profile:")
+        print("  " + "stage".ljust(width) + "wall (s)".rjust(10) + "cpu (s)".rjust(10) + "peak (MB)".rjust(11) + "rows in".rjust(10) + "rows out".rjust(10) + "bytes".rjust(12))
+        for stage in self.stages:
+            rows_in = "" if stage["rows_in"] is None else str(stage["rows_in"])
+            rows_out = "" if stage["rows_out"] is None else str(stage["rows_out"])
+            print("  " + stage["name"].ljust(width) + "%10.3f" % stage["wall_time"] + "%10.3f" % stage["cpu_time"] + "%11.2f" % stage["peak_mb"] +
+                  rows_in.rjust(10) + rows_out.rjust(10) + str(stage["bytes_written"]).rjust(12))
+        print("  " + "total".ljust(width) + "%10.3f" % results["wall_time"] + "%10.3f" % results["cpu_time"] + "%11.2f" % peak)
+        if self.report:
+            out_folder = os.path.split(self.report)[0]
+            if out_folder and not os.path.exists(out_folder): os.makedirs(out_folder)
+            with open(self.report, "w") as file:
+                json.dump(results, file, indent=1)
+            print("  Report saved to " + self.report)
@@ -0,0 +1,53 @@
+"""
+This script reads the values of selected patients and variables from a Mirador dataset, using
+the row index saved by makemira.py (data.idx) to seek directly to the row of each patient, 
+so the time per lookup does not depend on the size of the data file. The results are written
+as csv to the standard output, or to the file given with -out.
+
+-in <folder>: folder of the Mirador dataset
+-id <GID,...>: comma-separated list of patient IDs
+-ids <file>: file with one patient ID per line
+-cols <name,...>: comma-separated list of variables, all the variables if not provided
+-out <file>: output csv file
+
+Example:
+python miraquery.py -in mirador -id X-7028,X-7031 -cols OUT,PCR_MAX
+
+@copyright: Harvard University 2014-15
+"""
+
+import sys, csv
+import miradata
+
+mirador_folder = "mirador"
+ids = []
+columns = None
+output_name = None
+
+for i in range(1, len(sys.argv)):
+    arg = sys.argv[i]
+    if arg == "-in": mirador_folder = sys.argv[i + 1]
+    elif arg == "-id": ids.extend(sys.argv[i + 1].split(","))
+    elif arg == "-ids":
+        with open(sys.argv[i + 1], "r") as file:
+            ids.extend([line.strip() for line in file if line.strip()])
+    elif arg == "-cols": columns = sys.argv[i + 1].split(",")
+    elif arg == "-out": output_name = sys.argv[i + 1]
+
+index = miradata.DataIndex(mirador_folder)
+if columns is None: columns = index.names
+unknown = [name for name in columns if not name in index.columns]
+if unknown:
+    sys.stderr.write("Unknown variables: " + ", ".join(unknown) + "\n")
+    sys.exit(1)
+
+output = open(output_name, "w") if output_name else sys.stdout
+writer = csv.writer(output, dialect="excel")
+writer.writerow(["GID"] + columns)
+for id in ids:
+    if not id in index:
+        sys.stderr.write("Patient " + id + " not found\n")
+        continue
+    writer.writerow([id] + index.values(id, columns))
+if output_name: output.close()
+index.close()
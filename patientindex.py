@@ -0,0 +1,349 @@
+"""
+This module holds the index of the patients in the Ebola dataset, keyed by their GID, which
+the source tables are merged into. Each source is merged with a hash join: its rows are
+grouped by patient ID in a single pass, and each group is then merged into the record of
+the patient with one lookup, so the cost is linear in the number of rows regardless of the
+size of the ignore list or the number of patients. The index also keeps, for each source,
+the IDs that do not match any patient (orphans) and the IDs that appear more than once in
+sources with one row per patient (duplicates).
+
+Each patient is held in a compact Patient record that only keeps the values used in the 
+aggregation, and the index has a pool of the strings of the qPCR and Piccolo series, which
+the records store as integer codes.
+
+The records are saved into a patient store (see PatientIndex.save), so new rows can be merged
+later without parsing the sources again. Each record is stored separately, and the store has
+a table of the records sorted by GID, so ingesting new rows only reads and writes the records
+of the patients in the new rows (see PatientStore).
+
+The IDs of the sequencing samples (e.g. X7028) are normalized into GIDs (X-7028) with a bounded
+LRU cache, so each distinct sample name is normalized only once. The cache is cleared at the 
+start of each build (see makemira.Builder.clear).
+
+@copyright: Harvard University 2014-15
+"""
+
+import sys, os, re, json, mmap, struct, array, pickle, functools, collections
+import buildcache
+import miradata
+
+DIGIT = re.compile(r"\d")
+STORE_MAGIC = b"MIRAPAT1"
+# Fraction of the patient store taken by replaced records over which the store is rewritten
+STORE_MAX_DEAD = 0.5
+
+"""Returns the GID corresponding to the ID of a sequencing sample, by adding a dash before
+the first digit (e.g. X7028 -> X-7028)
+
+:param id: sample ID
+"""
+@functools.lru_cache(maxsize=1 << 16)
+def normalize_id(id):
+    res = DIGIT.search(id)
+    if res:
+        pos = res.start()
+        new_id = id[:pos] + '-' + id[pos:]
+    else:
+        print("  Warning: patient ID is malformed: " + id)
+        new_id = id
+    return new_id
+
+"""Returns the values of the given columns of a row as a tuple of interned strings, so the
+values repeated across patients (e.g. the categories of the demographics and clinical 
+tables) are stored only once.
+
+:param row: row of a source table
+:param columns: indices of the columns to keep
+"""
+def select_columns(row, columns):
+    return tuple([sys.intern(row[col]) for col in columns])
+
+"""Record of a patient. The values are kept in slots instead of a dictionary: the group, 
+outcome and sex are interned strings, the demographics and case notification rows are 
+reduced to the columns used by the dictionaries (see select_columns), and the qPCR and 
+Piccolo series are typed arrays. The dates of the qPCR samples and the values of the panels
+are codes of the string pool of the index, the viral loads are floats (NaN when missing).
+The panels of a patient are stored one after the other, each one taking as many codes as
+the columns kept from the Piccolo table.
+
+:param group: diagnosis group of the patient (Epos or Eneg)
+"""
+class Patient(object):
+    __slots__ = ["group", "outcome", "sex", "demo", "case", "qpcr_dates", "qpcr_loads", "pico", "pcr", "pico_flags"]
+
+    def __init__(self, group):
+        self.group = sys.intern(group)
+        self.outcome = None
+        self.sex = None
+        self.demo = None
+        self.case = None
+        self.qpcr_dates = array.array("i")
+        self.qpcr_loads = array.array("d")
+        self.pico = None
+        self.pcr = None
+        self.pico_flags = None
+
+"""Index of patients, with a record per patient in the order they were added.
+
+:param ignore: list of patient IDs to leave out of the index
+"""
+class PatientIndex(object):
+    def __init__(self, ignore=None):
+        self.ignore = set(ignore) if ignore else set()
+        self.records = collections.OrderedDict()
+        self.sources = collections.OrderedDict()
+        self.pool = miradata.StringPool()
+
+    def __len__(self):
+        return len(self.records)
+
+    """Merges the rows of a source into the index. The rows are grouped by ID, then merge is
+    called with the record of the patient and each of the rows with its ID, in the order of
+    the source. Rows of patients that are not in the index are counted as orphans, unless
+    create is given, in which case a new record is created by calling create with the first
+    row of the patient.
+
+    :param source: name of the source
+    :param rows: rows of the source
+    :param key: column holding the patient ID
+    :param merge: function adding a row to the record of a patient
+    :param create: function returning a new record from the first row of a patient
+    :param accept: function returning true for the rows that should be merged
+    :param unique: true if the source should have a single row per patient
+    """
+    def join(self, source, rows, key, merge, create=None, accept=None, unique=True):
+        table = collections.OrderedDict()
+        for row in rows:
+            if accept is not None and not accept(row): continue
+            id = row[key]
+            if id in table:
+                table[id].append(row)
+            else:
+                table[id] = [row]
+        stats = {"rows": len(rows), "matched": 0, "ignored": [], "orphans": [], "duplicates": []}
+        for id in table:
+            group = table[id]
+            if unique and 1 < len(group): stats["duplicates"].append(id)
+            if id in self.ignore:
+                stats["ignored"].append(id)
+                continue
+            record = self.records.get(id)
+            if record is None:
+                if create is None:
+                    stats["orphans"].append(id)
+                    continue
+                record = create(group[0])
+                self.records[id] = record
+            for row in group:
+                merge(record, row)
+            stats["matched"] += 1
+        self.sources[source] = stats
+
+    """Loads the records of the given patients from a patient store into the index
+
+    :param store: patient store (see PatientStore)
+    :param ids: patient IDs, the ones that are not in the store are left out
+    """
+    def preload(self, store, ids):
+        for id in ids:
+            record = store.get(id, self.pool)
+            if record is not None: self.records[id] = record
+
+    """Saves all the records of the index into a patient store (see write_store). The values 
+    derived in the aggregation are not saved.
+
+    :param filename: name of the file
+    :param info: dictionary with the values to save in the header of the table
+    """
+    def save(self, filename, info):
+        write_store(filename, ((id, encode_record(self.records[id], self.pool)) for id in self.records), info)
+
+    """Updates the records of the given patients in a patient store saved by save. The records
+    are appended at the end of the file, followed by a new table where only the entries of 
+    these patients are replaced, and the position of the table is written last, so the store is
+    left unchanged if the update is interrupted. The header of the table counts the bytes of 
+    the records and tables that were replaced, and when they take more than STORE_MAX_DEAD of 
+    the file, the store is written again with only the current records.
+
+    :param filename: name of the file
+    :param ids: IDs of the patients to update
+    :param info: dictionary with the values to save in the header of the table
+    """
+    def update(self, filename, ids, info):
+        store = PatientStore(filename)
+        pos = len(store.map)
+        # The current table is replaced by the new one
+        dead = store.dead + pos - store.table_pos
+        records = collections.OrderedDict()
+        entries = {}
+        for id in ids:
+            data = encode_record(self.records[id], self.pool)
+            old = store.table.find(id)
+            if old is not None: dead += old[1]
+            records[id] = data
+            entries[id] = [pos, len(data)]
+            pos += len(data)
+        table = store.table.merge(entries)
+        if STORE_MAX_DEAD * (pos + len(table[2])) < dead:
+            # The records of the other patients are copied without decoding them
+            def items():
+                for i in range(0, len(store.table)):
+                    id = store.table.key(i)
+                    if id in records: continue
+                    [start, length] = store.table.values(i)
+                    yield [id, store.map[start:start + length]]
+                for id in records:
+                    yield [id, records[id]]
+            write_store(filename, items(), info)
+            store.close()
+            return
+        store.close()
+        with open(filename, "r+b") as file:
+            file.seek(0, os.SEEK_END)
+            file.write(b"".join(records.values()))
+            write_table(file, pos, table, info, dead)
+
+    """Records the IDs of a source that was already parsed into a dictionary keyed by GID,
+    such as the sequencing data, so its orphans are reported.
+
+    :param source: name of the source
+    :param ids: patient IDs in the source
+    :param known: other patient IDs that are not orphans, such as the patients in a store
+    """
+    def check(self, source, ids, known=()):
+        ids = list(ids)
+        stats = {"rows": len(ids), "matched": 0, "ignored": [], "orphans": [], "duplicates": []}
+        for id in ids:
+            if id in self.records or id in known: stats["matched"] += 1
+            elif id in self.ignore: stats["ignored"].append(id)
+            else: stats["orphans"].append(id)
+        self.sources[source] = stats
+
+    """Prints the number of matched, orphan, and duplicate IDs of each source
+
+    :param title: title of the report
+    """
+    def print_report(self, title="Patient index"):
+        print(title + ": " + str(len(self.records)) + " patients")
+        for source in self.sources:
+            stats = self.sources[source]
+            line = "  " + source + ": " + str(stats["rows"]) + " rows, " + str(stats["matched"]) + " patients matched"
+            if stats["ignored"]: line += ", " + str(len(stats["ignored"])) + " ignored"
+            line += ", " + str(len(stats["orphans"])) + " orphan IDs"
+            line += ", " + str(len(stats["duplicates"])) + " duplicate IDs"
+            print(line)
+            if stats["orphans"]:
+                print("    orphans: " + ", ".join(stats["orphans"][:10]) + (", ..." if 10 < len(stats["orphans"]) else ""))
+            if stats["duplicates"]:
+                print("    duplicates: " + ", ".join(stats["duplicates"][:10]) + (", ..." if 10 < len(stats["duplicates"]) else ""))
+
+"""Returns the bytes of a patient record. The codes of the pool are replaced by their strings,
+so the record can be decoded into the pool of another index (see decode_record).
+
+:param record: patient record
+:param pool: string pool of the index of the record
+"""
+def encode_record(record, pool):
+    dates = [pool.string(code) for code in record.qpcr_dates]
+    pico = None if record.pico is None else [pool.string(code) for code in record.pico]
+    values = (record.group, record.outcome, record.sex, record.demo, record.case, dates, record.qpcr_loads, pico)
+    return pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+
+"""Returns a patient record from the bytes returned by encode_record
+
+:param data: bytes of the record
+:param pool: string pool of the index the record is added to
+"""
+def decode_record(data, pool):
+    [group, outcome, sex, demo, case, dates, loads, pico] = pickle.loads(data)
+    intern = lambda values: None if values is None else tuple([sys.intern(value) for value in values])
+    record = Patient(group)
+    record.outcome = None if outcome is None else sys.intern(outcome)
+    record.sex = None if sex is None else sys.intern(sex)
+    record.demo = intern(demo)
+    record.case = intern(case)
+    record.qpcr_dates = array.array("i", [pool.code(date) for date in dates])
+    record.qpcr_loads = loads
+    if pico is not None: record.pico = array.array("i", [pool.code(value) for value in pico])
+    return record
+
+"""Writes a patient store with the given records. The file starts with an 8-byte magic string 
+and the 8-byte position of the table of records, followed by the records and the table (see
+write_table).
+
+:param filename: name of the file
+:param items: pairs of patient ID and bytes of the record (see encode_record)
+:param info: dictionary with the values to save in the header of the table
+"""
+def write_store(filename, items, info):
+    with buildcache.OutputFile(filename, open, "wb") as file:
+        file.write(STORE_MAGIC + struct.pack("<Q", 0))
+        pos = 16
+        entries = {}
+        for [id, data] in items:
+            file.write(data)
+            entries[id.encode("utf-8")] = [pos, len(data)]
+            pos += len(data)
+        width = miradata.key_width(entries)
+        write_table(file, pos, [width, len(entries), miradata.pack_keys(entries, width)], info)
+
+"""Writes the table of records of a patient store at the end of the file: the 8-byte length of
+a JSON header (number of records, width of the IDs, bytes of the replaced records and tables, 
+and the values in info), followed by the entries with the position and length of the record of
+each patient (see miradata.KeyTable). Then writes the position of the table at the start of 
+the file.
+
+:param file: file of the store, opened for writing in binary mode
+:param pos: position of the end of the file
+:param table: width, number of entries and bytes of the table
+:param info: dictionary with the values to save in the header
+:param dead: number of bytes of the replaced records and tables in the file
+"""
+def write_table(file, pos, table, info, dead=0):
+    header = json.dumps({"count": table[1], "width": table[0], "dead": dead, "info": info}, sort_keys=True).encode("utf-8")
+    file.write(struct.pack("<Q", len(header)))
+    file.write(header)
+    file.write(table[2])
+    file.flush()
+    file.seek(8)
+    file.write(struct.pack("<Q", pos))
+
+"""Patient store saved by PatientIndex.save. The file is memory-mapped, and the record of a 
+patient is found with a binary search in the table of records, so only the records that are 
+requested are read.
+
+:param filename: name of the file
+"""
+class PatientStore(object):
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[0:8] != STORE_MAGIC:
+            raise ValueError("The patient store " + filename + " is out of date")
+        pos = struct.unpack_from("<Q", self.map, 8)[0]
+        size = struct.unpack_from("<Q", self.map, pos)[0]
+        header = json.loads(self.map[pos + 8:pos + 8 + size].decode("utf-8"))
+        self.info = header["info"]
+        self.dead = header.get("dead", 0)
+        self.table_pos = pos
+        self.table = miradata.KeyTable(self.map, pos + 8 + size, header["count"], header["width"], 2)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, id):
+        return self.table.find(id) is not None
+
+    """Returns the record of a patient, None if the patient is not in the store
+
+    :param id: patient ID
+    :param pool: string pool of the index the record is added to
+    """
+    def get(self, id, pool):
+        values = self.table.find(id)
+        if values is None: return None
+        return decode_record(self.map[values[0]:values[0] + values[1]], pool)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
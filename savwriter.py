@@ -0,0 +1,215 @@
+"""
+This module writes SPSS system files (.sav) directly from the rows of a Mirador dataset, so
+the data does not need to be parsed as text again when imported into SPSS. Numeric, date and
+numeric category variables are stored as doubles, with dates as seconds since the start of
+the Gregorian calendar as SPSS does, and the remaining variables as fixed width strings.
+Variable labels, value labels and the long variable names are included in the dictionary of
+the file, and missing values are stored as system-missing (numeric) or blank (string).
+
+The rows are added one at a time and spooled into a temporary file while the string widths
+and number of cases are collected, since those need to be known to write the file header.
+Memory use is bounded by one row regardless of the size of the dataset.
+
+@copyright: Harvard University 2014-15
+"""
+
+import os, sys, re, struct, marshal, datetime, tempfile
+import miradata
+
+SYSMIS = -sys.float_info.max
+HIGHEST = sys.float_info.max
+LOWEST = struct.unpack("<d", struct.pack("<Q", 0xffeffffffffffffe))[0]
+MAX_STRING = 255
+GREGORIAN = datetime.date(1582, 10, 14).toordinal()
+RESERVED = ["ALL", "AND", "BY", "EQ", "GE", "GT", "LE", "LT", "NE", "NOT", "OR", "TO", "WITH"]
+
+# Print/write formats: (type << 16) | (width << 8) | decimals
+FORMAT_INT = (5 << 16) | (8 << 8) | 0
+FORMAT_FLOAT = (5 << 16) | (12 << 8) | 4
+FORMAT_DATE = (20 << 16) | (11 << 8) | 0
+
+"""Returns the list of unique SPSS short names (at most 8 bytes, starting with a letter) for
+a list of variable names.
+
+:param names: variable names
+"""
+def short_names(names):
+    used = set()
+    result = []
+    for name in names:
+        base = re.sub("[^A-Za-z0-9_.@#$]", "_", name).upper()
+        if not base or not base[0].isalpha() or base in RESERVED: base = "V" + base
+        short = base[:8]
+        count = 1
+        while short in used:
+            suffix = str(count)
+            short = base[:8 - len(suffix)] + suffix
+            count += 1
+        used.add(short)
+        result.append(short)
+    return result
+
+"""Encodes a string into bytes padded with spaces (or truncated) to the given length
+
+:param value: string to encode
+:param length: length in bytes
+"""
+def padded(value, length):
+    data = value.encode("utf-8")[:length]
+    return data + b" " * (length - len(data))
+
+"""Writer of SPSS system files.
+
+:param filename: name of the .sav file
+:param names: variable names
+:param labels: variable labels
+:param types: Mirador variable types (int, float, date, category, string)
+:param codes: list with the dictionary of value labels (code:label) of each variable
+:param miss_str: missing string in the Mirador dataset
+:param date_pattern: date pattern of the Mirador dataset (dates.parse in config.mira)
+"""
+class SavWriter(object):
+    def __init__(self, filename, names, labels, types, codes, miss_str, date_pattern="yyyy-MM-dd"):
+        self.filename = filename
+        self.names = names
+        self.labels = labels
+        self.types = [t.lower() for t in types]
+        self.codes = codes
+        self.miss_str = miss_str
+        self.date_format = miradata.date_format(date_pattern)
+        self.widths = [1] * len(names)
+        self.numeric = [t != "string" for t in self.types]
+        self.ncases = 0
+        self.spool = tempfile.TemporaryFile()
+
+    """Adds a row of the Mirador dataset (list of strings) to the file.
+
+    :param row: list of values
+    """
+    def add_row(self, row):
+        marshal.dump(row, self.spool)
+        self.ncases += 1
+        for i in range(0, len(self.names)):
+            value = row[i]
+            if value == self.miss_str or value == "": continue
+            size = len(value.encode("utf-8"))
+            if self.widths[i] < size: self.widths[i] = size
+            if self.numeric[i] and self.types[i] == "category":
+                # Categories are numeric only if all their values are numbers
+                try:
+                    float(value)
+                except ValueError:
+                    self.numeric[i] = False
+
+    def numeric_value(self, i, value):
+        if value == self.miss_str or value == "": return SYSMIS
+        try:
+            if self.types[i] == "date":
+                date = datetime.datetime.strptime(value, self.date_format).date()
+                return float((date.toordinal() - GREGORIAN) * 86400)
+            return miradata.to_float(value)
+        except ValueError:
+            return SYSMIS
+
+    def segments(self, i):
+        if self.numeric[i]: return 1
+        return (min(self.widths[i], MAX_STRING) + 7) // 8
+
+    def write_header(self, file):
+        now = datetime.datetime.now()
+        file.write(b"$FL2")
+        file.write(padded("@(#) SPSS DATA FILE - Mirador ebola-data", 60))
+        case_size = sum(self.segments(i) for i in range(0, len(self.names)))
+        file.write(struct.pack("<iiiii", 2, case_size, 0, 0, self.ncases))
+        file.write(struct.pack("<d", 100.0))
+        file.write(padded(now.strftime("%d %b %y"), 9))
+        file.write(padded(now.strftime("%H:%M:%S"), 8))
+        file.write(padded("", 64))
+        file.write(b"\0" * 3)
+
+    def write_variables(self, file, shorts):
+        for i in range(0, len(self.names)):
+            label = self.labels[i].encode("utf-8")[:255]
+            if self.numeric[i]:
+                type = 0
+                if self.types[i] == "date": format = FORMAT_DATE
+                elif self.types[i] == "float": format = FORMAT_FLOAT
+                else: format = FORMAT_INT
+            else:
+                type = min(self.widths[i], MAX_STRING)
+                format = (1 << 16) | (type << 8)
+            file.write(struct.pack("<iiiiii", 2, type, 1 if label else 0, 0, format, format))
+            file.write(padded(shorts[i], 8))
+            if label:
+                file.write(struct.pack("<i", len(label)))
+                file.write(label + b" " * ((4 - len(label) % 4) % 4))
+            for k in range(1, self.segments(i)):
+                # Continuation records for strings longer than 8 bytes
+                file.write(struct.pack("<iiiiii", 2, -1, 0, 0, 0, 0))
+                file.write(padded("", 8))
+
+    def write_value_labels(self, file):
+        index = 1
+        for i in range(0, len(self.names)):
+            if self.numeric[i] and self.codes[i]:
+                entries = []
+                for code in self.codes[i]:
+                    try:
+                        entries.append((float(code), self.codes[i][code].encode("utf-8")[:120]))
+                    except ValueError:
+                        pass
+                if entries:
+                    file.write(struct.pack("<ii", 3, len(entries)))
+                    for value, label in entries:
+                        file.write(struct.pack("<dB", value, len(label)))
+                        file.write(label + b" " * ((8 - (len(label) + 1) % 8) % 8))
+                    file.write(struct.pack("<iii", 4, 1, index))
+            index += self.segments(i)
+
+    def write_extensions(self, file, shorts):
+        # Machine integer info: version, machine code, IEEE floats, compression, little
+        # endian, UTF-8
+        file.write(struct.pack("<iiii", 7, 3, 4, 8))
+        file.write(struct.pack("<8i", 1, 0, 0, -1, 1, 1, 2, 65001))
+        # Machine floating point info: system missing, highest and lowest values
+        file.write(struct.pack("<iiii", 7, 4, 8, 3))
+        file.write(struct.pack("<3d", SYSMIS, HIGHEST, LOWEST))
+        # Long variable names
+        longs = "\t".join(shorts[i] + "=" + self.names[i][:64] for i in range(0, len(self.names))).encode("utf-8")
+        file.write(struct.pack("<iiii", 7, 13, 1, len(longs)))
+        file.write(longs)
+        # Character encoding
+        encoding = b"UTF-8"
+        file.write(struct.pack("<iiii", 7, 20, 1, len(encoding)))
+        file.write(encoding)
+        # Dictionary termination
+        file.write(struct.pack("<ii", 999, 0))
+
+    def write_cases(self, file):
+        self.spool.seek(0)
+        count = len(self.names)
+        for n in range(0, self.ncases):
+            row = marshal.load(self.spool)
+            data = []
+            for i in range(0, count):
+                if self.numeric[i]:
+                    data.append(struct.pack("<d", self.numeric_value(i, row[i])))
+                else:
+                    value = row[i]
+                    if value == self.miss_str: value = ""
+                    data.append(padded(value, self.segments(i) * 8))
+            file.write(b"".join(data))
+
+    """Writes the .sav file with all the rows added so far.
+    """
+    def close(self):
+        shorts = short_names(self.names)
+        out_folder = os.path.split(self.filename)[0]
+        if out_folder and not os.path.exists(out_folder): os.makedirs(out_folder)
+        with open(self.filename, "wb") as file:
+            self.write_header(file)
+            self.write_variables(file, shorts)
+            self.write_value_labels(file)
+            self.write_extensions(file, shorts)
+            self.write_cases(file)
+        self.spool.close()
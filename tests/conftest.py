@@ -0,0 +1,11 @@
+"""
+Makes the modules of the repository importable from the tests, which are run with:
+
+python -m pytest tests
+
+@copyright: Harvard University 2014-15
+"""
+
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
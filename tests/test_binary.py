@@ -0,0 +1,74 @@
+"""
+Round trip of the column-major binary data file (miradata.write_binary) against data.csv
+
+@copyright: Harvard University 2014-15
+"""
+
+import os, csv, math
+import miradata
+
+IDS = ["X-1", "X-2", "X-3", "X-4", "X-5"]
+COLUMNS = [["GID", "String", "label", IDS],
+           ["AGE", "int", "", ["34", "", "7", "\\N", "61"]],
+           ["CODE", "int", "", ["12", "007", "", "3", "4"]],
+           ["PCR", "float", "", ["5.25", "0.1", "", "1e-07", "12"]],
+           ["AF", "float", "", ["[0.75]", "", "[0.5]", "\\N", "[0.0625]"]],
+           ["DOPCR", "date", "", ["2014-06-01", "", "2014-06-30", "2014-07-02", "\\N"]],
+           ["DIAG", "category", "1:Positive;0:Negative", ["1", "0", "", "1", "2"]],
+           ["NOTES", "String", "", ["fever", "", "t\u00eate, \"dry\"", "\\N", "line\nbreak"]]]
+
+"""Saves the test dataset into data.csv and data.cols.bin, returns the folder
+"""
+def save_dataset(folder):
+    dataset = miradata.Dataset(IDS)
+    ranges = {}
+    for [name, type, rstr, values] in COLUMNS:
+        dataset.add_column(name, type, values)
+        ranges[name] = rstr
+    with open(os.path.join(folder, "config.mira"), "w") as file:
+        file.write("data.source=data.csv\ndata.binary=data.bin\ndates.parse=yyyy-MM-dd\nmissing.string=\\N\n")
+    with open(os.path.join(folder, "data.csv"), "w") as file:
+        miradata.write_csv(file, list(dataset.columns), dataset.rows())
+    with open(os.path.join(folder, miradata.BINARY_NAME), "wb") as file:
+        miradata.write_binary(dataset, ranges, "yyyy-MM-dd", file)
+    return str(folder)
+
+def test_columns_match_csv(tmp_path):
+    folder = save_dataset(tmp_path)
+    with open(os.path.join(folder, "data.csv"), "r") as file:
+        rows = list(csv.reader(file))
+    names = rows[0]
+    bdata = miradata.BinaryData(os.path.join(folder, miradata.BINARY_NAME))
+    assert bdata.rows == len(IDS)
+    assert list(bdata.columns) == names
+    for c, name in enumerate(names):
+        stored = bdata.strings(name)
+        type = bdata.columns[name]["type"]
+        for r, row in enumerate(rows[1:]):
+            value = None if row[c] in ("", miradata.MISSING) else row[c]
+            if value is None or type not in ("int", "float"):
+                assert stored[r] == value, name
+            else:
+                assert float(stored[r]) == miradata.to_float(value), name
+    bdata.close()
+
+def test_typed_values(tmp_path):
+    folder = save_dataset(tmp_path)
+    bdata = miradata.BinaryData(os.path.join(folder, miradata.BINARY_NAME))
+    assert list(bdata.column("AGE")) == [34, miradata.INT_MISSING, 7, miradata.INT_MISSING, 61]
+    assert [bdata.columns[name]["type"] for name in ["GID", "CODE", "PCR", "DOPCR", "DIAG"]] == ["string", "int", "float", "date", "category"]
+    pcr = list(bdata.column("PCR"))
+    assert pcr[0] == 5.25 and math.isnan(pcr[2])
+    # Dates are days since 1970-01-01
+    dates = list(bdata.column("DOPCR"))
+    assert miradata.format_date(dates[0] + miradata.EPOCH) == "2014-06-01"
+    assert dates[1] == miradata.DATE_MISSING and dates[4] == miradata.DATE_MISSING
+    # Category codes index the levels of the range string first, then the other values
+    assert bdata.columns["DIAG"]["levels"] == ["1", "0", "2"]
+    assert list(bdata.column("DIAG")) == [0, 1, miradata.CODE_MISSING, 0, 2]
+    assert bdata.column("NOTES")[1] is None
+    bdata.close()
+
+def test_check_binary(tmp_path):
+    folder = save_dataset(tmp_path)
+    assert miradata.check_binary(folder) == 0
@@ -0,0 +1,66 @@
+"""
+Random access to the rows of data.csv through the row index (miradata.DataIndex)
+
+@copyright: Harvard University 2014-15
+"""
+
+import os, random
+import pytest
+import miradata
+
+"""Saves a dataset with the given ids into data.csv and data.idx, returns the folder
+"""
+def save_dataset(folder, ids):
+    dataset = miradata.Dataset(ids)
+    dataset.add_column("GID", "String", ids)
+    dataset.add_column("ROW", "int", [str(i) for i in range(0, len(ids))])
+    dataset.add_column("NOTE", "String", ["a, \"quoted\" value" if i % 7 == 0 else "" for i in range(0, len(ids))])
+    with open(os.path.join(folder, "config.mira"), "w") as file:
+        file.write("data.source=data.csv\n")
+    with open(os.path.join(folder, "data.csv"), "w") as file:
+        offsets = miradata.write_csv(file, list(dataset.columns), dataset.rows())
+    with open(os.path.join(folder, miradata.INDEX_NAME), "wb") as file:
+        miradata.write_index(file, os.path.join(folder, "data.csv"), list(dataset.columns), ids, offsets)
+    return str(folder)
+
+def test_lookup(tmp_path):
+    ids = ["X-" + str(i) for i in random.Random(0).sample(range(0, 100000), 2000)] + ["G-é", "Z"]
+    index = miradata.DataIndex(save_dataset(tmp_path, ids))
+    assert len(index) == len(ids)
+    assert index.names == ["GID", "ROW", "NOTE"]
+    assert index.ids() == ids
+    for i, id in enumerate(ids):
+        assert index.find(id) == i
+        assert index.values(id, ["ROW"]) == [str(i)]
+    assert index.row(ids[0]) == [ids[0], "0", "a, \"quoted\" value"]
+    for id in ["X-100000", "X-", "", "Z" * 40]:
+        assert id not in index
+    with pytest.raises(KeyError):
+        index.row("X-100000")
+    index.close()
+
+def test_out_of_date(tmp_path):
+    folder = save_dataset(tmp_path, ["X-1", "X-2"])
+    with open(os.path.join(folder, "data.csv"), "a") as file:
+        file.write("X-3,2,\n")
+    with pytest.raises(ValueError):
+        miradata.DataIndex(folder)
+
+@pytest.mark.parametrize("new_ids", [["X-" + str(i) for i in range(1000, 1010)] + ["A", "X-4999"],
+                                     ["X-1000", "A-longer-than-the-other-ids"]])
+def test_append(tmp_path, new_ids):
+    ids = ["X-" + str(i) for i in range(0, 500)]
+    folder = save_dataset(tmp_path, ids)
+    index = miradata.DataIndex(folder)
+    with open(os.path.join(folder, "data.csv"), "a") as file:
+        offsets = miradata.write_csv(file, None, [[id, str(len(ids) + i), ""] for i, id in enumerate(new_ids)],
+                                     index.offsets[-1])
+    with open(os.path.join(folder, miradata.INDEX_NAME + ".new"), "wb") as file:
+        miradata.append_index(file, index, new_ids, offsets)
+    index.close()
+    os.replace(os.path.join(folder, miradata.INDEX_NAME + ".new"), os.path.join(folder, miradata.INDEX_NAME))
+    index = miradata.DataIndex(folder)
+    assert index.ids() == ids + new_ids
+    for i, id in enumerate(ids + new_ids):
+        assert index.values(id, ["ROW"]) == [str(i)]
+    index.close()
@@ -0,0 +1,77 @@
+"""
+Ingesting new rows (makemira.py -ingest) against building the dataset from sources with the
+new rows at the end, on the csv sources in the repository
+
+@copyright: Harvard University 2014-15
+"""
+
+import os, csv, shutil, collections
+import pytest
+import makemira
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TABLES = {"master": ["master.csv", 1], "demo": ["demographics.csv", 1], "case": ["case.csv", 0], "pico": ["piccolo.csv", 3]}
+OUTPUTS = ["data.csv", "data.idx", "dictionary.csv", "groups.xml", "missing.csv"]
+
+def read_rows(filename):
+    with open(filename, "r") as file:
+        return list(csv.reader(file))
+
+def write_rows(filename, rows):
+    with open(filename, "w") as file:
+        csv.writer(file, lineterminator="\n").writerows(rows)
+
+"""Copies the csv sources and the files of the build into a folder, returns the folder
+"""
+def copy_sources(folder):
+    shutil.copytree(os.path.join(ROOT, "sources", "csv"), os.path.join(folder, "sources", "csv"))
+    for name in ["config.mira", "idignore", "demo-dict.csv", "case-dict.csv", "piccolo-expected.csv"]:
+        shutil.copy(os.path.join(ROOT, name), os.path.join(folder, name))
+    return str(folder)
+
+"""Moves the rows of the last new_patients patients of the master table, and the last row of the
+series of the extended patients, from the sources of a folder into csv files in the delta folder.
+The patient with the longest qPCR series is extended, so ingesting adds new variables.
+"""
+def split_sources(folder, delta, new_patients, extended):
+    files = makemira.source_files(False)
+    master = read_rows(os.path.join(folder, files["master"]))
+    ids = list(collections.OrderedDict.fromkeys(row[1] for row in master[1:] if row[10]))
+    counts = collections.Counter(row[1] for row in master[1:] if row[10])
+    new_ids = set(ids[len(ids) - new_patients:])
+    longest = max(counts.values())
+    ext_ids = [id for id in ids if not id in new_ids and 2 <= counts[id] < longest][:extended]
+    ext_ids.append([id for id in ids if not id in new_ids and counts[id] == longest][0])
+    for table in TABLES:
+        [name, key] = TABLES[table]
+        rows = read_rows(os.path.join(folder, files[table]))
+        last = dict((row[key], i) for i, row in enumerate(rows))
+        moved = [i for i, row in enumerate(rows) if 0 < i and (row[key] in new_ids or
+                 (table in ["master", "pico"] and row[key] in ext_ids and last[row[key]] == i))]
+        write_rows(os.path.join(folder, files[table]), [row for i, row in enumerate(rows) if not i in moved])
+        write_rows(os.path.join(delta, name), [rows[0]] + [rows[i] for i in moved])
+
+@pytest.mark.parametrize("options", [{}, {"log": True, "kinetics": True, "ranges": True}])
+def test_ingest(tmp_path, options):
+    full = copy_sources(tmp_path / "full")
+    base = copy_sources(tmp_path / "base")
+    delta = str(tmp_path / "delta")
+    os.makedirs(delta)
+    split_sources(base, delta, 5, 3)
+    # The full build has the rows of the delta at the end of the sources
+    files = makemira.source_files(False)
+    for table in TABLES:
+        rows = read_rows(os.path.join(base, files[table])) + read_rows(os.path.join(delta, TABLES[table][0]))[1:]
+        write_rows(os.path.join(full, files[table]), rows)
+    assert makemira.Builder(root=full, xlsx=False, **options).build()
+    assert makemira.Builder(root=base, xlsx=False, **options).build()
+    assert makemira.Builder(root=base, xlsx=False, ingest=delta, **options).build()
+    for name in OUTPUTS:
+        with open(os.path.join(full, "mirador", name), "rb") as file1, open(os.path.join(base, "mirador", name), "rb") as file2:
+            assert file1.read() == file2.read(), name
+
+    # The same rows cannot be ingested twice, and the dataset is built again from the sources
+    with pytest.raises(ValueError):
+        makemira.Builder(root=base, xlsx=False, ingest=delta, **options).build()
+    assert makemira.Builder(root=base, xlsx=False, **options).build()
+    assert not makemira.Builder(root=base, xlsx=False, **options).build()
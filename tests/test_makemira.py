@@ -0,0 +1,34 @@
+"""
+Parsing the sources of makemira.Builder in parallel, and the outputs of the long format
+
+@copyright: Harvard University 2014-15
+"""
+
+import os, shutil
+import makemira, miraprof
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_parallel_hashes(tmp_path):
+    shutil.copytree(os.path.join(ROOT, "sources", "csv"), str(tmp_path / "sources" / "csv"))
+    for name in ["config.mira", "idignore"]:
+        shutil.copy(os.path.join(ROOT, name), str(tmp_path / name))
+    builder = makemira.Builder(root=str(tmp_path), xlsx=False)
+    builder.profiler = miraprof.Profiler(None, None)
+    tasks = [[makemira.load_ignore, builder.ignore_file, []], [makemira.read_table, builder.files["master"], []]]
+    parallel = builder.parse_sources(tasks, 2)
+    # The hashes of the sources are kept by the builder, not only by the workers
+    for task in tasks:
+        assert os.path.abspath(task[1]) in builder.cache.hashes.hashes
+    assert parallel == builder.parse_sources(tasks, 1)
+
+def test_long_format(tmp_path):
+    shutil.copytree(os.path.join(ROOT, "sources", "csv"), str(tmp_path / "sources" / "csv"))
+    for name in ["config.mira", "idignore", "demo-dict.csv", "case-dict.csv", "piccolo-expected.csv"]:
+        shutil.copy(os.path.join(ROOT, name), str(tmp_path / name))
+    long_files = [str(tmp_path / "mirador" / name) for name in ["qpcr.csv", "panels.csv"]]
+    assert makemira.Builder(root=str(tmp_path), xlsx=False, long=True).build()
+    assert all(os.path.isfile(filename) for filename in long_files)
+    # The long-format tables are removed by a build without -long
+    assert makemira.Builder(root=str(tmp_path), xlsx=False).build()
+    assert not any(os.path.isfile(filename) for filename in long_files)
@@ -0,0 +1,51 @@
+"""
+Patient store (patientindex.PatientIndex.save/update and PatientStore)
+
+@copyright: Harvard University 2014-15
+"""
+
+import os
+import patientindex
+
+"""Returns an index with a record per ID, with a qPCR series of the given length
+"""
+def make_index(ids, length):
+    index = patientindex.PatientIndex()
+    for id in ids:
+        record = patientindex.Patient("Epos")
+        record.sex = "Female"
+        record.demo = ("34", "Kenema")
+        for k in range(0, length):
+            record.qpcr_dates.append(index.pool.code("2014-06-" + str(10 + k)))
+            record.qpcr_loads.append(float(k))
+        index.records[id] = record
+    return index
+
+def read_store(filename, ids):
+    store = patientindex.PatientStore(filename)
+    pool = patientindex.miradata.StringPool()
+    records = dict((id, store.get(id, pool)) for id in ids)
+    result = [len(store), store.info, dict((id, [pool.string(code) for code in records[id].qpcr_dates]) for id in ids)]
+    store.close()
+    return result
+
+def test_update(tmp_path):
+    filename = str(tmp_path / "patients.store")
+    ids = ["X-" + str(i) for i in range(0, 200)]
+    make_index(ids, 2).save(filename, {"qpcr": 2})
+    size = os.path.getsize(filename)
+    [count, info, dates] = read_store(filename, ids)
+    assert count == 200 and info == {"qpcr": 2}
+    assert dates["X-7"] == ["2014-06-10", "2014-06-11"]
+
+    # Updating the same patients every day keeps the store under twice its size
+    for day in range(0, 30):
+        make_index(["X-1", "X-2", "new-" + str(day)], 3).update(filename, ["X-1", "X-2", "new-" + str(day)], {"qpcr": 3})
+        assert os.path.getsize(filename) < 2.5 * size
+    [count, info, dates] = read_store(filename, ids + ["new-0", "new-29"])
+    assert count == 230 and info == {"qpcr": 3}
+    assert dates["X-1"] == dates["new-29"] == ["2014-06-10", "2014-06-11", "2014-06-12"]
+    assert dates["X-7"] == ["2014-06-10", "2014-06-11"]
+    store = patientindex.PatientStore(filename)
+    assert "X-199" in store and not "X-200" in store
+    store.close()
@@ -0,0 +1,48 @@
+"""
+Streaming VCF reader (vcfstream.Reader), and reading sites through the position index
+
+@copyright: Harvard University 2014-15
+"""
+
+import os
+import vcfstream
+
+HEADER = "##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tX7028\tX7031\n"
+SITES = [["KM034562", "100", "A", "0.25", "0.5"], ["KM034562", "200", "C", "0.75", "0.125"]]
+
+"""Writes a VCF file with the given sites, returns its name
+"""
+def write_vcf(filename, sites):
+    with open(filename, "w") as file:
+        file.write(HEADER)
+        for [chrom, pos, ref, af1, af2] in sites:
+            file.write("\t".join([chrom, pos, ".", ref, "T", ".", "PASS", "DP=10", "GT:AF", "1:" + af1, "1:" + af2]) + "\n")
+    return filename
+
+def test_read(tmp_path):
+    filename = write_vcf(str(tmp_path / "t.vcf"), SITES)
+    reader = vcfstream.Reader(filename, ["AF", "GT"], lambda s: s[0] + "-" + s[1:])
+    assert reader.ids == ["X-7028", "X-7031"]
+    sites = list(reader)
+    assert [site.pos for site in sites] == [100, 200]
+    assert sites[1].values == [["0.75", "0.125"], ["1", "1"]]
+
+def test_fetch(tmp_path):
+    filename = write_vcf(str(tmp_path / "t.vcf"), SITES)
+    sites = list(vcfstream.Reader(filename, ["AF"]).fetch({200}))
+    assert [[site.pos, site.values] for site in sites] == [[200, [["0.75", "0.125"]]]]
+    assert os.path.isfile(vcfstream.index_filename(filename))
+
+def test_stale_index(tmp_path):
+    filename = write_vcf(str(tmp_path / "t.vcf"), SITES)
+    list(vcfstream.Reader(filename, ["AF"]).fetch({100}))
+    # Same size and modification time, with the records swapped
+    st = os.stat(filename)
+    write_vcf(filename, SITES[::-1])
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert vcfstream.file_signature(filename) == [str(st.st_size), str(st.st_mtime_ns)]
+    sites = list(vcfstream.Reader(filename, ["AF"]).fetch({100}))
+    assert [[site.pos, site.values] for site in sites] == [[100, [["0.25", "0.5"]]]]
+    # The index was built again
+    sites = list(vcfstream.Reader(filename, ["AF"]).fetch({200}))
+    assert [[site.pos, site.values] for site in sites] == [[200, [["0.75", "0.125"]]]]
@@ -0,0 +1,27 @@
+"""
+Parity of the streaming xlsx reader with the csv files converted with in2csv from the 
+workbooks in sources/xls
+
+@copyright: Harvard University 2014-15
+"""
+
+import os, csv, types
+import pytest
+import xlsxstream
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHEETS = [["MasterDataListandEBOVResults.xlsx", "Ebola_js1", "MasterDataListandEBOVResults.csv"],
+          ["DemographicsFromSim_schieffelin.xlsx", None, "DemographicsFromSim_schieffelin.csv"],
+          ["CaseNotification_schieffelin.xlsx", None, "CaseNotification_schieffelin.csv"],
+          ["FinalPiccoloData_schieffelin.xlsx", "FinalSummary1", "FinalPiccoloData_schieffelin-FinalSummary1.csv"]]
+
+@pytest.mark.parametrize("xlsx_name, sheet, csv_name", SHEETS)
+def test_in2csv_parity(xlsx_name, sheet, csv_name):
+    rows = xlsxstream.read_sheet(os.path.join(ROOT, "sources", "xls", xlsx_name), sheet)
+    assert isinstance(rows, types.GeneratorType)
+    with open(os.path.join(ROOT, "sources", "csv", csv_name), "r") as file:
+        assert list(rows) == list(csv.reader(file))
+
+def test_check_sheet():
+    [xlsx_name, sheet, csv_name] = SHEETS[0]
+    assert xlsxstream.check_sheet(os.path.join(ROOT, "sources", "xls", xlsx_name), sheet, os.path.join(ROOT, "sources", "csv", csv_name)) == 0
@@ -0,0 +1,294 @@
+"""
+This module provides a minimal streaming reader for the VCF files holding the viral
+sequencing data. Unlike PyVCF, it does not create record and call objects for every line
+of the file: only the requested FORMAT fields are tokenized, the sample columns are mapped
+to patient ids once from the header, and each site is returned as a compact set of
+per-sample value lists.
+
+The reader can also use a sidecar position index (a byte offset per CHROM/POS, stored in 
+<vcf file>.pidx) to seek straight to a set of requested sites. The index is built the first
+time it is needed, and rebuilt whenever the size or modification time (in nanoseconds) of the
+VCF file changes, or a record read through it is not at the indexed position. Bgzip-compressed VCF files are indexed in the same way using BGZF virtual offsets
+(compressed block offset << 16 | offset within the uncompressed block), as tabix does.
+
+@copyright: Harvard University 2014-15
+"""
+
+import os, struct, zlib, gzip, collections
+
+"""Data for a single site (record) in the VCF file. The values attribute holds one list per
+requested FORMAT field, with one (raw string) entry per sample column, and "." for missing
+entries.
+"""
+Site = collections.namedtuple("Site", ["chrom", "pos", "info", "values"])
+
+"""Returns the list of values of a FORMAT field for all the samples in a record.
+
+:param samples: sample columns of the record
+:param slot: position of the field in the FORMAT column, -1 if the field is not present
+:param nkeys: number of fields in the FORMAT column
+"""
+def extract_field(samples, slot, nkeys):
+    if slot < 0:
+        return ["."] * len(samples)
+    if nkeys == 1:
+        return samples
+    if slot == 0:
+        return [s.split(":", 1)[0] for s in samples]
+    values = []
+    for s in samples:
+        parts = s.split(":", slot + 1)
+        values.append(parts[slot] if slot < len(parts) else ".")
+    return values
+
+"""File-like object over a BGZF (bgzip) compressed file, supporting readline, and tell and 
+seek with virtual offsets.
+
+:param filename: name of the bgzip file
+"""
+class BgzfFile(object):
+    def __init__(self, filename):
+        self.raw = open(filename, "rb")
+        self.block_start = 0
+        self.block_data = b""
+        self.within = 0
+
+    def read_block(self):
+        start = self.raw.tell()
+        header = self.raw.read(12)
+        if len(header) < 12:
+            self.block_start = start
+            self.block_data = b""
+            self.within = 0
+            return False
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = self.raw.read(xlen)
+        bsize = None
+        i = 0
+        while i + 4 <= len(extra):
+            slen = struct.unpack("<H", extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == b"BC": bsize = struct.unpack("<H", extra[i + 4:i + 6])[0]
+            i = i + 4 + slen
+        if bsize is None:
+            raise IOError("Not a BGZF block at offset " + str(start))
+        rest = self.raw.read(bsize + 1 - 12 - xlen)
+        self.block_start = start
+        self.block_data = zlib.decompress(rest[:-8], -15)
+        self.within = 0
+        return True
+
+    def fill(self):
+        # Move to the next non-empty block when the current one is exhausted
+        while len(self.block_data) <= self.within:
+            if not self.read_block(): return False
+        return True
+
+    def readline(self):
+        parts = []
+        while self.fill():
+            end = self.block_data.find(b"\n", self.within)
+            if end < 0:
+                parts.append(self.block_data[self.within:])
+                self.within = len(self.block_data)
+            else:
+                parts.append(self.block_data[self.within:end + 1])
+                self.within = end + 1
+                break
+        return b"".join(parts)
+
+    def tell(self):
+        self.fill()
+        return (self.block_start << 16) | self.within
+
+    def seek(self, voffset):
+        self.raw.seek(voffset >> 16)
+        self.read_block()
+        self.within = voffset & 0xFFFF
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line: break
+            yield line
+
+    def close(self):
+        self.raw.close()
+
+"""Opens a VCF file in binary mode, returns a BgzfFile for bgzip-compressed files, a
+streaming (non-seekable) file for other gzip files, and a regular file otherwise.
+
+:param filename: name of the vcf file
+"""
+def open_vcf(filename):
+    with open(filename, "rb") as file:
+        header = file.read(18)
+    if header[:2] == b"\x1f\x8b":
+        if 16 <= len(header) and header[3:4] == b"\x04" and header[12:14] == b"BC":
+            return BgzfFile(filename)
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+"""Returns the name of the position index file of a VCF file
+
+:param filename: name of the vcf file
+"""
+def index_filename(filename):
+    return filename + ".pidx"
+
+"""Returns the signature (size and modification time in nanoseconds) used to detect changes in a
+VCF file
+
+:param filename: name of the vcf file
+"""
+def file_signature(filename):
+    st = os.stat(filename)
+    return [str(st.st_size), str(st.st_mtime_ns)]
+
+"""Builds the position index of a VCF file, and saves it into the sidecar index file. Returns
+a dictionary mapping each position to the list of (chrom, offset) of the records at that 
+position.
+
+:param filename: name of the vcf file
+"""
+def build_index(filename):
+    index = {}
+    lines = ["\t".join(["#pidx"] + file_signature(filename))]
+    file = open_vcf(filename)
+    try:
+        while True:
+            offset = file.tell()
+            line = file.readline()
+            if not line: break
+            if line.startswith(b"#") or not line.strip(): continue
+            parts = line.split(b"\t", 2)
+            chrom = parts[0].decode("utf-8")
+            pos = int(parts[1])
+            index.setdefault(pos, []).append((chrom, offset))
+            lines.append(chrom + "\t" + str(pos) + "\t" + str(offset))
+    finally:
+        file.close()
+    try:
+        with open(index_filename(filename), "w") as idx_file:
+            idx_file.write("\n".join(lines) + "\n")
+    except (IOError, OSError):
+        print("  Warning: cannot write position index for " + filename)
+    return index
+
+"""Returns the position index of a VCF file, loading it from the sidecar index file if it
+is up to date, or building it otherwise.
+
+:param filename: name of the vcf file
+"""
+def load_index(filename):
+    idx_name = index_filename(filename)
+    if os.path.isfile(idx_name):
+        with open(idx_name, "r") as idx_file:
+            header = idx_file.readline().rstrip("\n").split("\t")
+            if header == ["#pidx"] + file_signature(filename):
+                index = {}
+                for line in idx_file:
+                    [chrom, pos, offset] = line.rstrip("\n").split("\t")
+                    index.setdefault(int(pos), []).append((chrom, int(offset)))
+                return index
+    return build_index(filename)
+
+"""Streaming VCF reader. Iterating over the reader yields a Site per record in the file.
+
+:param filename: vcf file
+:param fields: list of FORMAT fields to extract for each sample, e.g. ["GT", "AF"]
+:param sample_id: optional function mapping sample names into patient ids, applied once
+                  per sample column when reading the header
+"""
+class Reader(object):
+    def __init__(self, filename, fields, sample_id=None):
+        self.filename = filename
+        self.fields = list(fields)
+        self.samples = []
+        self.ids = []
+        self.format_cache = {}
+        self.file = open_vcf(filename)
+        self.read_header(sample_id)
+
+    def read_header(self, sample_id):
+        while True:
+            line = self.file.readline()
+            if not line: break
+            if line.startswith(b"##"): continue
+            if line.startswith(b"#CHROM"):
+                self.samples = line.decode("utf-8").rstrip("\r\n").split("\t")[9:]
+                if sample_id:
+                    self.ids = [sample_id(s) for s in self.samples]
+                else:
+                    self.ids = list(self.samples)
+            break
+
+    def format_slots(self, fmt):
+        if fmt in self.format_cache:
+            return self.format_cache[fmt]
+        keys = fmt.split(":")
+        slots = [keys.index(f) if f in keys else -1 for f in self.fields]
+        self.format_cache[fmt] = (slots, len(keys))
+        return self.format_cache[fmt]
+
+    def parse_line(self, line):
+        parts = line.decode("utf-8").rstrip("\r\n").split("\t")
+        samples = parts[9:]
+        if 8 < len(parts):
+            slots, nkeys = self.format_slots(parts[8])
+        else:
+            slots, nkeys = [-1] * len(self.fields), 0
+        values = [extract_field(samples, slot, nkeys) for slot in slots]
+        return Site(parts[0], int(parts[1]), parts[7], values)
+
+    def __iter__(self):
+        for line in self.file:
+            if not line.strip() or line.startswith(b"#"): continue
+            yield self.parse_line(line)
+        self.close()
+
+    """Yields the sites at the requested positions, in the order they appear in the file,
+    seeking to each of them with the position index instead of reading the whole file. If a
+    record is not at the position given by the index, the index is out of date even if the 
+    signature of the file matches, so it is built again before reading the sites.
+
+    :param positions: collection of positions to read
+    :param chrom: optional chromosome the positions refer to
+    """
+    def fetch(self, positions, chrom=None):
+        sites = self.read_sites(load_index(self.filename), positions, chrom)
+        if sites is None:
+            sites = self.read_sites(build_index(self.filename), positions, chrom)
+            if sites is None:
+                self.close()
+                raise ValueError("Cannot read the indexed sites of " + self.filename)
+        for site in sites:
+            yield site
+        self.close()
+
+    """Returns the sites at the requested positions read with a position index, None if a
+    record is not at the position given by the index
+
+    :param index: position index (see load_index)
+    :param positions: collection of positions to read
+    :param chrom: optional chromosome the positions refer to
+    """
+    def read_sites(self, index, positions, chrom):
+        entries = []
+        for pos in positions:
+            for entry in index.get(pos, []):
+                if chrom is None or entry[0] == chrom: entries.append((entry[1], entry[0], pos))
+        sites = []
+        for [offset, entry_chrom, pos] in sorted(entries):
+            self.file.seek(offset)
+            line = self.file.readline()
+            if not line.strip() or line.startswith(b"#"): return None
+            try:
+                site = self.parse_line(line)
+            except (ValueError, IndexError, UnicodeDecodeError):
+                return None
+            if site.pos != pos or site.chrom != entry_chrom: return None
+            sites.append(site)
+        return sites
+
+    def close(self):
+        self.file.close()
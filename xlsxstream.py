@@ -0,0 +1,380 @@
+"""
+This module reads the rows of a sheet in an Excel workbook (.xlsx) directly from the zip
+file, parsing the sheet incrementally so the workbook is never loaded into memory as a whole.
+Only the shared strings table and the cell formats are kept in memory while reading.
+
+Cell values are converted into strings in the same way as csvkit's in2csv, which was used to
+convert the workbooks into the csv files in sources/csv, so the rows are identical to the
+rows of those files:
+
+- the type of each column is inferred from all its values, like in2csv does, so a column
+  with only yes/no values is written as True/False, and null values (empty, whitespace,
+  NA, None, ...) are written as empty strings
+- numbers are written with full precision, integers without decimals
+- cells with a date format are written as ISO dates (or date-times when they have a time)
+- every row is padded to the width of the sheet
+- the values in the first (header) row are written without conversion
+
+Inferring the types takes a first pass over the sheet, so the sheet is parsed twice, and the
+converted rows are yielded one at a time in the second pass. The elements of the rows already
+parsed are removed from the XML tree, so the memory used does not grow with the sheet.
+
+The conversion can be checked against in2csv's output with:
+
+python xlsxstream.py -check sources/xls/MasterDataListandEBOVResults.xlsx Ebola_js1 sources/csv/MasterDataListandEBOVResults.csv
+
+@copyright: Harvard University 2014-15
+"""
+
+import sys, re, csv, zipfile, decimal, datetime, itertools, posixpath
+import xml.etree.ElementTree as ElementTree
+
+NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+# Built-in number formats that represent dates and times
+DATE_FORMATS = set([14, 15, 16, 17, 18, 19, 20, 21, 22, 27, 30, 36, 45, 46, 47, 50, 57])
+NULL_TIME = datetime.time(0, 0, 0)
+
+# Column types inferred by in2csv, in order of preference, and the strings that it converts
+# into null and boolean values (ignoring case and surrounding whitespace)
+BOOLEAN = "boolean"
+NUMBER = "number"
+DATE = "date"
+DATETIME = "datetime"
+TEXT = "text"
+TYPES = [BOOLEAN, NUMBER, DATE, DATETIME, TEXT]
+NULL_VALUES = set(["", "na", "n/a", "none", "null", "."])
+TRUE_VALUES = set(["yes", "y", "true", "t", "1"])
+FALSE_VALUES = set(["no", "n", "false", "f", "0"])
+
+"""Returns true if a custom number format represents a date or time: it contains day, month,
+year, hour or second codes outside of quoted text and brackets.
+
+:param code: number format code
+"""
+def is_date_format(code):
+    code = re.sub(r'"[^"]*"|\[[^\]]*\]|\\.|_.|\*.', "", code)
+    return re.search("[dmyhs]", code.lower()) is not None
+
+"""Converts an Excel serial date into a datetime
+
+:param value: serial date
+:param date1904: true if the workbook uses the 1904 date system
+"""
+def from_excel(value, date1904=False):
+    if date1904:
+        base = datetime.datetime(1904, 1, 1)
+    elif value < 60:
+        # Excel treats 1900 as a leap year
+        base = datetime.datetime(1899, 12, 31)
+    else:
+        base = datetime.datetime(1899, 12, 30)
+    days = int(value)
+    return base + datetime.timedelta(days=days) + datetime.timedelta(seconds=(value - days) * 86400)
+
+def normalize_datetime(value):
+    if value.microsecond < 1000:
+        return value.replace(microsecond=0)
+    if 999000 < value.microsecond:
+        return value.replace(microsecond=0) + datetime.timedelta(seconds=1)
+    return value
+
+"""Returns the zero-based column index of a cell reference, e.g. 2 for C7
+
+:param ref: cell reference
+"""
+def column_index(ref):
+    index = 0
+    for char in ref:
+        if "A" <= char <= "Z":
+            index = index * 26 + ord(char) - 64
+        else:
+            break
+    return index - 1
+
+"""Excel workbook opened for streaming the rows of its sheets.
+
+:param filename: name of the .xlsx file
+"""
+class Workbook(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.zip = zipfile.ZipFile(filename, "r")
+        names = set(self.zip.namelist())
+
+        workbook = ElementTree.fromstring(self.zip.read("xl/workbook.xml"))
+        pr = workbook.find(NS + "workbookPr")
+        self.date1904 = pr is not None and pr.get("date1904") in ["1", "true"]
+        rels = ElementTree.fromstring(self.zip.read("xl/_rels/workbook.xml.rels"))
+        targets = {}
+        for rel in rels.iter(PKG_REL_NS + "Relationship"):
+            target = rel.get("Target")
+            if target.startswith("/"): target = target[1:]
+            else: target = posixpath.normpath(posixpath.join("xl", target))
+            targets[rel.get("Id")] = target
+        self.sheets = []
+        for sheet in workbook.iter(NS + "sheet"):
+            self.sheets.append([sheet.get("name"), targets[sheet.get(REL_NS + "id")]])
+
+        self.strings = []
+        if "xl/sharedStrings.xml" in names:
+            with self.zip.open("xl/sharedStrings.xml") as file:
+                root = None
+                for event, elem in ElementTree.iterparse(file, ["start", "end"]):
+                    if event == "start":
+                        if root is None: root = elem
+                        continue
+                    if elem.tag == NS + "si":
+                        # Text of the item, including rich text runs but not phonetic hints
+                        text = [t.text or "" for t in elem.iter(NS + "t")]
+                        for rph in elem.iter(NS + "rPh"):
+                            for t in rph.iter(NS + "t"): text.remove(t.text or "")
+                        self.strings.append("".join(text))
+                        root.clear()
+
+        self.dates = set()
+        if "xl/styles.xml" in names:
+            styles = ElementTree.fromstring(self.zip.read("xl/styles.xml"))
+            custom = set()
+            formats = styles.find(NS + "numFmts")
+            if formats is not None:
+                for fmt in formats.iter(NS + "numFmt"):
+                    if is_date_format(fmt.get("formatCode", "")): custom.add(int(fmt.get("numFmtId")))
+            xfs = styles.find(NS + "cellXfs")
+            if xfs is not None:
+                for i, xf in enumerate(xfs.iter(NS + "xf")):
+                    fmt = int(xf.get("numFmtId", "0"))
+                    if fmt in DATE_FORMATS or fmt in custom: self.dates.add(i)
+
+    def sheet_names(self):
+        return [sheet[0] for sheet in self.sheets]
+
+    """Returns the value of a cell as a Python object (None, str, int, float, bool or datetime)
+
+    :param elem: c element of the cell
+    """
+    def cell_value(self, elem):
+        type = elem.get("t", "n")
+        if type == "inlineStr":
+            return "".join(t.text or "" for t in elem.iter(NS + "t"))
+        v = elem.find(NS + "v")
+        if v is None or v.text is None: return None
+        value = v.text
+        if type == "s": return self.strings[int(value)]
+        if type == "b": return value == "1"
+        if type == "str" or type == "e": return value
+        if type == "d": return datetime.datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S" if "T" in value else "%Y-%m-%d")
+        if "." in value or "E" in value or "e" in value: number = float(value)
+        else: number = int(value)
+        if int(elem.get("s", "0")) in self.dates:
+            return from_excel(number, self.date1904)
+        return number
+
+    """Iterates over the rows of a sheet as lists of python values, padded to the width of
+    the sheet and including the empty rows.
+
+    :param sheet: name of the sheet, the first sheet if not provided
+    """
+    def values(self, sheet=None):
+        if sheet is None:
+            path = self.sheets[0][1]
+        else:
+            paths = [entry[1] for entry in self.sheets if entry[0] == sheet]
+            if not paths: raise KeyError("Sheet " + sheet + " not found in " + self.filename)
+            path = paths[0]
+        width = 0
+        next_row = 1
+        data = None
+        with self.zip.open(path) as file:
+            for event, elem in ElementTree.iterparse(file, ["start", "end"]):
+                if event == "start":
+                    if data is None and elem.tag == NS + "sheetData": data = elem
+                    continue
+                if elem.tag == NS + "dimension":
+                    ref = elem.get("ref", "A1").split(":")[-1]
+                    width = column_index(ref) + 1
+                elif elem.tag == NS + "row":
+                    number = int(elem.get("r", str(next_row)))
+                    while next_row < number:
+                        # Rows without any cells
+                        yield [None] * width
+                        next_row += 1
+                    row = [None] * width
+                    col = 0
+                    for c in elem.iter(NS + "c"):
+                        ref = c.get("r")
+                        if ref: col = column_index(ref)
+                        while len(row) <= col: row.append(None)
+                        row[col] = self.cell_value(c)
+                        col += 1
+                    next_row = number + 1
+                    # The parsed row is removed from sheetData
+                    data.clear()
+                    yield row
+
+    """Iterates over the rows of a sheet as lists of strings, formatted as in2csv does. The
+    type of each column is inferred first, in a separate pass over the sheet, so the values
+    of a column are formatted according to the type of the whole column.
+
+    :param sheet: name of the sheet, the first sheet if not provided
+    """
+    def rows(self, sheet=None):
+        types = infer_types(self.values(sheet))
+        first = True
+        for row in self.values(sheet):
+            if first:
+                yield [format_header(value) for value in row]
+                first = False
+            else:
+                yield [format_value(value, types[i] if i < len(types) else TEXT) for i, value in enumerate(row)]
+
+    def close(self):
+        self.zip.close()
+
+"""Converts the value of a cell as read by in2csv: dates at midnight become dates, and the
+microseconds of times are rounded.
+
+:param value: value of the cell
+"""
+def excel_value(value):
+    if value.__class__ is datetime.datetime:
+        if value.time() == NULL_TIME: return value.date()
+        return normalize_datetime(value)
+    return value
+
+"""Returns the value converted into the given column type, following the rules of the agate
+types used by in2csv. Raises ValueError if the value cannot be converted. Strings are only
+recognized as dates when they are in ISO format, and never as time intervals, which agate
+parses with natural language rules that do not occur in the Ebola sheets.
+
+:param value: value of the cell
+:param type: column type (BOOLEAN, NUMBER, DATE, DATETIME or TEXT)
+"""
+def cast(value, type):
+    if value is None: return None
+    if value.__class__ is str:
+        text = value.strip()
+        if text.lower() in NULL_VALUES: return None
+    if type == TEXT:
+        return value if value.__class__ is str else str(value)
+    if type == BOOLEAN:
+        if value.__class__ is bool: return value
+        if value.__class__ is int:
+            if value == 1: return True
+            if value == 0: return False
+        elif value.__class__ is str:
+            text = text.replace(",", "").lower()
+            if text in TRUE_VALUES: return True
+            if text in FALSE_VALUES: return False
+    elif type == NUMBER:
+        if value.__class__ is int: return decimal.Decimal(value)
+        if value.__class__ is float: return decimal.Decimal(repr(value))
+        if value.__class__ is str:
+            text = text.strip("%")
+            sign = 1
+            if text.startswith("-"):
+                text = text[1:]
+                sign = -1
+            try:
+                return decimal.Decimal(text.strip("$").replace(",", "")) * sign
+            except decimal.InvalidOperation:
+                pass
+    elif type == DATE:
+        if value.__class__ is datetime.date: return value
+        if value.__class__ is str:
+            try:
+                return datetime.datetime.strptime(text, "%Y-%m-%d").date()
+            except ValueError:
+                pass
+    elif type == DATETIME:
+        if value.__class__ is datetime.datetime: return value
+        if value.__class__ is datetime.date: return datetime.datetime.combine(value, NULL_TIME)
+        if value.__class__ is str:
+            for fmt in ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"]:
+                try:
+                    return datetime.datetime.strptime(text, fmt)
+                except ValueError:
+                    pass
+    raise ValueError("Cannot convert " + repr(value) + " to " + type)
+
+"""Returns the type of each column of a sheet, excluding the header row: the first type, in
+the order of preference of agate, that all the values of the column can be converted into.
+Columns that are empty or only have null values are boolean.
+
+:param rows: rows of the sheet as python values, as returned by Workbook.values
+"""
+def infer_types(rows):
+    hypotheses = None
+    for row in rows:
+        if hypotheses is None:
+            hypotheses = [list(TYPES) for value in row]
+            continue
+        for i in range(0, len(row)):
+            if len(hypotheses) <= i: hypotheses.append(list(TYPES))
+            types = hypotheses[i]
+            if len(types) == 1: continue
+            value = excel_value(row[i])
+            for type in types[:-1]:
+                try:
+                    cast(value, type)
+                except ValueError:
+                    types.remove(type)
+    if hypotheses is None: return []
+    return [types[0] for types in hypotheses]
+
+def format_header(value):
+    if value is None: return ""
+    if value.__class__ is float: return repr(value)
+    return str(value)
+
+def format_value(value, type=TEXT):
+    value = cast(excel_value(value), type)
+    if value is None: return ""
+    if type == DATE or type == DATETIME: return value.isoformat()
+    return str(value)
+
+"""Iterates over the rows of a sheet as lists of strings, the workbook is closed when all the
+rows were read
+
+:param filename: name of the .xlsx file
+:param sheet: name of the sheet, the first sheet if not provided
+"""
+def read_sheet(filename, sheet=None):
+    workbook = Workbook(filename)
+    try:
+        for row in workbook.rows(sheet):
+            yield row
+    finally:
+        workbook.close()
+
+"""Returns the number of rows of a sheet that are different from the rows of a csv file
+
+:param filename: name of the .xlsx file
+:param sheet: name of the sheet
+:param csv_filename: name of the csv file
+"""
+def check_sheet(filename, sheet, csv_filename):
+    mismatches = 0
+    with open(csv_filename, "r") as file:
+        pairs = itertools.zip_longest(read_sheet(filename, sheet), csv.reader(file))
+        for i, [row, exp] in enumerate(pairs):
+            if row == exp: continue
+            mismatches += 1
+            if mismatches <= 10:
+                print("  Row " + str(i + 1) + ": " + str(row) + " vs " + str(exp))
+    return mismatches
+
+if __name__ == "__main__":
+    for i in range(1, len(sys.argv)):
+        if sys.argv[i] == "-check":
+            [xlsx_name, sheet, csv_name] = sys.argv[i + 1:i + 4]
+            print("Checking " + xlsx_name + " (" + sheet + ") against " + csv_name + "...")
+            count = check_sheet(xlsx_name, sheet, csv_name)
+            if count:
+                print("Found " + str(count) + " different rows.")
+                sys.exit(1)
+            print("Done.")
+        elif sys.argv[i] == "-sheets":
+            print("\n".join(Workbook(sys.argv[i + 1]).sheet_names()))